@@ -0,0 +1,230 @@
+#
+#    Copyright 2019 EPAM Systems
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+"""
+Automatic choice of gunicorn workers, threads and worker class for a packaged model
+"""
+import json
+import logging
+import math
+import os
+import subprocess
+import typing
+
+from legion.packager.rest.constants import SERVER_MODE_WSGI, SERVER_MODE_ASGI, LEGION_SUB_PATH_NAME
+
+LOGGER = logging.getLogger(__name__)
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+# Duration (seconds) of every calibration phase and timeout of the whole calibration (including model init)
+CALIBRATION_DURATION = 1.0
+CALIBRATION_TIMEOUT = 300
+# Count of threads that predict concurrently in the second calibration phase
+CALIBRATION_THREADS = 4
+# CPU time / wall time of a prediction below which the model is considered to be waiting (I/O, remote calls)
+WAITING_CPU_RATIO = 0.5
+# Throughput gain of concurrent threads above which predictions are considered to run outside the GIL
+PARALLEL_THREADS_SPEEDUP = 1.5
+MAX_THREADS = 32
+
+# Is executed by Python of model environment with the output folder of the packager as working directory.
+# Prints JSON with latency, CPU/wall time ratio of sequential predictions and throughput gain of concurrent threads
+CALIBRATION_SCRIPT = '''
+import json
+import sys
+import threading
+import time
+
+import legion_model.entrypoint as entrypoint
+
+duration, threads = float(sys.argv[1]), int(sys.argv[2])
+entrypoint.init()
+input_schema, _ = entrypoint.info()
+columns = [column['name'] for column in input_schema]
+row = [column.get('example') for column in input_schema]
+
+
+def predict_until(deadline, counts):
+    count = 0
+    while time.perf_counter() < deadline:
+        entrypoint.predict_on_matrix([row], provided_columns_names=columns)
+        count += 1
+    counts.append(count)
+
+
+entrypoint.predict_on_matrix([row], provided_columns_names=columns)
+
+counts = []
+wall, cpu = time.perf_counter(), time.process_time()
+predict_until(wall + duration, counts)
+wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+concurrent_counts = []
+deadline = time.perf_counter() + duration
+workers = [threading.Thread(target=predict_until, args=(deadline, concurrent_counts)) for _ in range(threads)]
+for worker in workers:
+    worker.start()
+for worker in workers:
+    worker.join()
+
+print(json.dumps({
+    'latency': wall / counts[0],
+    'cpu_ratio': cpu / wall,
+    'threads_speedup': sum(concurrent_counts) / counts[0]
+}))
+'''
+
+
+class Calibration(typing.NamedTuple):
+    """
+    Measurements of model predictions on an example row
+    """
+
+    latency: float
+    cpu_ratio: float
+    threads_speedup: float
+
+
+class ServerSettings(typing.NamedTuple):
+    """
+    Chosen server settings with a human readable reasoning
+    """
+
+    workers: int
+    threads: int
+    server_mode: str
+    summary: str
+
+
+def _read_first_line(path: str) -> typing.Optional[str]:
+    try:
+        with open(path) as stream:
+            return stream.readline().strip()
+    except OSError:
+        return None
+
+
+def read_cpu_limit(cgroup_root: str = CGROUP_ROOT) -> float:
+    """
+    Get count of CPUs available for the current container: CFS quota of cgroup v2 or v1,
+    CPU affinity of the process if there is no quota
+
+    :param cgroup_root: mount point of cgroup file system
+    :return: count of CPUs (may be fractional)
+    """
+    cpu_max = _read_first_line(os.path.join(cgroup_root, 'cpu.max'))
+    if cpu_max:
+        quota, _, period = cpu_max.partition(' ')
+        if quota != 'max' and period:
+            return int(quota) / int(period)
+
+    for controller in ('cpu', 'cpu,cpuacct'):
+        quota = _read_first_line(os.path.join(cgroup_root, controller, 'cpu.cfs_quota_us'))
+        period = _read_first_line(os.path.join(cgroup_root, controller, 'cpu.cfs_period_us'))
+        if quota and period and int(quota) > 0:
+            return int(quota) / int(period)
+
+    if hasattr(os, 'sched_getaffinity'):
+        return float(len(os.sched_getaffinity(0)))
+    return float(os.cpu_count() or 1)
+
+
+def choose_native_threads(cpus: float, consumers: int) -> int:
+    """
+    Choose limit of native thread pools, so pools of all workers (or inference processes) fit the CPUs
+
+    :param cpus: count of CPUs available for the model server
+    :param consumers: count of processes that predict
+    :return: count of threads of every native thread pool
+    """
+    return max(1, int(cpus) // consumers)
+
+
+def calibrate(output_folder: str, python_bin: str,
+              duration: float = CALIBRATION_DURATION) -> typing.Optional[Calibration]:
+    """
+    Measure predict_on_matrix of packaged model in a separate process of model environment
+
+    :param output_folder: output folder of the packager (with copied model)
+    :param python_bin: Python of model environment
+    :param duration: duration (seconds) of every calibration phase
+    :return: calibration or None if model can not be run by the Python
+    """
+    # Model locates its files by MODEL_LOCATION as in the model server
+    env = dict(os.environ, PYTHONPATH=output_folder, MODEL_LOCATION=LEGION_SUB_PATH_NAME)
+    try:
+        result = subprocess.run([python_bin, '-c', CALIBRATION_SCRIPT, str(duration), str(CALIBRATION_THREADS)],
+                                cwd=output_folder, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                timeout=CALIBRATION_TIMEOUT, check=True, universal_newlines=True)
+        # Model may print to stdout, result is the last line
+        return Calibration(**json.loads(result.stdout.strip().splitlines()[-1]))
+    except subprocess.CalledProcessError as calibration_error:
+        LOGGER.warning('Calibration run of the model has failed: %s', calibration_error.stderr.strip())
+    except (OSError, subprocess.TimeoutExpired, ValueError, IndexError, TypeError) as calibration_error:
+        LOGGER.warning('Calibration run of the model has failed: %s', calibration_error)
+
+    return None
+
+
+def choose_server_settings(cpus: float, calibration: Calibration) -> ServerSettings:
+    """
+    Choose workers, threads and server mode
+
+    One worker is started per CPU (per several CPUs if one prediction uses them, e.g. BLAS),
+    threads are added if predictions wait or run outside the GIL and waiting models are served by ASGI workers
+
+    :param cpus: count of CPUs available for the model server
+    :param calibration: measurements of model predictions
+    :return: server settings
+    """
+    cores = max(1, int(cpus))
+    cpus_per_prediction = max(1.0, calibration.cpu_ratio)
+    workers = max(1, round(cores / cpus_per_prediction))
+    server_mode = SERVER_MODE_WSGI
+    if calibration.cpu_ratio < WAITING_CPU_RATIO:
+        # Threads of a worker wait most of time, enough of them to load its CPU
+        threads = min(MAX_THREADS, 2 * math.ceil(1 / max(calibration.cpu_ratio, 1 / MAX_THREADS)))
+        server_mode = SERVER_MODE_ASGI
+    elif calibration.threads_speedup >= PARALLEL_THREADS_SPEEDUP:
+        threads = CALIBRATION_THREADS
+    else:
+        # GIL-bound predictions, second thread only overlaps request I/O with prediction
+        threads = 2
+
+    return ServerSettings(workers, threads, server_mode,
+                          f'CPU limit {cpus:g}, prediction latency {calibration.latency * 1000:.3f} ms, '
+                          f'CPU/wall time ratio {calibration.cpu_ratio:.2f}, '
+                          f'{CALIBRATION_THREADS} threads speedup {calibration.threads_speedup:.2f}')
+
+
+def autotune(output_folder: str, python_bin: str, cpus: float) -> typing.Optional[ServerSettings]:
+    """
+    Choose server settings by CPU limit of the model server and calibration run of packaged model
+
+    :param output_folder: output folder of the packager (with copied model)
+    :param python_bin: Python of model environment
+    :param cpus: count of CPUs available for the model server
+    :return: server settings or None if the model can not be calibrated
+    """
+    calibration = calibrate(output_folder, python_bin)
+    if calibration is None:
+        LOGGER.warning('Server settings are not autotuned: the model can not be run by %s', python_bin)
+        return None
+
+    settings = choose_server_settings(cpus, calibration)
+    LOGGER.info('Autotuned server settings - workers: %d, threads: %d, server mode: %s (%s)',
+                settings.workers, settings.threads, settings.server_mode, settings.summary)
+
+    return settings
@@ -0,0 +1,614 @@
+#
+#    Copyright 2019 EPAM Systems
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+"""
+Benchmark of packaged model (output folder of the packager) served locally
+"""
+import collections
+import contextlib
+import importlib
+import json
+import logging
+import itertools
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing
+
+import click
+import requests
+from legion.sdk.clients.model_grpc import GrpcModelClient
+
+try:
+    import grpc
+except ImportError:
+    grpc = None
+
+from legion.packager.rest.constants import HANDLER_MODULE, HANDLER_ASGI_MODULE, HANDLER_APP, LEGION_SUB_PATH_NAME, \
+    SERVER_MODE_WSGI, SERVER_MODE_ASGI, ASGI_WORKER_CLASS, DESCRIPTION_TEMPLATE, SERVER_SETTINGS_FILE
+from legion.packager.rest.io_proc_utils import setup_logging
+
+SERVER_START_TIMEOUT = 60
+# Count of last lines of server output printed if the server fails to start
+SERVER_LOG_TAIL_LINES = 50
+
+
+def build_server_command(output_folder: str, server_mode: str, host: str, port: int, workers: int, threads: int,
+                         gunicorn_bin: str = 'gunicorn', preload: bool = False,
+                         timeout: typing.Optional[int] = None) -> typing.List[str]:
+    """
+    Build gunicorn command line for the packaged model
+
+    :param output_folder: output folder of the packager
+    :param server_mode: wsgi or asgi
+    :param host: host to bind
+    :param port: port to bind
+    :param workers: count of gunicorn workers
+    :param threads: count of threads per worker
+    :param gunicorn_bin: path to gunicorn binary
+    :param preload: load model in gunicorn master before forking workers
+    :param timeout: (Optional) worker timeout in seconds
+    :return: command line
+    """
+    command = [gunicorn_bin, '--pythonpath', output_folder, '-b', f'{host}:{port}', '-w', str(workers)]
+    if timeout is not None:
+        command += ['--timeout', str(timeout)]
+    if preload:
+        command.append('--preload')
+    if server_mode == SERVER_MODE_ASGI:
+        command += ['-k', ASGI_WORKER_CLASS, f'{HANDLER_ASGI_MODULE}:{HANDLER_APP}']
+    else:
+        command += ['--threads', str(threads), f'{HANDLER_MODULE}:{HANDLER_APP}']
+    return command
+
+
+@contextlib.contextmanager
+def start_server(command: typing.List[str], url: str, env: typing.Optional[typing.Dict[str, str]] = None):
+    """
+    Start server process and wait for its healthcheck
+
+    :param command: server command line
+    :param url: root url of the server
+    :param env: additional env. variables
+    :return: server process
+    """
+    process_env = dict(os.environ, MODEL_LOCATION=LEGION_SUB_PATH_NAME, **(env or {}))
+    # Output of the server is kept in a file to show it if the server fails
+    log_file = tempfile.NamedTemporaryFile(prefix='legion-benchmark-server-', suffix='.log', delete=False)
+    logging.info('Starting server (output is written to %s): %s', log_file.name, ' '.join(command))
+    process = subprocess.Popen(command, env=process_env, stdout=log_file, stderr=subprocess.STDOUT)
+
+    try:
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while True:
+            if process.poll() is not None:
+                raise Exception(f'Server has exited with code {process.returncode}:\n{read_log_tail(log_file.name)}')
+            try:
+                if requests.get(f'{url}/healthcheck', timeout=1).ok:
+                    break
+            except requests.exceptions.RequestException:
+                pass
+            if time.monotonic() > deadline:
+                raise Exception(f'Server has not started in {SERVER_START_TIMEOUT} seconds:\n'
+                                f'{read_log_tail(log_file.name)}')
+            time.sleep(0.2)
+
+        yield process
+    finally:
+        process.terminate()
+        process.wait()
+        log_file.close()
+
+
+def read_log_tail(path: str, lines: int = SERVER_LOG_TAIL_LINES) -> str:
+    """
+    Read last lines of a log file
+
+    :param path: path to the file
+    :param lines: count of lines
+    :return: text
+    """
+    with open(path, errors='replace') as stream:
+        return ''.join(collections.deque(stream, lines))
+
+
+def resolve_gunicorn_bin(settings: typing.Dict[str, typing.Any], gunicorn_bin: typing.Optional[str]) -> str:
+    """
+    Choose gunicorn binary: explicitly provided one, the one of the generated entrypoint (model environment)
+    if it exists locally, or the first one on PATH
+
+    :param settings: server settings of the entrypoint
+    :param gunicorn_bin: (Optional) explicitly provided path to gunicorn binary
+    :return: path to gunicorn binary
+    """
+    if gunicorn_bin:
+        return gunicorn_bin
+
+    entrypoint_bin = settings['gunicorn_bin']
+    if entrypoint_bin and os.path.exists(entrypoint_bin):
+        return entrypoint_bin
+
+    logging.warning('Gunicorn binary of the entrypoint %s does not exist, gunicorn from PATH is used', entrypoint_bin)
+    return 'gunicorn'
+
+
+def read_server_settings(output_folder: str) -> typing.Dict[str, typing.Any]:
+    """
+    Read server settings generated by the packager (server settings of entrypoint.sh saved from template context)
+
+    :param output_folder: output folder of the packager
+    :return: Legion's env. variables, gunicorn binary, server mode, preload flag, timeout, count of workers and threads
+    """
+    settings_path = os.path.join(output_folder, SERVER_SETTINGS_FILE)
+    if not os.path.exists(settings_path):
+        raise click.ClickException(f'{settings_path} is not found, repack the model with the current packager')
+
+    with open(settings_path) as settings_file:
+        return json.load(settings_file)
+
+
+def read_model_description(output_folder: str) -> typing.Dict[str, str]:
+    """
+    Read model name and version from description generated by the packager
+
+    :param output_folder: output folder of the packager
+    :return: model name and version (empty if they are not found)
+    """
+    with open(os.path.join(output_folder, DESCRIPTION_TEMPLATE)) as description_file:
+        description = description_file.read()
+
+    name = re.search(r'^Model name: (.*)$', description, re.MULTILINE)
+    version = re.search(r'^Model version: (.*)$', description, re.MULTILINE)
+    return {
+        'name': name.group(1).strip() if name else '',
+        'version': version.group(1).strip() if version else ''
+    }
+
+
+def parse_int_list(value: str) -> typing.List[int]:
+    """
+    Parse comma-separated list of positive integers
+
+    :param value: list as string, e.g. 1,10,100
+    :return: list of integers
+    """
+    try:
+        values = [int(item) for item in value.split(',') if item.strip()]
+    except ValueError:
+        raise click.BadParameter(f'{value!r} is not a comma-separated list of integers')
+    if not values or min(values) <= 0:
+        raise click.BadParameter(f'{value!r} has to contain positive integers')
+    return values
+
+
+def build_payload(url: str, rows: int) -> typing.Dict[str, typing.Any]:
+    """
+    Build invoke payload from example values of model info
+
+    :param url: root url of the server
+    :param rows: count of rows in payload
+    :return: invoke payload
+    """
+    info = requests.get(f'{url}/api/model/info').json()
+    properties = info['paths']['/api/model/invoke']['post']['parameters'][0]['schema']['properties']
+
+    return {
+        'columns': properties['columns']['example'],
+        'data': properties['data']['example'][:1] * rows
+    }
+
+
+def percentile(values: typing.List[float], ratio: float) -> float:
+    """
+    Get percentile of sorted values (nearest rank)
+
+    :param values: sorted values
+    :param ratio: percentile as ratio (0..1)
+    :return: value
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(ratio * len(values)))]
+
+
+def drive_calls(build_call: typing.Callable[[], typing.Callable[[], bool]], concurrency: int,
+                requests_count: int) -> typing.Dict[str, float]:
+    """
+    Make calls from concurrent clients and measure latency
+
+    :param build_call: factory of call function (one per client), call returns True on success
+    :param concurrency: count of concurrent clients
+    :param requests_count: total count of calls
+    :return: throughput (calls per second), latency percentiles (ms) and count of errors
+    """
+    latencies: typing.List[float] = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(range(requests_count))
+
+    def client():
+        call = build_call()
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            start = time.perf_counter()
+            ok = call()
+            elapsed = time.perf_counter() - start
+            with lock:
+                if ok:
+                    latencies.append(elapsed * 1000)
+                else:
+                    errors[0] += 1
+
+    start_time = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    duration = time.perf_counter() - start_time
+
+    latencies.sort()
+    return {
+        'throughput': len(latencies) / duration,
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'errors': errors[0]
+    }
+
+
+def drive_load(url: str, payload: typing.Dict[str, typing.Any], concurrency: int,
+               requests_count: int) -> typing.Dict[str, float]:
+    """
+    Send invoke requests from concurrent clients and measure latency
+
+    :param url: root url of the server
+    :param payload: invoke payload
+    :param concurrency: count of concurrent clients
+    :param requests_count: total count of requests
+    :return: throughput (requests per second), latency percentiles (ms) and count of errors
+    """
+    body = json.dumps(payload)
+    headers = {'Content-Type': 'application/json'}
+
+    def build_call():
+        session = requests.Session()
+
+        def call():
+            try:
+                return session.post(f'{url}/api/model/invoke', data=body, headers=headers).ok
+            except requests.exceptions.RequestException:
+                return False
+
+        return call
+
+    return drive_calls(build_call, concurrency, requests_count)
+
+
+def drive_grpc_load(target: str, payload: typing.Dict[str, typing.Any], concurrency: int,
+                    requests_count: int) -> typing.Dict[str, float]:
+    """
+    Make unary gRPC predictions from concurrent clients (legion-sdk and grpcio are required) and measure latency
+
+    :param target: gRPC server address (host:port)
+    :param payload: invoke payload
+    :param concurrency: count of concurrent clients
+    :param requests_count: total count of requests
+    :return: throughput (requests per second), latency percentiles (ms) and count of errors
+    """
+    if grpc is None:
+        raise ValueError('grpcio is required for gRPC benchmark')
+
+    def build_call():
+        client = GrpcModelClient(target)
+
+        def call():
+            try:
+                client.invoke(**payload)
+                return True
+            except grpc.RpcError:
+                return False
+
+        return call
+
+    return drive_calls(build_call, concurrency, requests_count)
+
+
+def get_child_pids(pid: int) -> typing.List[int]:
+    """
+    Get PIDs of child processes (Linux only)
+
+    :param pid: parent PID
+    :return: list of child PIDs
+    """
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as stat_file:
+                stat = stat_file.read()
+        except OSError:
+            continue
+        # Process name may contain spaces, so fields are counted after it
+        if int(stat.rsplit(')', 1)[1].split()[1]) == pid:
+            children.append(int(entry))
+    return sorted(children)
+
+
+def read_memory_usage(pid: int) -> typing.Dict[str, float]:
+    """
+    Read RSS, PSS, shared and private memory of process in MiB (Linux only)
+
+    :param pid: process PID
+    :return: memory usage
+    """
+    usage = {'Rss': 0, 'Pss': 0, 'Shared_Clean': 0, 'Shared_Dirty': 0, 'Private_Clean': 0, 'Private_Dirty': 0}
+    with open(f'/proc/{pid}/smaps') as smaps_file:
+        for line in smaps_file:
+            key, _, value = line.partition(':')
+            if key in usage:
+                usage[key] += int(value.split()[0])
+
+    return {
+        'rss_mb': usage['Rss'] / 1024,
+        'pss_mb': usage['Pss'] / 1024,
+        'shared_mb': (usage['Shared_Clean'] + usage['Shared_Dirty']) / 1024,
+        'private_mb': (usage['Private_Clean'] + usage['Private_Dirty']) / 1024
+    }
+
+
+@click.group()
+def benchmark():
+    """
+    Benchmarks of packaged model (output folder of the packager) served locally
+    """
+    pass
+
+
+@benchmark.command('serving-modes')
+@click.argument('output_folder', type=click.Path(exists=True, dir_okay=True, readable=True))
+@click.option('--port', type=int, default=5050, help='Port to start server on')
+@click.option('--workers', type=int, default=1, help='Count of gunicorn workers')
+@click.option('--threads', type=int, default=4, help='Count of threads (per worker or in prediction pool)')
+@click.option('--concurrency', type=int, default=16, help='Count of concurrent clients')
+@click.option('--requests', 'requests_count', type=int, default=2000, help='Count of requests per mode')
+@click.option('--rows', type=int, default=1, help='Count of rows in one request')
+@click.option('--gunicorn', 'gunicorn_bin', type=str, default=None,
+              help='Path to gunicorn binary (default: binary of the generated entrypoint)')
+@click.option('--verbose', is_flag=True, help='Verbose output')
+def compare_serving_modes(output_folder, port, workers, threads, concurrency, requests_count, rows,
+                          gunicorn_bin, verbose):
+    """
+    Compare WSGI (Flask) and ASGI (Starlette) serving of the packaged model and print results as JSON
+    """
+    setup_logging(verbose)
+    output_folder = os.path.abspath(output_folder)
+    gunicorn_bin = resolve_gunicorn_bin(read_server_settings(output_folder), gunicorn_bin)
+    url = f'http://127.0.0.1:{port}'
+    results = {}
+
+    for server_mode in (SERVER_MODE_WSGI, SERVER_MODE_ASGI):
+        command = build_server_command(output_folder, server_mode, '127.0.0.1', port, workers, threads, gunicorn_bin)
+        with start_server(command, url, env={'LEGION_PREDICT_THREADS': str(threads)}):
+            payload = build_payload(url, rows)
+            results[server_mode] = drive_load(url, payload, concurrency, requests_count)
+
+    click.echo(json.dumps(results, indent=2))
+
+
+@benchmark.command('preload')
+@click.argument('output_folder', type=click.Path(exists=True, dir_okay=True, readable=True))
+@click.option('--port', type=int, default=5050, help='Port to start server on')
+@click.option('--workers', type=int, default=4, help='Count of gunicorn workers')
+@click.option('--requests', 'requests_count', type=int, default=200, help='Count of requests to touch workers')
+@click.option('--gunicorn', 'gunicorn_bin', type=str, default=None,
+              help='Path to gunicorn binary (default: binary of the generated entrypoint)')
+@click.option('--verbose', is_flag=True, help='Verbose output')
+def compare_preload(output_folder, port, workers, requests_count, gunicorn_bin, verbose):
+    """
+    Compare per-worker RSS, PSS, shared and private memory with and without model preloading
+    and print results as JSON
+    """
+    setup_logging(verbose)
+    output_folder = os.path.abspath(output_folder)
+    gunicorn_bin = resolve_gunicorn_bin(read_server_settings(output_folder), gunicorn_bin)
+    url = f'http://127.0.0.1:{port}'
+    results = {}
+
+    for preload in (False, True):
+        command = build_server_command(output_folder, SERVER_MODE_WSGI, '127.0.0.1', port, workers, 1,
+                                       gunicorn_bin, preload)
+        with start_server(command, url, env={'LEGION_PRELOAD': 'true' if preload else 'false'}) as process:
+            drive_load(url, build_payload(url, 1), workers, requests_count)
+            master_memory = read_memory_usage(process.pid)
+            workers_memory = [read_memory_usage(pid) for pid in get_child_pids(process.pid)]
+
+        results['preload' if preload else 'no_preload'] = {
+            'master': master_memory,
+            'workers': workers_memory,
+            'total_workers_pss_mb': sum(memory['pss_mb'] for memory in workers_memory)
+        }
+
+    click.echo(json.dumps(results, indent=2))
+
+
+@benchmark.command('protocols')
+@click.argument('output_folder', type=click.Path(exists=True, dir_okay=True, readable=True))
+@click.option('--port', type=int, default=5050, help='Port to start HTTP server on')
+@click.option('--grpc-port', type=int, default=5051, help='Port to start gRPC server on')
+@click.option('--workers', type=int, default=1, help='Count of gunicorn workers')
+@click.option('--threads', type=int, default=4, help='Count of threads per worker')
+@click.option('--concurrency', type=int, default=16, help='Count of concurrent clients')
+@click.option('--requests', 'requests_count', type=int, default=2000, help='Count of requests per protocol')
+@click.option('--rows', type=int, default=1, help='Count of rows in one request')
+@click.option('--gunicorn', 'gunicorn_bin', type=str, default=None,
+              help='Path to gunicorn binary (default: binary of the generated entrypoint)')
+@click.option('--verbose', is_flag=True, help='Verbose output')
+def compare_protocols(output_folder, port, grpc_port, workers, threads, concurrency, requests_count, rows,
+                      gunicorn_bin, verbose):
+    """
+    Compare REST (JSON) and gRPC (packed tensors) invocation of the packaged model served by the same server
+    and print results as JSON
+    """
+    setup_logging(verbose)
+    output_folder = os.path.abspath(output_folder)
+    gunicorn_bin = resolve_gunicorn_bin(read_server_settings(output_folder), gunicorn_bin)
+    url = f'http://127.0.0.1:{port}'
+
+    command = build_server_command(output_folder, SERVER_MODE_WSGI, '127.0.0.1', port, workers, threads, gunicorn_bin)
+    with start_server(command, url, env={'LEGION_PREDICT_THREADS': str(threads), 'LEGION_GRPC_PORT': str(grpc_port)}):
+        payload = build_payload(url, rows)
+        results = {
+            'rest': drive_load(url, payload, concurrency, requests_count),
+            'grpc': drive_grpc_load(f'127.0.0.1:{grpc_port}', payload, concurrency, requests_count)
+        }
+
+    click.echo(json.dumps(results, indent=2))
+
+
+@benchmark.command('bench')
+@click.argument('output_folder', type=click.Path(exists=True, dir_okay=True, readable=True))
+@click.option('--batch-sizes', type=str, default='1,10,100', help='Comma-separated counts of rows in one request')
+@click.option('--workers', 'workers_list', type=str, default=None,
+              help='Comma-separated counts of gunicorn workers (default: generated setting)')
+@click.option('--threads', 'threads_list', type=str, default=None,
+              help='Comma-separated counts of threads per worker (default: generated setting)')
+@click.option('--concurrency', type=int, default=16, help='Count of concurrent clients')
+@click.option('--requests', 'requests_count', type=int, default=1000, help='Count of requests per measurement')
+@click.option('--port', type=int, default=5050, help='Port to start server on')
+@click.option('--gunicorn', 'gunicorn_bin', type=str, default=None,
+              help='Path to gunicorn binary (default: binary of the generated entrypoint)')
+@click.option('--report', type=click.Path(dir_okay=False, writable=True), default=None,
+              help='Path to save JSON report to (default: print it)')
+@click.option('--verbose', is_flag=True, help='Verbose output')
+def bench(output_folder, batch_sizes, workers_list, threads_list, concurrency, requests_count, port, gunicorn_bin,
+          report, verbose):
+    """
+    Start the packaged model locally with generated server settings, drive it with synthetic rows
+    built from examples of the model info for every combination of workers, threads and batch size,
+    and report throughput and latency percentiles as JSON
+    """
+    setup_logging(verbose)
+    output_folder = os.path.abspath(output_folder)
+    settings = read_server_settings(output_folder)
+    gunicorn_bin = resolve_gunicorn_bin(settings, gunicorn_bin)
+    batch_sizes = parse_int_list(batch_sizes)
+    workers_list = parse_int_list(workers_list) if workers_list else [settings['workers']]
+    threads_list = parse_int_list(threads_list) if threads_list else [settings['threads']]
+    url = f'http://127.0.0.1:{port}'
+    results = []
+
+    for workers, threads in itertools.product(workers_list, threads_list):
+        command = build_server_command(output_folder, settings['server_mode'], '127.0.0.1', port, workers, threads,
+                                       gunicorn_bin, settings['preload'], settings['timeout'])
+        # gRPC endpoint is not measured, so it does not take a port
+        env = dict(settings['env'], LEGION_PREDICT_THREADS=str(threads), LEGION_GRPC_PORT='0')
+        with start_server(command, url, env=env):
+            for batch_size in batch_sizes:
+                measurement = drive_load(url, build_payload(url, batch_size), concurrency, requests_count)
+                logging.info('workers=%d threads=%d batch_size=%d: %.1f requests/s',
+                             workers, threads, batch_size, measurement['throughput'])
+                results.append({
+                    'workers': workers,
+                    'threads': threads,
+                    'batch_size': batch_size,
+                    'rows_per_second': measurement['throughput'] * batch_size,
+                    **measurement
+                })
+
+    content = json.dumps({
+        'model': read_model_description(output_folder),
+        'server_mode': settings['server_mode'],
+        'preload': settings['preload'],
+        'concurrency': concurrency,
+        'requests': requests_count,
+        'results': results,
+        'best': max(results, key=lambda result: result['rows_per_second'])
+    }, indent=2)
+
+    if report:
+        with open(report, 'w') as report_file:
+            report_file.write(content)
+        logging.info('Benchmark report has been saved to %s', report)
+    else:
+        click.echo(content)
+
+
+def measure_handler(handler, body: bytes, handle_function, repeats: int) -> typing.Dict[str, float]:
+    """
+    Measure parsing and prediction of one request body by the handler (in-process)
+
+    :param handler: imported handler module
+    :param body: JSON request body
+    :param handle_function: handle_prediction_on_matrix or handle_prediction_on_objects of the handler
+    :param repeats: count of measurements
+    :return: latency percentiles (ms) or error
+    """
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = handle_function(handler.parse_request_data(body, handler.JSON_MIMETYPE, {}))
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        if isinstance(result, handler.Response):
+            return {'error': json.loads(result.get_data())['message']}
+
+    latencies.sort()
+    return {
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95)
+    }
+
+
+@benchmark.command('prediction-modes')
+@click.argument('output_folder', type=click.Path(exists=True, dir_okay=True, readable=True))
+@click.option('--rows', type=int, default=1000, help='Count of rows (objects) in one request')
+@click.option('--repeats', type=int, default=50, help='Count of measurements per mode')
+@click.option('--verbose', is_flag=True, help='Verbose output')
+def compare_prediction_modes(output_folder, rows, repeats, verbose):
+    """
+    Compare matrix and objects prediction modes of the packaged model in-process
+    (model has to implement both predict_on_matrix and predict_on_objects) and print results as JSON
+    """
+    setup_logging(verbose)
+    os.chdir(os.path.abspath(output_folder))
+    os.environ.setdefault('MODEL_LOCATION', LEGION_SUB_PATH_NAME)
+    sys.path.insert(0, os.getcwd())
+    handler = importlib.import_module(HANDLER_MODULE)
+
+    input_schema, _ = handler.legion_model.entrypoint.info()
+    columns = [prop['name'] for prop in input_schema]
+    example = [prop['example'] for prop in input_schema]
+
+    matrix_body = json.dumps({'columns': columns, 'data': [example] * rows}).encode('utf-8')
+    objects_body = json.dumps([dict(zip(columns, example))] * rows).encode('utf-8')
+
+    results = {
+        'matrix': measure_handler(handler, matrix_body, handler.handle_prediction_on_matrix, repeats),
+        'objects': measure_handler(handler, objects_body, handler.handle_prediction_on_objects, repeats)
+    }
+
+    click.echo(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    benchmark()  # pylint: disable=E1120
@@ -24,11 +24,34 @@ CONDA_FILE_NAME = 'conda.yaml'
 RESOURCES_FOLDER = os.path.join(os.path.dirname(__file__), 'resources')
 ENTRYPOINT_TEMPLATE = 'entrypoint.sh'
 DESCRIPTION_TEMPLATE = 'description.txt'
+# Server settings of the generated entrypoint.sh (read by benchmarks of the output folder)
+SERVER_SETTINGS_FILE = 'server_settings.json'
 ENTRYPOINT_DOCKER_TEMPLATE = 'entrypoint.docker.sh'
 DOCKERFILE_TEMPLATE = 'Dockerfile'
 DOCKERFILE_CONDA_INST_INSTRUCTIONS_TEMPLATE = 'conda.Dockerfile'
 HANDLER_MODULE = 'legion_handler'
+HANDLER_ASGI_MODULE = 'legion_handler_asgi'
+HANDLER_METRICS_MODULE = 'legion_handler_metrics'
+HANDLER_MULTI_MODULE = 'legion_handler_multi'
+HANDLER_POOL_MODULE = 'legion_handler_pool'
+HANDLER_GRPC_MODULE = 'legion_handler_grpc'
+HANDLER_LOG_MODULE = 'legion_handler_log'
+HANDLER_PROFILER_MODULE = 'legion_handler_profiler'
+GRPC_SERVICE_DEFINITION = 'legion_model_service.proto'
+# gRPC module of legion-sdk (message codec of the gRPC server) is copied with the handler if gRPC is enabled
+GRPC_CODEC_MODULE = 'legion_model_grpc'
 HANDLER_APP = 'app'
+# Additional modules that are copied with the handler
+HANDLER_EXTENSION_MODULES = (HANDLER_ASGI_MODULE, HANDLER_METRICS_MODULE, HANDLER_MULTI_MODULE, HANDLER_POOL_MODULE,
+                             HANDLER_GRPC_MODULE, HANDLER_LOG_MODULE, HANDLER_PROFILER_MODULE)
+# Packages installed to model environment if gRPC endpoint is enabled
+GRPC_PACKAGES = ('grpcio',)
+
+SERVER_MODE_WSGI = 'wsgi'
+SERVER_MODE_ASGI = 'asgi'
+ASGI_WORKER_CLASS = 'uvicorn.workers.UvicornWorker'
+# JSON codecs that are installed to model environment if they are chosen explicitly
+FAST_JSON_CODECS = ('orjson', 'ujson')
 
 TARGET_DOCKER_REGISTRY = 'docker-push'
 PULL_DOCKER_REGISTRY = 'docker-pull'
@@ -20,6 +20,8 @@ import typing
 
 import pydantic
 
+from legion.packager.rest.constants import SERVER_MODE_WSGI, SERVER_MODE_ASGI
+
 DEFAULT_IMAGE_NAME_TEMPLATE = "{{ Name }}-{{ Version }}:{{ RandomUUID }}"
 
 
@@ -78,5 +80,105 @@ class PackagingResourceArguments(pydantic.BaseModel):
     timeout: int = 60
     workers: int = 1
     threads: int = 4
+    # Choose workers, threads and server mode by CPU limit and calibration run of the model during packaging
+    # (model environment has to be available to the packager, otherwise configured settings are kept)
+    # and count of CPUs of the model server (required for autotune, it is also used for native thread limits)
+    autotune: bool = False
+    autotuneCpus: float = 0
+    # wsgi (gunicorn + Flask) or asgi (gunicorn + uvicorn, prediction runs in a pool of `threads` threads)
+    serverMode: str = SERVER_MODE_WSGI
+    # Load model in gunicorn master before forking workers (copy-on-write sharing of model memory)
+    preload: bool = False
+    # Count of predictions on example rows of model info before the model reports readiness (0 disables warmup)
+    warmupIterations: int = 0
+    # Admission control (per worker): max count of in-flight and queued predictions
+    # and max estimated wait time of a new one, exceeding requests are rejected with 503 (0 disables a limit).
+    # Queue depth is limited only in asgi mode: wsgi requests wait for a gunicorn thread before the handler sees them
+    maxQueueDepth: int = 0
+    maxEstimatedWaitMs: int = 0
+    # Min size (bytes) of invoke response to compress it with gzip/zstd accepted by client (0 disables compression)
+    compressionMinSize: int = 1024
+    # Support zstd Content-Encoding in addition to gzip (installs zstandard to model environment)
+    zstdCompression: bool = False
+    # Max size (MB) of decompressed invoke request body (of a line for stream requests), larger ones get 413
+    maxDecompressedMb: int = 100
+    # Count of dedicated inference processes per worker, matrices are passed through shared memory
+    # (0 predicts in the worker). Requires numpy in model environment
+    inferenceProcesses: int = 0
+    # Limit of native thread pools (OpenMP, MKL, OpenBLAS, numexpr) of every worker or inference process
+    # (0 - CPU quota of the model container divided by count of workers and inference processes)
+    nativeThreads: int = 0
+    # Port of gRPC endpoint (legion.model.ModelService) served alongside HTTP (0 disables gRPC)
+    grpcPort: int = 0
+    # Validate and cast input matrices by input schema of the model info before prediction
+    # (model receives numpy arrays). Requires numpy in model environment
+    inputValidation: bool = False
+    # Reorder provided input columns to the declared order of the model info before prediction
+    # (missing and unknown columns are rejected)
+    reorderColumns: bool = False
+    # Sink of asynchronous prediction log: path to file, file://, tcp://host:port or unix:// URL (empty disables log)
+    # and max size (MB) of serialized records waiting for writing per worker (new records are dropped if it is exceeded)
+    predictionLog: str = ''
+    predictionLogQueueMb: int = 64
+    # Token of /api/model/profile endpoint (Profiler-Token header), only its SHA-256 digest is stored in the image.
+    # Empty value disables the profiler
+    profilerToken: str = ''
+    # Max count of rows coalesced from concurrent requests into one prediction (0 disables batching)
+    batchMaxSize: int = 0
+    batchMaxWaitMs: int = 5
+    # Count of rows predicted at once by streaming endpoint
+    streamChunkSize: int = 1000
+    # Max count of cached prediction rows (0 disables cache). Is used only for deterministic models
+    predictionCacheSize: int = 0
+    predictionCacheTtl: int = 300
+    # JSON codec of model server: auto (the fastest installed), orjson, ujson or json (standard library)
+    jsonCodec: str = 'auto'
+    # Serve GPPI models from subdirectories of the directory (in the model container) by multi-model host
+    # instead of the packaged model (empty disables) and max estimated memory of loaded models (0 disables eviction).
+    # Requires wsgi server mode without autotune, preload, inference processes and gRPC
+    modelsLocation: str = ''
+    modelsMemoryBudgetMb: int = 0
     # Full name or Jinja template
     imageName: str = DEFAULT_IMAGE_NAME_TEMPLATE
+
+    @pydantic.validator('serverMode')
+    def check_server_mode(cls, value):  # pylint: disable=E0213
+        """
+        Check that server mode is supported
+        """
+        if value not in (SERVER_MODE_WSGI, SERVER_MODE_ASGI):
+            raise ValueError(f'Unknown server mode {value!r}, {SERVER_MODE_WSGI} or {SERVER_MODE_ASGI} is expected')
+        return value
+
+    @pydantic.validator('autotuneCpus', always=True)
+    def check_autotune_cpus(cls, value, values):  # pylint: disable=E0213
+        """
+        Check that CPUs of the model server are provided for autotune (the packaging container has other CPUs)
+        """
+        if values.get('autotune') and value <= 0:
+            raise ValueError('autotuneCpus (CPU limit of the model server) is required for autotune')
+        return value
+
+    @pydantic.validator('modelsLocation')
+    def check_models_location(cls, value, values):  # pylint: disable=E0213
+        """
+        Check that multi-model host is not combined with options which are bound to the packaged model
+        """
+        if value:
+            unsupported = [option for option in ('autotune', 'preload', 'inferenceProcesses', 'grpcPort')
+                           if values.get(option)]
+            if values.get('serverMode') != SERVER_MODE_WSGI:
+                unsupported.append('serverMode')
+            if unsupported:
+                raise ValueError(f'modelsLocation can not be combined with {", ".join(unsupported)}')
+        return value
+
+    @pydantic.validator('maxQueueDepth')
+    def check_max_queue_depth(cls, value, values):  # pylint: disable=E0213
+        """
+        Check that queue depth is limited in the server mode where queued requests are visible to the handler
+        """
+        if value and values.get('serverMode') != SERVER_MODE_ASGI:
+            raise ValueError(f'maxQueueDepth requires {SERVER_MODE_ASGI} server mode, '
+                             f'queued requests of {SERVER_MODE_WSGI} workers wait in gunicorn')
+        return value
@@ -13,21 +13,28 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 #
+import hashlib
 import io
+import json
 import logging
 import os.path
 import shutil
 import uuid
+from typing import Any, Dict
 
 import yaml
+from legion.packager.rest.autotune import autotune
 from legion.packager.rest.constants import LEGION_SUB_PATH_NAME, RESOURCES_FOLDER, HANDLER_MODULE, CONDA_FILE_NAME, \
     ENTRYPOINT_TEMPLATE, ENTRYPOINT_DOCKER_TEMPLATE, HANDLER_APP, DESCRIPTION_TEMPLATE, \
-    DOCKERFILE_CONDA_INST_INSTRUCTIONS_TEMPLATE, DOCKERFILE_TEMPLATE
+    DOCKERFILE_CONDA_INST_INSTRUCTIONS_TEMPLATE, DOCKERFILE_TEMPLATE, HANDLER_ASGI_MODULE, HANDLER_EXTENSION_MODULES, \
+    SERVER_MODE_ASGI, ASGI_WORKER_CLASS, FAST_JSON_CODECS, GRPC_PACKAGES, GRPC_SERVICE_DEFINITION, \
+    HANDLER_MULTI_MODULE, GRPC_CODEC_MODULE, SERVER_SETTINGS_FILE
 from legion.packager.rest.data_models import PackagingResourceArguments, LegionProjectManifest
 from legion.packager.rest.io_proc_utils import make_executable, run
 from legion.packager.rest.manifest_and_resource import validate_model_manifest, get_model_manifest
-from legion.packager.rest.template import DockerTemplateContext, render_packager_template
+from legion.packager.rest.template import DockerTemplateContext, render_packager_template, build_server_environment
 from legion.packager.rest.version import __version__
+from legion.sdk.clients import model_grpc
 
 
 def work(model, output_folder, conda_env, ignore_conda, conda_env_name,
@@ -62,10 +69,6 @@ def work(model, output_folder, conda_env, ignore_conda, conda_env_name,
                                          conda_env_name, ignore_conda,
                                          manifest, output_folder, conda_dep_list)
 
-    # Building of variables for template file and generating of output
-    final_entrypoint = render_packager_template(ENTRYPOINT_TEMPLATE, context.dict())
-    final_entrypoint_docker = render_packager_template(ENTRYPOINT_DOCKER_TEMPLATE, context.dict())
-
     # Copying of model to destination subdirectory
     model_location = os.path.join(model, manifest.model.workDir)
     target_model_location = os.path.join(output_folder, LEGION_SUB_PATH_NAME)
@@ -74,11 +77,27 @@ def work(model, output_folder, conda_env, ignore_conda, conda_env_name,
     shutil.copytree(model_location, target_model_location)
 
     # Copying of handler function
-    handler_location = os.path.join(RESOURCES_FOLDER, f'{HANDLER_MODULE}.py')
-    target_handler_location = os.path.join(output_folder, f'{HANDLER_MODULE}.py')
+    for module in (HANDLER_MODULE,) + HANDLER_EXTENSION_MODULES:
+        handler_location = os.path.join(RESOURCES_FOLDER, f'{module}.py')
+        target_handler_location = os.path.join(output_folder, f'{module}.py')
 
-    logging.info(f'Copying handler {handler_location} to {target_handler_location}')
-    shutil.copy(handler_location, target_handler_location)
+        logging.info(f'Copying handler {handler_location} to {target_handler_location}')
+        shutil.copy(handler_location, target_handler_location)
+
+    # Copying of gRPC service definition for clients in other languages and of the message codec
+    if arguments.grpcPort:
+        shutil.copy(os.path.join(RESOURCES_FOLDER, GRPC_SERVICE_DEFINITION),
+                    os.path.join(output_folder, GRPC_SERVICE_DEFINITION))
+        shutil.copy(model_grpc.__file__, os.path.join(output_folder, f'{GRPC_CODEC_MODULE}.py'))
+
+    # Calibration imports the copied model, so it is run after copying
+    if arguments.autotune:
+        _autotune_template_context(context, arguments, output_folder)
+    context.server_environment = build_server_environment(context)
+
+    # Building of variables for template file and generating of output
+    final_entrypoint = render_packager_template(ENTRYPOINT_TEMPLATE, context.dict())
+    final_entrypoint_docker = render_packager_template(ENTRYPOINT_DOCKER_TEMPLATE, context.dict())
 
     # Copying of conda env
     target_conda_env_location = os.path.join(output_folder, CONDA_FILE_NAME)
@@ -99,6 +118,12 @@ def work(model, output_folder, conda_env, ignore_conda, conda_env_name,
     with open(description_target, 'w') as out_stream:
         out_stream.write(description_data)
 
+    # Save server settings of entrypoint.sh
+    server_settings_target = os.path.join(output_folder, SERVER_SETTINGS_FILE)
+    logging.info(f'Dumping server settings to {server_settings_target}')
+    with open(server_settings_target, 'w') as out_stream:
+        json.dump(_get_server_settings(context), out_stream, indent=2)
+
     if dockerfile:
         entrypoint_docker_target = os.path.join(output_folder, ENTRYPOINT_DOCKER_TEMPLATE)
         logging.info(f'Dumping {ENTRYPOINT_DOCKER_TEMPLATE} to {entrypoint_target}')
@@ -120,6 +145,69 @@ def work(model, output_folder, conda_env, ignore_conda, conda_env_name,
     return manifest
 
 
+def _autotune_template_context(context: DockerTemplateContext, arguments: PackagingResourceArguments,
+                               output_folder: str) -> None:
+    """
+    Replace workers, threads and server mode of template context by autotuned ones
+    (configured ones are kept if the model can not be calibrated)
+    """
+    # Model environment is not built if local conda is ignored, calibration by Python of the packager
+    # would measure other versions of dependencies (or fail on missing ones)
+    python_bin = os.path.join(context.path, 'python')
+    if not os.path.exists(python_bin):
+        logging.warning(f'Model environment is not found ({python_bin}), autotuning is skipped, '
+                        f'configured server settings are kept')
+        return
+
+    settings = autotune(output_folder, python_bin, arguments.autotuneCpus)
+    if settings is None:
+        return
+
+    if arguments.maxQueueDepth and settings.server_mode != SERVER_MODE_ASGI:
+        logging.info('Server mode %s is kept for limit of queue depth', SERVER_MODE_ASGI)
+        settings = settings._replace(server_mode=SERVER_MODE_ASGI)
+    asgi_mode = settings.server_mode == SERVER_MODE_ASGI
+
+    context.workers = str(settings.workers)
+    context.threads = str(settings.threads)
+    context.server_mode = settings.server_mode
+    context.worker_class = ASGI_WORKER_CLASS if asgi_mode else ''
+    context.wsgi_handler = f'{HANDLER_ASGI_MODULE if asgi_mode else HANDLER_MODULE}:{HANDLER_APP}'
+    context.autotune_summary = settings.summary
+    context.native_thread_consumers = _native_thread_consumers(arguments, settings.workers)
+
+
+def _get_server_settings(context: DockerTemplateContext) -> Dict[str, Any]:
+    """
+    Get server settings of entrypoint.sh from template context
+    """
+    return {
+        'env': context.server_environment,
+        'gunicorn_bin': context.gunicorn_bin,
+        'server_mode': context.server_mode,
+        'preload': context.preload,
+        'timeout': int(context.timeout),
+        'workers': int(context.workers),
+        'threads': int(context.threads)
+    }
+
+
+def _native_thread_consumers(arguments: PackagingResourceArguments, workers: int) -> str:
+    """
+    Get count of processes that share CPUs of the container (entrypoint divides CPU quota by it at start)
+    """
+    return str(workers * max(1, arguments.inferenceProcesses))
+
+
+def _get_handler_module(arguments: PackagingResourceArguments) -> str:
+    """
+    Get module of the server application: multi-model host, ASGI or WSGI handler of the packaged model
+    """
+    if arguments.modelsLocation:
+        return HANDLER_MULTI_MODULE
+    return HANDLER_ASGI_MODULE if arguments.serverMode == SERVER_MODE_ASGI else HANDLER_MODULE
+
+
 def _generate_template_context(arguments: PackagingResourceArguments,
                                conda_env: str,
                                conda_env_name: str,
@@ -130,6 +218,18 @@ def _generate_template_context(arguments: PackagingResourceArguments,
     """
     Generate Docker packager context for templates
     """
+    asgi_mode = arguments.serverMode == SERVER_MODE_ASGI
+    server_packages = ['gunicorn[gevent]', 'flask']
+    # Autotune may choose ASGI workers after the environment is built
+    if asgi_mode or arguments.autotune:
+        server_packages += ['uvicorn', 'starlette']
+    if arguments.zstdCompression:
+        server_packages.append('zstandard')
+    if arguments.jsonCodec in FAST_JSON_CODECS:
+        server_packages.append(arguments.jsonCodec)
+    if arguments.grpcPort:
+        server_packages += list(GRPC_PACKAGES)
+
     env_id = str(uuid.uuid4())
     if conda_env_name:
         logging.info(f'Using specified conda env name {conda_env_name!r} instead of generation')
@@ -159,14 +259,18 @@ def _generate_template_context(arguments: PackagingResourceArguments,
         conda_prefix = conda_info.get('prefix')
 
         # Install additional requirements to env (gunicorn)
-        logging.info(f'Installing additional packages (gunicorn) in env {env_id} at {conda_prefix}')
-        run(f'{conda_prefix}/bin/pip', 'install', 'gunicorn[gevent]')
-        run(f'{conda_prefix}/bin/pip', 'install', 'flask')
+        logging.info(f'Installing additional packages ({server_packages}) in env {env_id} at {conda_prefix}')
+        for package in server_packages:
+            run(f'{conda_prefix}/bin/pip', 'install', package)
     else:
         logging.info(f'Local usage of conda has been disabled due to flag specified')
         conda_prefix = arguments.dockerfileCondaEnvsLocation
 
     logging.info(f'Building context for template')
+    # Plain profiler token is not stored in the output
+    profiler_token_sha256 = ''
+    if arguments.profilerToken:
+        profiler_token_sha256 = hashlib.sha256(arguments.profilerToken.encode('utf-8')).hexdigest()
 
     return DockerTemplateContext(
         model_name=manifest.model.name,
@@ -183,11 +287,40 @@ def _generate_template_context(arguments: PackagingResourceArguments,
         port=arguments.port,
         workers=arguments.workers,
         threads=arguments.threads,
+        server_mode=arguments.serverMode,
+        preload=arguments.preload,
+        warmup_iterations=arguments.warmupIterations,
+        max_queue_depth=arguments.maxQueueDepth,
+        max_estimated_wait_ms=arguments.maxEstimatedWaitMs,
+        compression_min_size=arguments.compressionMinSize,
+        zstd_compression=arguments.zstdCompression,
+        max_decompressed_mb=arguments.maxDecompressedMb,
+        inference_processes=arguments.inferenceProcesses,
+        native_threads=arguments.nativeThreads,
+        native_thread_consumers=_native_thread_consumers(arguments, arguments.workers),
+        grpc_port=arguments.grpcPort,
+        input_validation=arguments.inputValidation,
+        reorder_columns=arguments.reorderColumns,
+        prediction_log=arguments.predictionLog,
+        prediction_log_queue_mb=arguments.predictionLogQueueMb,
+        profiler_token_sha256=profiler_token_sha256,
+        worker_class=ASGI_WORKER_CLASS if asgi_mode else '',
+        autotune_summary='',
+        batch_max_size=arguments.batchMaxSize,
+        batch_max_wait_ms=arguments.batchMaxWaitMs,
+        stream_chunk_size=arguments.streamChunkSize,
+        prediction_cache_size=arguments.predictionCacheSize,
+        prediction_cache_ttl=arguments.predictionCacheTtl,
+        json_codec=arguments.jsonCodec,
+        models_location=arguments.modelsLocation,
+        models_memory_budget_mb=arguments.modelsMemoryBudgetMb,
         pythonpath=output_folder,
-        wsgi_handler=f'{HANDLER_MODULE}:{HANDLER_APP}',
+        wsgi_handler=f'{_get_handler_module(arguments)}:{HANDLER_APP}',
         model_location=LEGION_SUB_PATH_NAME,
         entrypoint_target=ENTRYPOINT_TEMPLATE,
         handler_file=f'{HANDLER_MODULE}.py',
+        handler_extension_files=[f'{module}.py' for module in HANDLER_EXTENSION_MODULES] +
+        ([f'{GRPC_CODEC_MODULE}.py'] if arguments.grpcPort else []),
         base_image=arguments.dockerfileBaseImage,
         conda_installation_content='',
         conda_file_name=CONDA_FILE_NAME,
@@ -1,13 +1,38 @@
 #!/usr/bin/env bash
 
-# Starting of Gunicorn server with Legion's HTTP handler
+# Starting of Gunicorn server (WSGI or ASGI workers) with Legion's HTTP handler
+{%- if autotune_summary %}
+# Workers, threads and server mode are autotuned: {{ autotune_summary }}
+{%- endif %}
+
+{% include 'native_threads.sh' %}
+
+# Workers write snapshots of their metrics to the directory, /metrics merges snapshots of all workers
+LEGION_METRICS_DIR=${LEGION_METRICS_DIR:-$(mktemp -d -t legion-metrics.XXXXXX)}
 
 PATH={{ path }}:$PATH \
 MODEL_LOCATION={{ model_location }} \
+{%- for name, value in server_environment.items() %}
+{{ name }}={{ value }} \
+{%- endfor %}
+LEGION_METRICS_DIR=$LEGION_METRICS_DIR \
+LEGION_NATIVE_THREADS=$LEGION_NATIVE_THREADS \
+OMP_NUM_THREADS=$LEGION_NATIVE_THREADS \
+MKL_NUM_THREADS=$LEGION_NATIVE_THREADS \
+OPENBLAS_NUM_THREADS=$LEGION_NATIVE_THREADS \
+NUMEXPR_NUM_THREADS=$LEGION_NATIVE_THREADS \
+VECLIB_MAXIMUM_THREADS=$LEGION_NATIVE_THREADS \
     {{ gunicorn_bin }} \
     --pythonpath {{ pythonpath }}/ \
     --timeout {{ timeout }} \
     -b {{ host }}:{{ port }} \
     -w {{ workers }} \
+{%- if preload %}
+    --preload \
+{%- endif %}
+{%- if worker_class %}
+    -k {{ worker_class }} \
+{%- else %}
     --threads {{ threads }} \
+{%- endif %}
     {{ wsgi_handler }}
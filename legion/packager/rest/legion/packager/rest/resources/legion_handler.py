@@ -13,28 +13,232 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 #
+import atexit
+import collections
+import contextlib
 import functools
+import gc
+import gzip
+import hashlib
+import hmac
+import io
 import json
+import logging
+import math
+import operator
 import os
-from typing import List, Dict, Union, Any
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+from typing import List, Dict, Union, Any, Optional, Tuple
 
+import legion_handler_metrics as metrics
 import legion_model.entrypoint
 from flask import Flask, jsonify, Response, request
+from werkzeug.http import parse_accept_header
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 REQUEST_ID = 'x-request-id'
 MODEL_REQUEST_ID = 'request-id'
 MODEL_NAME = 'Model-Name'
 MODEL_VERSION = 'Model-Version'
+DATA_COLUMNS = 'Data-Columns'
+PROFILER_TOKEN = 'Profiler-Token'
+REQUEST_TIMEOUT_MS = 'Request-Timeout-Ms'
+REQUEST_DEADLINE = 'Request-Deadline'
+
+JSON_MIMETYPE = 'application/json'
+NPY_MIMETYPE = 'application/x-npy'
+ARROW_MIMETYPE = 'application/vnd.apache.arrow.stream'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+GZIP_ENCODING = 'gzip'
+ZSTD_ENCODING = 'zstd'
+GZIP_COMPRESSION_LEVEL = 6
 
 app = Flask(__name__)
 SUPPORTED_PREDICTION_MODE = legion_model.entrypoint.init()
 
 LEGION_MODEL_NAME = "LEGION_MODEL_NAME"
 LEGION_MODEL_VERSION = "LEGION_MODEL_VERSION"
+LEGION_BATCH_MAX_SIZE = "LEGION_BATCH_MAX_SIZE"
+LEGION_BATCH_MAX_WAIT_MS = "LEGION_BATCH_MAX_WAIT_MS"
+LEGION_STREAM_CHUNK_SIZE = "LEGION_STREAM_CHUNK_SIZE"
+LEGION_PREDICTION_CACHE_SIZE = "LEGION_PREDICTION_CACHE_SIZE"
+LEGION_PREDICTION_CACHE_TTL = "LEGION_PREDICTION_CACHE_TTL"
+LEGION_JSON_CODEC = "LEGION_JSON_CODEC"
+LEGION_PRELOAD = "LEGION_PRELOAD"
+LEGION_WARMUP_ITERATIONS = "LEGION_WARMUP_ITERATIONS"
+LEGION_PREDICT_THREADS = "LEGION_PREDICT_THREADS"
+LEGION_MAX_QUEUE_DEPTH = "LEGION_MAX_QUEUE_DEPTH"
+LEGION_MAX_ESTIMATED_WAIT_MS = "LEGION_MAX_ESTIMATED_WAIT_MS"
+LEGION_COMPRESSION_MIN_SIZE = "LEGION_COMPRESSION_MIN_SIZE"
+LEGION_MAX_DECOMPRESSED_MB = "LEGION_MAX_DECOMPRESSED_MB"
+LEGION_INFERENCE_PROCESSES = "LEGION_INFERENCE_PROCESSES"
+LEGION_INFERENCE_TIMEOUT_MS = "LEGION_INFERENCE_TIMEOUT_MS"
+LEGION_GRPC_PORT = "LEGION_GRPC_PORT"
+LEGION_INPUT_VALIDATION = "LEGION_INPUT_VALIDATION"
+LEGION_REORDER_COLUMNS = "LEGION_REORDER_COLUMNS"
+LEGION_PREDICTION_LOG = "LEGION_PREDICTION_LOG"
+LEGION_PREDICTION_LOG_QUEUE_MB = "LEGION_PREDICTION_LOG_QUEUE_MB"
+LEGION_METRICS_DIR = "LEGION_METRICS_DIR"
+# Limits of native thread pools (OpenMP, MKL, OpenBLAS, numexpr), they are set by the entrypoint
+NATIVE_THREAD_VARIABLES = ('LEGION_NATIVE_THREADS', 'OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                           'NUMEXPR_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS')
+LEGION_PROFILER_TOKEN_SHA256 = "LEGION_PROFILER_TOKEN_SHA256"
+
+LOGGER = logging.getLogger(__name__)
+
+
+def build_error_response(message, status=500):
+    return Response(response=json.dumps({'message': message}), status=status, mimetype=JSON_MIMETYPE)
+
+
+def get_supported_mimetypes() -> List[str]:
+    """
+    Get request/response formats, supported in current environment (JSON is preferred)
+
+    :return: list of mimetypes
+    """
+    mimetypes = [JSON_MIMETYPE]
+    if numpy:
+        mimetypes.append(NPY_MIMETYPE)
+        if pyarrow:
+            mimetypes.append(ARROW_MIMETYPE)
+    return mimetypes
+
+
+def to_json_builtin(value: Any) -> Any:
+    """
+    Convert numpy values to JSON-serializable builtin types
+
+    :param value: value that is not serializable by JSON codec
+    :return: builtin value
+    """
+    if numpy and isinstance(value, numpy.ndarray):
+        return value.tolist()
+    if numpy and isinstance(value, numpy.generic):
+        return value.item()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+class NumpyJSONEncoder(json.JSONEncoder):
+    """
+    JSON encoder for numpy values (binary requests are parsed to numpy arrays)
+    """
+
+    def default(self, o):  # pylint: disable=E0202
+        try:
+            return to_json_builtin(o)
+        except TypeError:
+            return super().default(o)
+
+
+class JSONCodec:
+    """
+    Standard library JSON codec. Parses bytes and serializes to bytes
+    """
+
+    name = 'json'
+
+    def loads(self, data: bytes) -> Any:
+        return json.loads(data)
+
+    def dumps(self, value: Any, serializer=None) -> bytes:
+        """
+        Serialize value
 
+        :param value: value to serialize
+        :param serializer: (Optional) JSONEncoder class declared by the model
+        :return: JSON bytes
+        """
+        return json.dumps(value, cls=serializer or NumpyJSONEncoder).encode('utf-8')
 
-def build_error_response(message):
-    return Response(response=json.dumps({'message': message}), status=500, mimetype='application/json')
+
+class OrjsonCodec(JSONCodec):
+    """
+    orjson codec. Serializes numpy arrays natively
+    """
+
+    name = 'orjson'
+
+    def loads(self, data: bytes) -> Any:
+        return orjson.loads(data)
+
+    def dumps(self, value: Any, serializer=None) -> bytes:
+        if serializer:
+            return super().dumps(value, serializer)
+        return orjson.dumps(value, default=to_json_builtin, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+class UjsonCodec(JSONCodec):
+    """
+    ujson codec
+    """
+
+    name = 'ujson'
+
+    def loads(self, data: bytes) -> Any:
+        return ujson.loads(data)
+
+    def dumps(self, value: Any, serializer=None) -> bytes:
+        if serializer:
+            return super().dumps(value, serializer)
+        return ujson.dumps(value, default=to_json_builtin, ensure_ascii=False).encode('utf-8')
+
+
+def build_json_codec(name: str) -> JSONCodec:
+    """
+    Build JSON codec by name (auto - the fastest installed one). Falls back to the standard library
+
+    :param name: auto, orjson, ujson or json
+    :return: JSON codec
+    """
+    codecs = {'orjson': (orjson, OrjsonCodec), 'ujson': (ujson, UjsonCodec)}
+
+    if name == 'auto':
+        for module, codec in codecs.values():
+            if module:
+                return codec()
+    elif name in codecs:
+        module, codec = codecs[name]
+        if module:
+            return codec()
+        LOGGER.warning('JSON codec %s is not installed, standard library is used', name)
+    elif name != JSONCodec.name:
+        LOGGER.warning('Unknown JSON codec %s, standard library is used', name)
+
+    return JSONCodec()
+
+
+JSON_CODEC = build_json_codec(os.getenv(LEGION_JSON_CODEC, 'auto'))
 
 
 @functools.lru_cache()
@@ -47,14 +251,55 @@ def get_json_output_serializer():
 
 @app.route('/api/model/info', methods=['GET'])
 def info():
+    body, etag = get_info_document()
+
+    resp = Response(response=body, status=200, mimetype=JSON_MIMETYPE)
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'no-cache'
+
+    return resp.make_conditional(request)
+
+
+@functools.lru_cache()
+def get_info_document() -> Tuple[bytes, str]:
+    """
+    Build and encode OpenAPI document of the model once.
+    Call get_info_document.cache_clear() if the model is reloaded.
+
+    :return: encoded document and its ETag
+    """
     # Consider, if model does not provide info endpoint
-    # TODO: Refactor this
     input_schema, output_schema = legion_model.entrypoint.info()
 
-    input_properties = generate_input_props(input_schema)
-    output_properties = generate_output_props(output_schema)
+    body = json.dumps(build_info_document(generate_input_props(input_schema),
+                                          generate_output_props(output_schema))).encode('utf-8')
+
+    return body, hashlib.sha1(body).hexdigest()
+
 
-    return jsonify({
+def get_native_thread_limits() -> Dict[str, Optional[int]]:
+    """
+    Get limits of native thread pools of the worker
+
+    :return: limit by environment variable (None if it is not set)
+    """
+    limits = {}
+    for variable in NATIVE_THREAD_VARIABLES:
+        value = os.getenv(variable, '')
+        limits[variable] = int(value) if value.isdigit() else None
+
+    return limits
+
+
+def build_info_document(input_properties: Dict[str, Any], output_properties: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Build OpenAPI document of the model
+
+    :param input_properties: input model properties in OpenAPI format
+    :param output_properties: output model properties in OpenAPI format
+    :return: OpenAPI document
+    """
+    return {
         "swagger": "2.0",
         "info": {
             "description": "This is a EDI server.",
@@ -72,6 +317,7 @@ def info():
         ],
         "host": "",
         "basePath": "",
+        "x-native-thread-limits": get_native_thread_limits(),
         "paths": {
             "/api/model/info": {
                 "get": {
@@ -89,15 +335,40 @@ def info():
                     }
                 }
             },
+            "/api/model/batch": {
+                "post": {
+                    "description": "Execute predictions for a list of independent invoke payloads",
+                    "consumes": [JSON_MIMETYPE],
+                    "produces": [JSON_MIMETYPE],
+                    "summary": "Batch prediction",
+                    "parameters": [
+                        {
+                            "in": "body",
+                            "name": "BatchPredictionParameters",
+                            "required": True,
+                            "schema": {
+                                "items": {
+                                    "properties": input_properties,
+                                    "type": "object"
+                                },
+                                "type": "array"
+                            }
+                        }
+                    ],
+                    "responses": {
+                        "200": {
+                            "description": "Results of predictions (or errors) in order of payloads",
+                            "name": "BatchPredictionResponse",
+                            "type": "array"
+                        }
+                    }
+                }
+            },
             "/api/model/invoke": {
                 "post": {
                     "description": "Execute prediction",
-                    "consumes": [
-                        "application/json"
-                    ],
-                    "produces": [
-                        "application/json"
-                    ],
+                    "consumes": get_supported_mimetypes(),
+                    "produces": get_supported_mimetypes(),
                     "summary": "Prediction",
                     "parameters": [
                         {
@@ -121,7 +392,7 @@ def info():
                 }
             }
         }
-    })
+    }
 
 
 def generate_input_props(input_schema: List[Dict[str, Union[Union[str, None, bool], Any]]]) -> Dict[str, Any]:
@@ -187,65 +458,1992 @@ def generate_output_props(output_schema: List[Dict[str, Union[Union[str, None, b
     }
 
 
+try:
+    get_info_document()
+except Exception as info_exception:
+    LOGGER.warning('Can not build model info document: %s', info_exception)
+
+
 @app.route('/healthcheck', methods=['GET'])
 def ping():
     return jsonify({'status': True})
 
 
-def handle_prediction_on_matrix(parsed_data):
-    matrix = parsed_data.get('data')
-    columns = parsed_data.get('columns', None)
+class DeadlineExceeded(Exception):
+    """
+    Deadline of the request has passed before prediction
+    """
 
-    if not matrix:
-        return build_error_response('Matrix is not provided')
+    def __init__(self):
+        super().__init__('Request deadline has been exceeded before prediction')
+
+
+def parse_deadline(headers) -> Optional[float]:
+    """
+    Parse request deadline from Request-Timeout-Ms (relative, in ms)
+    or Request-Deadline (absolute, unix time in seconds) headers. Invalid values are ignored
+
+    :param headers: request headers
+    :return: deadline as time.monotonic() value or None
+    """
+    timeout_ms = headers.get(REQUEST_TIMEOUT_MS)
+    deadline = headers.get(REQUEST_DEADLINE)
 
     try:
-        prediction, columns = legion_model.entrypoint.predict_on_matrix(matrix, provided_columns_names=columns)
-    except Exception as predict_exception:
-        return build_error_response(f'Exception during prediction: {predict_exception}')
+        if timeout_ms:
+            return time.monotonic() + float(timeout_ms) / 1000
+        if deadline:
+            return time.monotonic() + float(deadline) - time.time()
+    except ValueError:
+        LOGGER.warning('Can not parse %s or %s header as a number, deadline is ignored',
+                       REQUEST_TIMEOUT_MS, REQUEST_DEADLINE)
 
-    response = {
-        'prediction': prediction,
-        'columns': columns
-    }
+    return None
 
-    response_json = json.dumps(response, cls=get_json_output_serializer())
-    return response_json
 
+def check_deadline(deadline: Optional[float]):
+    """
+    Check that deadline has not passed
 
-def handle_prediction_on_objects(parsed_data):
-    return build_error_response('Can not handle this types of requests')
+    :param deadline: deadline as time.monotonic() value or None
+    :raises DeadlineExceeded: if the deadline has passed
+    """
+    if deadline is not None and time.monotonic() >= deadline:
+        raise DeadlineExceeded()
 
 
-@app.route('/api/model/invoke', methods=['POST'])
-def predict():
-    if not request.data:
-        return build_error_response('Please provide data with this POST request')
+class _BatchItem:
+    """
+    Rows of one request waiting for a batched prediction
+    """
 
-    try:
-        data = request.data.decode('utf-8')
-    except UnicodeDecodeError as decode_error:
-        return build_error_response(f'Can not decode POST data using utf-8 charset: {decode_error}')
+    __slots__ = ('matrix', 'columns', 'deadline', 'future')
 
-    try:
-        parsed_data = json.loads(data)
-    except ValueError as value_error:
-        return build_error_response(f'Can not parse input as JSON: {value_error}')
+    def __init__(self, matrix: List[List[Any]], columns: Optional[List[str]], deadline: Optional[float] = None):
+        self.matrix = matrix
+        self.columns = columns
+        self.deadline = deadline
+        self.future = Future()
 
-    if SUPPORTED_PREDICTION_MODE == 'matrix':
-        response_json = handle_prediction_on_matrix(parsed_data)
-    elif SUPPORTED_PREDICTION_MODE == 'objects':
-        response_json = handle_prediction_on_objects(parsed_data)
-    else:
-        return build_error_response(f'Unknown model\'s return type: {SUPPORTED_PREDICTION_MODE}')
 
-    resp = Response(response=response_json, status=200, mimetype='application/json')
+class MicroBatcher:
+    """
+    Coalesces rows of concurrent requests into one predict_on_matrix call
+
+    Items that are already queued are always taken without waiting. The batcher waits up to max_wait
+    for more rows only if the previous batch has been shared by several requests, so a single client
+    does not pay the wait time on every call.
+    """
 
-    resp.headers[MODEL_NAME] = os.getenv(LEGION_MODEL_NAME)
-    resp.headers[MODEL_VERSION] = os.getenv(LEGION_MODEL_VERSION)
+    def __init__(self, predict_function, max_size: int, max_wait: float):
+        """
+        Build batcher
 
-    request_id = request.headers.get(MODEL_REQUEST_ID) or request.headers.get(REQUEST_ID)
-    if request_id:
-        resp.headers[MODEL_REQUEST_ID] = request_id
+        :param predict_function: function with predict_on_matrix interface
+        :param max_size: max count of rows in one batch
+        :param max_wait: max time (in seconds) to wait for more rows
+        """
+        self._predict_function = predict_function
+        self._max_size = max_size
+        self._max_wait = max_wait
+        self._queue = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._worker_lock = threading.Lock()
+        self._last_batch_requests = 1
+        self._closed = False
 
-    return resp
+    def predict(self, matrix: List[List[Any]], columns: Optional[List[str]] = None,
+                deadline: Optional[float] = None) -> Tuple[Any, Any]:
+        """
+        Make prediction for the rows of one request
+
+        :param matrix: data for prediction
+        :param columns: (Optional). Name of columns for provided matrix.
+        :param deadline: (Optional). Deadline (time.monotonic() value), rows are dropped if it passes in the queue
+        :return: result matrix and result column names
+        """
+        if not self._ensure_worker():
+            # Requests that are still in flight after close are predicted without batching
+            check_deadline(deadline)
+            return self._predict_function(matrix, provided_columns_names=columns)
+
+        item = _BatchItem(matrix, columns, deadline)
+        self._queue.put(item)
+
+        return item.future.result()
+
+    def close(self):
+        """
+        Stop the worker thread after queued items are predicted
+        """
+        with self._worker_lock:
+            self._closed = True
+            worker, self._worker = self._worker, None
+
+        if worker and worker.is_alive():
+            self._queue.put(None)
+            worker.join()
+
+    def _ensure_worker(self) -> bool:
+        """
+        Start the worker thread lazily, so it is created in a process that serves requests
+
+        :return: is the worker running (it is not after close)
+        """
+        if self._worker and self._worker.is_alive():
+            return True
+
+        with self._worker_lock:
+            if self._closed:
+                return False
+            if not self._worker or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._work, name='legion-micro-batcher', daemon=True)
+                self._worker.start()
+
+        return True
+
+    def _collect(self) -> List[_BatchItem]:
+        """
+        Collect next batch of items (blocks until at least one item is available)
+
+        :return: items of batch, empty list if the batcher is closed
+        """
+        item = self._queue.get()
+        if item is None:
+            return []
+
+        items = [item]
+        rows = len(item.matrix)
+
+        deadline = None
+        if self._last_batch_requests > 1:
+            deadline = time.monotonic() + self._max_wait
+
+        while rows < self._max_size:
+            try:
+                if deadline is None:
+                    item = self._queue.get_nowait()
+                else:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+
+            if item is None:
+                # Close is handled by the next collect, after the collected items are predicted
+                self._queue.put(None)
+                break
+
+            items.append(item)
+            rows += len(item.matrix)
+
+        self._last_batch_requests = len(items)
+        return items
+
+    def _work(self):
+        while True:
+            items = self._collect()
+            if not items:
+                return
+
+            # Only requests with the same columns can share one call
+            groups: Dict[Any, List[_BatchItem]] = {}
+            now = time.monotonic()
+            for item in items:
+                if item.deadline is not None and now >= item.deadline:
+                    item.future.set_exception(DeadlineExceeded())
+                    continue
+                key = tuple(item.columns) if item.columns is not None else None
+                groups.setdefault(key, []).append(item)
+
+            for group in groups.values():
+                try:
+                    self._predict_group(group)
+                except Exception as batch_exception:
+                    # The worker thread has to survive, otherwise requests of the worker wait forever
+                    LOGGER.exception('Micro batch of %d requests has failed', len(group))
+                    self._fail(group, batch_exception)
+
+    def _predict_group(self, items: List[_BatchItem]):
+        """
+        Make one prediction for the group of items and split results back
+
+        :param items: items with the same columns
+        """
+        if len(items) == 1:
+            self._predict_single(items[0])
+            return
+
+        try:
+            matrix = concatenate_matrices([item.matrix for item in items])
+        except ValueError:
+            # Matrices can not be stacked (e.g. numpy arrays of different widths without columns)
+            for item in items:
+                self._predict_single(item)
+            return
+
+        try:
+            prediction, columns = self._predict_function(matrix, provided_columns_names=items[0].columns)
+            # Model does not return one row per input row (or returns a scalar), so results can not be split
+            splittable = prediction is not None and len(prediction) == len(matrix)
+        except Exception as predict_exception:
+            self._fail(items, predict_exception)
+            return
+
+        if not splittable:
+            for item in items:
+                self._predict_single(item)
+            return
+
+        try:
+            offset = 0
+            for item in items:
+                item.future.set_result((prediction[offset:offset + len(item.matrix)], columns))
+                offset += len(item.matrix)
+        except Exception as split_exception:
+            self._fail(items, split_exception)
+
+    @staticmethod
+    def _fail(items: List[_BatchItem], exception: Exception):
+        """
+        Set exception to futures of items that are not resolved yet
+
+        :param items: items of batch
+        :param exception: exception to set
+        """
+        for item in items:
+            if not item.future.done():
+                item.future.set_exception(exception)
+
+    def _predict_single(self, item: _BatchItem):
+        try:
+            item.future.set_result(self._predict_function(item.matrix, provided_columns_names=item.columns))
+        except Exception as predict_exception:
+            item.future.set_exception(predict_exception)
+
+
+def concatenate_matrices(matrices: List[Any]) -> Any:
+    """
+    Concatenate rows of matrices (numpy arrays are concatenated without conversion to lists)
+
+    :param matrices: list of matrices
+    :return: matrix
+    """
+    if numpy and all(isinstance(matrix, numpy.ndarray) for matrix in matrices):
+        return numpy.concatenate(matrices)
+
+    result = []
+    for matrix in matrices:
+        result.extend(matrix)
+    return result
+
+
+def build_micro_batcher() -> Optional[MicroBatcher]:
+    """
+    Build micro batcher if it is enabled using env. variables
+
+    :return: micro batcher or None
+    """
+    max_size = int(os.getenv(LEGION_BATCH_MAX_SIZE, '0'))
+    if max_size <= 0:
+        return None
+
+    max_wait = int(os.getenv(LEGION_BATCH_MAX_WAIT_MS, '5')) / 1000
+
+    return MicroBatcher(PREDICT_FUNCTION, max_size, max_wait)
+
+
+def build_inference_pool():
+    """
+    Build pool of inference processes if it is enabled using env. variables
+
+    :return: inference pool or None
+    """
+    processes = int(os.getenv(LEGION_INFERENCE_PROCESSES, '0'))
+    if processes <= 0:
+        return None
+
+    import legion_handler_pool
+    pool = legion_handler_pool.InferencePool(
+        legion_model.entrypoint.__name__, processes,
+        int(os.getenv(LEGION_INFERENCE_TIMEOUT_MS, str(int(legion_handler_pool.TASK_TIMEOUT * 1000)))) / 1000
+    )
+    if os.getenv(LEGION_PRELOAD) != 'true':
+        # Preloaded handler is imported in gunicorn master, so processes are started on the first request in worker
+        pool.start()
+
+    return pool
+
+
+INFERENCE_POOL = build_inference_pool()
+# Function with predict_on_matrix interface: pool of inference processes or model's predict_on_matrix
+PREDICT_FUNCTION = INFERENCE_POOL.predict if INFERENCE_POOL else legion_model.entrypoint.predict_on_matrix
+MICRO_BATCHER = build_micro_batcher()
+
+
+class PredictionCache:
+    """
+    Size-bounded LRU cache of prediction rows with TTL
+
+    Rows are keyed by a canonical hash of row values and column names.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        """
+        Build cache
+
+        :param max_size: max count of cached rows
+        :param ttl: time to live of cached rows in seconds (0 - rows do not expire)
+        """
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def build_key(row: Any, columns: Optional[List[str]]) -> bytes:
+        """
+        Build canonical hash of row values and column names
+
+        :param row: values of row
+        :param columns: (Optional). Name of columns
+        :return: hash digest
+        """
+        canonical = JSON_CODEC.dumps([columns, row])
+        return hashlib.blake2b(canonical, digest_size=16).digest()
+
+    def get(self, key: bytes) -> Optional[Tuple[Any, Any]]:
+        """
+        Get cached prediction row and output columns
+
+        :param key: row key
+        :return: cached value or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._ttl and entry[0] < time.monotonic():
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: bytes, value: Tuple[Any, Any]):
+        """
+        Store prediction row and output columns
+
+        :param key: row key
+        :param value: prediction row and output columns
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self._ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get cache counters
+
+        :return: dict of counters
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+    def predict(self, matrix: Any, columns: Optional[List[str]], predict_function) -> Tuple[Any, Any]:
+        """
+        Make prediction only for rows that are not cached
+
+        :param matrix: data for prediction
+        :param columns: (Optional). Name of columns for provided matrix.
+        :param predict_function: function to predict missing rows (matrix, columns)
+        :return: result matrix and result column names
+        """
+        keys = [self.build_key(row, columns) for row in matrix]
+        cached = [self.get(key) for key in keys]
+        missing = [index for index, value in enumerate(cached) if value is None]
+
+        if missing:
+            if numpy and isinstance(matrix, numpy.ndarray):
+                missing_matrix = matrix[missing]
+            else:
+                missing_matrix = [matrix[index] for index in missing]
+
+            prediction, output_columns = predict_function(missing_matrix, columns)
+
+            if len(prediction) != len(missing):
+                # Model does not return one row per input row, so rows can not be cached
+                if len(missing) == len(keys):
+                    return prediction, output_columns
+                return predict_function(matrix, columns)
+
+            for index, row in zip(missing, prediction):
+                cached[index] = (row, output_columns)
+                self.put(keys[index], cached[index])
+
+        return [value[0] for value in cached], cached[0][1]
+
+
+def is_model_deterministic() -> bool:
+    """
+    Check if model declares that it returns the same prediction for the same input
+
+    :return: is model deterministic
+    """
+    if hasattr(legion_model.entrypoint, 'is_deterministic'):
+        return bool(legion_model.entrypoint.is_deterministic())
+    return False
+
+
+def build_prediction_cache() -> Optional[PredictionCache]:
+    """
+    Build prediction cache if it is enabled using env. variables and model is deterministic
+
+    :return: prediction cache or None
+    """
+    max_size = int(os.getenv(LEGION_PREDICTION_CACHE_SIZE, '0'))
+    if max_size <= 0:
+        return None
+
+    if not is_model_deterministic():
+        LOGGER.warning('Prediction cache is disabled because model does not declare itself as deterministic')
+        return None
+
+    return PredictionCache(max_size, int(os.getenv(LEGION_PREDICTION_CACHE_TTL, '300')))
+
+
+PREDICTION_CACHE = build_prediction_cache()
+
+
+def _predict_on_matrix(matrix: Any, columns: Optional[List[str]] = None,
+                       deadline: Optional[float] = None) -> Tuple[Any, Any]:
+    check_deadline(deadline)
+
+    if MICRO_BATCHER:
+        return MICRO_BATCHER.predict(matrix, columns, deadline)
+    if INFERENCE_POOL:
+        try:
+            return INFERENCE_POOL.predict(matrix, columns, deadline)
+        except TimeoutError:
+            # Wait for the inference process is bounded by the deadline of the request
+            check_deadline(deadline)
+            raise
+
+    return PREDICT_FUNCTION(matrix, provided_columns_names=columns)
+
+
+class InputValidationError(ValueError):
+    """
+    Input matrix does not match input schema of the model
+    """
+    pass
+
+
+class InputSchema:
+    """
+    Validator and coercer of input matrices compiled from input schema of the model info
+
+    Every column is checked and cast to numpy dtype of its schema type in one vectorized pass,
+    so the model receives a numpy array: numeric columns are stacked with type promotion,
+    matrices with string columns are object arrays.
+    """
+
+    def __init__(self, fields: List[Tuple[str, Optional[str], bool]]):
+        """
+        Build schema
+
+        :param fields: name, type (None if not declared) and required flag of every input column in schema order
+        """
+        self.fields = fields
+        self.names = tuple(name for name, _, _ in fields)
+        self._fields_by_name = {field[0]: field for field in fields}
+        self._required = {name for name, _, required in fields if required}
+
+    @classmethod
+    def from_info(cls, input_schema: List[Dict[str, Any]]) -> 'InputSchema':
+        """
+        Compile schema from input schema of the model info
+
+        :param input_schema: list of properties with name, type and required flag
+        :return: schema
+        """
+        return cls([(prop['name'], prop.get('type'), bool(prop.get('required', False))) for prop in input_schema])
+
+    @classmethod
+    def cast_column(cls, name: str, column_type: Optional[str], required: bool, values: Any) -> Any:
+        """
+        Check and cast values of one column
+
+        :param name: column name
+        :param column_type: schema type (integer, number, boolean or string), other types are not cast
+        :param required: missing (null) values are not allowed
+        :param values: 1-dimensional numpy array
+        :raises InputValidationError: if values can not be cast
+        :return: cast values
+        """
+        missing = numpy.equal(values, None) if values.dtype.hasobject else numpy.zeros(len(values), dtype=bool)
+        missing_count = int(missing.sum())
+        if required and missing_count:
+            raise InputValidationError(f'Column {name} is required, {missing_count} values are missing')
+
+        if column_type == 'boolean':
+            if not numpy.all(missing | numpy.equal(values, True) | numpy.equal(values, False)):
+                raise InputValidationError(f'Column {name} has to contain boolean values')
+            return values if missing_count else values.astype(numpy.bool_)
+        if column_type == 'string':
+            return values if missing_count else values.astype(str)
+        if column_type not in ('integer', 'number'):
+            return values
+
+        try:
+            # Missing values of optional numeric columns are NaN
+            as_float = values.astype(numpy.float64)
+        except (TypeError, ValueError) as cast_error:
+            raise InputValidationError(f'Column {name} has to contain numbers: {cast_error}')
+        if column_type == 'number' or missing_count:
+            return as_float
+
+        if not numpy.all(numpy.isfinite(as_float)) or not numpy.array_equal(as_float, numpy.trunc(as_float)):
+            raise InputValidationError(f'Column {name} has to contain integer values')
+        try:
+            # Direct cast keeps precision of integers above 2**53
+            return values.astype(numpy.int64)
+        except (TypeError, ValueError, OverflowError):
+            return as_float.astype(numpy.int64)
+
+    def coerce(self, matrix: Any, columns: Optional[List[str]] = None) -> Any:
+        """
+        Validate matrix and cast its columns
+
+        :param matrix: list of rows or numpy array
+        :param columns: (Optional). Name of columns for provided matrix, schema order is used if not provided
+        :raises InputValidationError: if matrix does not match the schema
+        :return: cast matrix (numpy array)
+        """
+        names = self.names if columns is None else tuple(columns)
+        if columns is not None:
+            unknown = [name for name in names if name not in self._fields_by_name]
+            if unknown:
+                raise InputValidationError(f'Unknown columns: {", ".join(map(str, unknown))}')
+            if len(set(names)) != len(names):
+                raise InputValidationError('Column names have to be unique')
+            absent = self._required.difference(names)
+            if absent:
+                raise InputValidationError(f'Required columns are not provided: {", ".join(sorted(absent))}')
+
+        values = matrix if isinstance(matrix, numpy.ndarray) else numpy.asarray(matrix, dtype=object)
+        if values.ndim != 2 or values.shape[1] != len(names):
+            raise InputValidationError(f'Every row has to contain {len(names)} values')
+
+        cast = [self.cast_column(*self._fields_by_name[name], values[:, index]) for index, name in enumerate(names)]
+        if all(column.dtype.kind in 'biuf' for column in cast):
+            return numpy.column_stack(cast)
+
+        result = numpy.empty(values.shape, dtype=object)
+        for index, column in enumerate(cast):
+            result[:, index] = column
+        return result
+
+
+def build_input_schema() -> Optional[InputSchema]:
+    """
+    Compile input schema if input validation is enabled using env. variables
+
+    :return: schema or None
+    """
+    if os.getenv(LEGION_INPUT_VALIDATION) != 'true':
+        return None
+    if numpy is None:
+        LOGGER.warning('Input validation requires numpy, it is disabled')
+        return None
+
+    try:
+        input_schema, _ = legion_model.entrypoint.info()
+    except Exception as info_exception:
+        LOGGER.warning('Can not compile input schema from model info, input validation is disabled: %s',
+                       info_exception)
+        return None
+
+    return InputSchema.from_info(input_schema) if input_schema else None
+
+
+INPUT_SCHEMA = build_input_schema()
+
+
+@functools.lru_cache()
+def get_input_columns() -> Optional[Tuple[str, ...]]:
+    """
+    Get declared order of input columns (object fields) from input schema of the model info (is built once)
+
+    :return: column names or None if the model does not provide input schema
+    """
+    try:
+        input_schema, _ = legion_model.entrypoint.info()
+    except Exception as info_exception:
+        LOGGER.warning('Can not get order of input columns from model info: %s', info_exception)
+        return None
+
+    return tuple(prop['name'] for prop in input_schema) or None
+
+
+# Count of distinct column tuples with cached permutations
+COLUMN_PERMUTATION_CACHE_SIZE = 256
+
+
+@functools.lru_cache(maxsize=COLUMN_PERMUTATION_CACHE_SIZE)
+def get_column_permutation(columns: Tuple[str, ...]) -> Optional[Tuple[int, ...]]:
+    """
+    Get permutation of provided columns to the declared input order (is computed once per column tuple)
+
+    :param columns: provided column names
+    :raises InputValidationError: if columns are not unique, missing or unknown
+    :return: indexes of provided columns in the declared order or None if the order is the same
+    """
+    declared = get_input_columns()
+    positions = {name: index for index, name in enumerate(columns)}
+    if len(positions) != len(columns):
+        raise InputValidationError('Column names have to be unique')
+
+    errors = []
+    unknown = [str(name) for name in columns if name not in set(declared)]
+    if unknown:
+        errors.append(f'Unknown columns: {", ".join(unknown)}')
+    missing = [name for name in declared if name not in positions]
+    if missing:
+        errors.append(f'Columns are not provided: {", ".join(missing)}')
+    if errors:
+        raise InputValidationError('; '.join(errors))
+
+    permutation = tuple(positions[name] for name in declared)
+    return None if permutation == tuple(range(len(columns))) else permutation
+
+
+def reorder_columns(matrix: Any, columns: List[str]) -> Any:
+    """
+    Reorder matrix columns to the declared input order by the cached permutation
+
+    :param matrix: list of rows or numpy array
+    :param columns: provided column names
+    :raises InputValidationError: if columns or row widths do not match the declared input columns
+    :return: matrix with columns in the declared order (numpy array or list of rows)
+    """
+    try:
+        permutation = get_column_permutation(tuple(columns))
+    except TypeError:
+        raise InputValidationError('Column names have to be strings')
+
+    if numpy and isinstance(matrix, numpy.ndarray):
+        if matrix.ndim != 2 or matrix.shape[1] != len(columns):
+            raise InputValidationError(f'Every row has to contain {len(columns)} values')
+        return matrix if permutation is None else matrix[:, permutation]
+
+    try:
+        widths = set(map(len, matrix))
+    except TypeError:
+        widths = None
+    if widths != {len(columns)}:
+        raise InputValidationError(f'Every row has to contain {len(columns)} values')
+    if permutation is None:
+        return matrix
+
+    getter = operator.itemgetter(*permutation)
+    if len(permutation) == 1:
+        return [[row[permutation[0]]] for row in matrix]
+    return list(map(list, map(getter, matrix)))
+
+
+def build_column_reordering() -> bool:
+    """
+    Check if column reordering is enabled using env. variables and the model declares input columns
+
+    :return: is reordering enabled
+    """
+    if os.getenv(LEGION_REORDER_COLUMNS) != 'true':
+        return False
+    if not get_input_columns():
+        LOGGER.warning('Model info does not declare input columns, column reordering is disabled')
+        return False
+
+    return True
+
+
+REORDER_COLUMNS = build_column_reordering()
+
+
+def prepare_matrix(matrix: List[List[Any]], columns: Optional[List[str]] = None) -> Tuple[Any, Optional[List[str]]]:
+    """
+    Reorder columns to the declared input order and validate and cast the matrix by the input schema
+    if these features are enabled
+
+    :param matrix: data for prediction
+    :param columns: (Optional). Name of columns for provided matrix.
+    :raises InputValidationError: if the matrix does not match the input schema
+    :return: matrix and column names for prediction
+    """
+    if REORDER_COLUMNS and columns is not None:
+        matrix = reorder_columns(matrix, columns)
+        columns = list(get_input_columns())
+
+    if INPUT_SCHEMA:
+        matrix = INPUT_SCHEMA.coerce(matrix, columns)
+
+    return matrix, columns
+
+
+def predict_on_prepared_matrix(matrix: Any, columns: Optional[List[str]] = None,
+                               deadline: Optional[float] = None) -> Tuple[Any, Any]:
+    """
+    Make prediction on matrix returned by prepare_matrix using the prediction cache
+    and the micro batcher if they are enabled
+
+    :param matrix: data for prediction
+    :param columns: (Optional). Name of columns for provided matrix.
+    :param deadline: (Optional). Deadline (time.monotonic() value) of the request
+    :return: result matrix and result column names
+    """
+    if PREDICTION_CACHE:
+        return PREDICTION_CACHE.predict(matrix, columns, functools.partial(_predict_on_matrix, deadline=deadline))
+
+    return _predict_on_matrix(matrix, columns, deadline)
+
+
+def predict_on_matrix(matrix: List[List[Any]], columns: Optional[List[str]] = None,
+                      deadline: Optional[float] = None) -> Tuple[Any, Any]:
+    """
+    Make prediction using the prediction cache and the micro batcher if they are enabled
+    (columns are reordered to the declared input order and the matrix is validated and cast
+    by the input schema if these features are enabled)
+
+    :param matrix: data for prediction
+    :param columns: (Optional). Name of columns for provided matrix.
+    :param deadline: (Optional). Deadline (time.monotonic() value) of the request
+    :raises InputValidationError: if the matrix does not match the input schema
+    :return: result matrix and result column names
+    """
+    matrix, columns = prepare_matrix(matrix, columns)
+
+    return predict_on_prepared_matrix(matrix, columns, deadline)
+
+
+@app.route('/api/model/cache', methods=['GET'])
+def cache_stats():
+    if not PREDICTION_CACHE:
+        return jsonify({'enabled': False})
+
+    return jsonify({'enabled': True, **PREDICTION_CACHE.stats()})
+
+
+def is_empty_matrix(matrix: Any) -> bool:
+    """
+    Check if matrix is not provided or does not contain rows
+
+    :param matrix: list of rows or numpy array
+    :return: is matrix empty
+    """
+    if numpy and isinstance(matrix, numpy.ndarray):
+        return matrix.size == 0
+
+    return not matrix
+
+
+def build_deadline_response() -> Response:
+    return Response(response=json.dumps({'message': str(DeadlineExceeded())}), status=504, mimetype=JSON_MIMETYPE)
+
+
+def handle_prediction_on_matrix(parsed_data, deadline: Optional[float] = None):
+    matrix = parsed_data.get('data')
+    columns = parsed_data.get('columns', None)
+
+    if is_empty_matrix(matrix):
+        return build_error_response('Matrix is not provided')
+
+    try:
+        prediction, columns = predict_on_matrix(matrix, columns, deadline)
+    except DeadlineExceeded:
+        return build_deadline_response()
+    except InputValidationError as validation_error:
+        return build_error_response(f'Invalid input: {validation_error}')
+    except Exception as predict_exception:
+        return build_error_response(f'Exception during prediction: {predict_exception}')
+
+    return {
+        'prediction': prediction,
+        'columns': columns
+    }
+
+
+@functools.lru_cache()
+def get_object_input_type() -> type:
+    """
+    Get input type of predict_on_objects (dict of columns is used if the model does not declare it)
+
+    :return: input type
+    """
+    get_input_type = getattr(legion_model.entrypoint, 'get_object_input_type', None)
+
+    return get_input_type() if get_input_type else dict
+
+
+def records_to_columns(records: List[Dict[str, Any]], columns: Tuple[str, ...],
+                       as_arrays: bool = True) -> Dict[str, Any]:
+    """
+    Convert records to columns in one pass: fields are extracted by itemgetter and transposed by zip
+    (both run in C), missing fields are converted to None
+
+    :param records: list of JSON objects
+    :param columns: order of fields
+    :param as_arrays: convert columns to numpy arrays (if numpy is available)
+    :return: dict of column name to numpy array (or list)
+    """
+    getter = operator.itemgetter(*columns)
+    try:
+        try:
+            rows = list(map(getter, records))
+        except KeyError:
+            rows = [tuple(record.get(column) for column in columns) for record in records]
+            if len(columns) == 1:
+                rows = [row[0] for row in rows]
+    except (TypeError, AttributeError):
+        raise ValueError('Objects have to be JSON objects')
+
+    values = [rows] if len(columns) == 1 else list(zip(*rows))
+    convert = numpy.asarray if numpy and as_arrays else list
+
+    return {column: convert(column_values) for column, column_values in zip(columns, values)}
+
+
+def handle_prediction_on_objects(parsed_data, deadline: Optional[float] = None):
+    records = parsed_data.get('data') if isinstance(parsed_data, dict) else parsed_data
+
+    # Type is checked first: truth value of numpy arrays (parsed binary formats) is ambiguous
+    if not isinstance(records, list) or not records:
+        return build_error_response('Objects are not provided')
+    if not isinstance(records[0], dict):
+        return build_error_response('Objects have to be JSON objects')
+    if not hasattr(legion_model.entrypoint, 'predict_on_objects'):
+        return build_error_response('Model does not implement predict_on_objects')
+
+    # Objects are always converted to columns in declared order, the input type is only a hint:
+    # list keeps plain lists of values, other types (pandas.DataFrame, ...) are built from dict of columns
+    input_type = get_object_input_type()
+    try:
+        columns = records_to_columns(records, get_input_columns() or tuple(records[0]), input_type is not list)
+        objects = columns if input_type in (dict, list) else input_type(columns)
+    except ValueError as value_error:
+        return build_error_response(str(value_error))
+
+    try:
+        check_deadline(deadline)
+        prediction = legion_model.entrypoint.predict_on_objects(objects)
+    except DeadlineExceeded:
+        return build_deadline_response()
+    except Exception as predict_exception:
+        return build_error_response(f'Exception during prediction: {predict_exception}')
+
+    if hasattr(prediction, 'to_dict'):
+        # pandas.DataFrame
+        prediction = prediction.to_dict(orient='records')
+
+    return {
+        'prediction': prediction
+    }
+
+
+def _predict_batch_item(matrix: Any, columns: Optional[List[str]], deadline: Optional[float]) -> Dict[str, Any]:
+    try:
+        prediction, prediction_columns = predict_on_prepared_matrix(matrix, columns, deadline)
+    except DeadlineExceeded as deadline_exceeded:
+        return {'error': str(deadline_exceeded)}
+    except Exception as predict_exception:
+        return {'error': f'Exception during prediction: {predict_exception}'}
+
+    return {'prediction': prediction, 'columns': prediction_columns}
+
+
+def _predict_batch_group(group: List[Tuple[int, Any]], columns: Optional[List[str]],
+                         deadline: Optional[float]) -> List[Tuple[int, Dict[str, Any]]]:
+    """
+    Make one prediction for matrices with the same columns and split results back.
+    Matrices are predicted one by one if the prediction fails (to isolate the failing one)
+    or the model does not return one row per input row
+
+    :param group: indexes of items and their prepared matrices
+    :param columns: column names of matrices
+    :param deadline: (Optional). Deadline (time.monotonic() value) of the request
+    :return: indexes of items and their results
+    """
+    if len(group) > 1:
+        try:
+            matrix = concatenate_matrices([item_matrix for _, item_matrix in group])
+            prediction, prediction_columns = predict_on_prepared_matrix(matrix, columns, deadline)
+        except DeadlineExceeded as deadline_exceeded:
+            return [(index, {'error': str(deadline_exceeded)}) for index, _ in group]
+        except Exception as predict_exception:
+            LOGGER.debug('Batch of %d matrices is predicted one by one: %s', len(group), predict_exception)
+        else:
+            if len(prediction) == len(matrix):
+                results = []
+                offset = 0
+                for index, item_matrix in group:
+                    results.append((index, {'prediction': prediction[offset:offset + len(item_matrix)],
+                                            'columns': prediction_columns}))
+                    offset += len(item_matrix)
+                return results
+
+    return [(index, _predict_batch_item(item_matrix, columns, deadline)) for index, item_matrix in group]
+
+
+def predict_batch_on_matrix(items: List[Any], deadline: Optional[float] = None) -> List[Dict[str, Any]]:
+    """
+    Make predictions for independent invoke payloads, matrices with the same columns are predicted at once
+
+    :param items: parsed invoke payloads (dicts with `data` and `columns`)
+    :param deadline: (Optional). Deadline (time.monotonic() value) of the request
+    :return: result (`prediction` and `columns`) or error (`error`) of every item
+    """
+    results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+    groups: Dict[Optional[Tuple[str, ...]], List[Tuple[int, Any]]] = {}
+
+    for index, item in enumerate(items):
+        matrix = item.get('data') if isinstance(item, dict) else None
+        if is_empty_matrix(matrix):
+            results[index] = {'error': 'Matrix is not provided'}
+            continue
+
+        try:
+            matrix, columns = prepare_matrix(matrix, item.get('columns'))
+        except InputValidationError as validation_error:
+            results[index] = {'error': f'Invalid input: {validation_error}'}
+            continue
+
+        groups.setdefault(tuple(columns) if columns is not None else None, []).append((index, matrix))
+
+    for key, group in groups.items():
+        for index, result in _predict_batch_group(group, list(key) if key is not None else None, deadline):
+            results[index] = result
+
+    return results
+
+
+def predict_batch_on_objects(items: List[Any], deadline: Optional[float] = None) -> List[Dict[str, Any]]:
+    """
+    Make predictions for independent invoke payloads of objects one by one
+
+    :param items: parsed invoke payloads
+    :param deadline: (Optional). Deadline (time.monotonic() value) of the request
+    :return: result (`prediction`) or error (`error`) of every item
+    """
+    results = []
+    for item in items:
+        result = handle_prediction_on_objects(item, deadline)
+        if isinstance(result, Response):
+            result = {'error': json.loads(result.get_data())['message']}
+        results.append(result)
+
+    return results
+
+
+def parse_columns_header(headers) -> Optional[List[str]]:
+    """
+    Parse JSON list of column names from headers
+
+    :param headers: request headers
+    :return: column names or None
+    """
+    columns = headers.get(DATA_COLUMNS)
+    if not columns:
+        return None
+
+    try:
+        return json.loads(columns)
+    except ValueError as value_error:
+        raise ValueError(f'Can not parse {DATA_COLUMNS} header as JSON: {value_error}')
+
+
+def get_supported_encodings() -> List[str]:
+    """
+    Get content encodings, supported in current environment (zstd is preferred)
+
+    :return: list of content encodings
+    """
+    if zstandard:
+        return [ZSTD_ENCODING, GZIP_ENCODING]
+
+    return [GZIP_ENCODING]
+
+
+# Decompressed data is limited, so a small compressed body can not expand to gigabytes (decompression bomb)
+MAX_DECOMPRESSED_SIZE = int(os.getenv(LEGION_MAX_DECOMPRESSED_MB, '100')) * 1024 * 1024
+DECOMPRESSION_CHUNK_SIZE = 1024 * 1024
+
+
+class PayloadTooLarge(ValueError):
+    """
+    Decompressed request data exceeds MAX_DECOMPRESSED_SIZE
+    """
+
+    def __init__(self):
+        super().__init__(f'Decompressed request data exceeds {MAX_DECOMPRESSED_SIZE} bytes')
+
+
+def open_decompressed_stream(stream, content_encoding: Optional[str]):
+    """
+    Build reader of decompressed data according to Content-Encoding header
+
+    :param stream: file-like object with compressed data
+    :param content_encoding: value of Content-Encoding header
+    :return: buffered reader and exceptions of decompression or None if data is not compressed
+    """
+    encoding = (content_encoding or '').strip().lower()
+    if encoding in ('', 'identity'):
+        return None
+
+    if encoding not in get_supported_encodings():
+        raise ValueError(f'Unsupported Content-Encoding: {content_encoding}')
+
+    if encoding == GZIP_ENCODING:
+        return gzip.GzipFile(fileobj=stream, mode='rb'), (OSError, EOFError, zlib.error)
+
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(stream)), zstandard.ZstdError
+
+
+def decode_request_body(data: bytes, content_encoding: Optional[str]) -> bytes:
+    """
+    Decompress POST data according to Content-Encoding header (incrementally, up to MAX_DECOMPRESSED_SIZE)
+
+    :param data: POST data
+    :param content_encoding: value of Content-Encoding header
+    :raises PayloadTooLarge: if decompressed data exceeds MAX_DECOMPRESSED_SIZE
+    :return: decompressed data
+    """
+    decompressed = open_decompressed_stream(io.BytesIO(data), content_encoding)
+    if decompressed is None:
+        return data
+
+    reader, errors = decompressed
+    chunks, size = [], 0
+    try:
+        while True:
+            chunk = reader.read(min(DECOMPRESSION_CHUNK_SIZE, MAX_DECOMPRESSED_SIZE + 1 - size))
+            if not chunk:
+                return b''.join(chunks)
+            size += len(chunk)
+            if size > MAX_DECOMPRESSED_SIZE:
+                raise PayloadTooLarge()
+            chunks.append(chunk)
+    except errors as decode_error:
+        raise ValueError(f'Can not decompress {content_encoding} data: {decode_error}')
+
+
+def decode_request_stream(stream, content_encoding: Optional[str]):
+    """
+    Decompress POST data stream according to Content-Encoding header
+
+    :param stream: file-like object with POST data
+    :param content_encoding: value of Content-Encoding header
+    :return: iterable of decompressed lines (lines longer than MAX_DECOMPRESSED_SIZE raise PayloadTooLarge)
+    """
+    decompressed = open_decompressed_stream(stream, content_encoding)
+    if decompressed is None:
+        return stream
+
+    reader, errors = decompressed
+
+    def read_lines():
+        try:
+            while True:
+                line = reader.readline(MAX_DECOMPRESSED_SIZE + 1)
+                if not line:
+                    return
+                if len(line) > MAX_DECOMPRESSED_SIZE:
+                    raise PayloadTooLarge()
+                yield line
+        except errors as decode_error:
+            raise ValueError(f'Can not decompress {content_encoding} data: {decode_error}')
+
+    return read_lines()
+
+
+COMPRESSION_MIN_SIZE = int(os.getenv(LEGION_COMPRESSION_MIN_SIZE, '1024'))
+
+
+def compress_response(resp: Response, accept_encoding: Optional[str]) -> Response:
+    """
+    Compress response body with the best encoding accepted by client if body is not smaller than
+    COMPRESSION_MIN_SIZE (0 disables compression)
+
+    :param resp: response
+    :param accept_encoding: value of Accept-Encoding header
+    :return: the same response
+    """
+    if COMPRESSION_MIN_SIZE <= 0:
+        return resp
+
+    resp.vary.add('Accept-Encoding')
+
+    encoding = parse_accept_header(accept_encoding).best_match(get_supported_encodings())
+    if not encoding or (resp.content_length or 0) < COMPRESSION_MIN_SIZE:
+        return resp
+
+    if encoding == GZIP_ENCODING:
+        resp.set_data(gzip.compress(resp.get_data(), compresslevel=GZIP_COMPRESSION_LEVEL))
+    else:
+        resp.set_data(zstandard.ZstdCompressor().compress(resp.get_data()))
+    resp.headers['Content-Encoding'] = encoding
+
+    return resp
+
+
+def parse_request_data(data: bytes, mimetype: str, headers) -> Dict[str, Any]:
+    """
+    Parse POST data according to its content type
+
+    :param data: POST data
+    :param mimetype: content type of POST data
+    :param headers: request headers
+    :return: parsed data with `data` and `columns` keys for matrix mode
+    """
+    if mimetype == NPY_MIMETYPE and numpy:
+        try:
+            matrix = numpy.load(io.BytesIO(data), allow_pickle=False)
+        except ValueError as value_error:
+            raise ValueError(f'Can not parse input as NPY: {value_error}')
+
+        return {'data': matrix, 'columns': parse_columns_header(headers)}
+
+    if mimetype == ARROW_MIMETYPE and numpy and pyarrow:
+        try:
+            table = pyarrow.ipc.open_stream(data).read_all()
+        except pyarrow.ArrowException as arrow_error:
+            raise ValueError(f'Can not parse input as Arrow IPC stream: {arrow_error}')
+
+        matrix = numpy.column_stack([column.to_numpy() for column in table.columns]) if table.num_columns else None
+        return {'data': matrix, 'columns': table.column_names}
+
+    try:
+        return JSON_CODEC.loads(data)
+    except ValueError as value_error:
+        raise ValueError(f'Can not parse input as JSON: {value_error}')
+
+
+def build_prediction_response(response_data: Dict[str, Any], mimetype: str) -> Response:
+    """
+    Serialize prediction to the requested format
+
+    :param response_data: dict with `prediction` and `columns`
+    :param mimetype: requested content type
+    :return: response
+    """
+    if mimetype in (NPY_MIMETYPE, ARROW_MIMETYPE):
+        prediction = numpy.asarray(response_data['prediction'])
+        if prediction.ndim == 1:
+            prediction = prediction.reshape(-1, 1)
+        columns = [str(column) for column in response_data['columns']]
+        buffer = io.BytesIO()
+
+        if mimetype == NPY_MIMETYPE:
+            numpy.save(buffer, prediction, allow_pickle=False)
+            resp = Response(response=buffer.getvalue(), status=200, mimetype=NPY_MIMETYPE)
+            resp.headers[DATA_COLUMNS] = json.dumps(columns)
+            return resp
+
+        batch = pyarrow.RecordBatch.from_arrays([pyarrow.array(prediction[:, index])
+                                                 for index in range(prediction.shape[1])], names=columns)
+        with pyarrow.ipc.new_stream(buffer, batch.schema) as writer:
+            writer.write_batch(batch)
+        return Response(response=buffer.getvalue(), status=200, mimetype=ARROW_MIMETYPE)
+
+    response_json = JSON_CODEC.dumps(response_data, get_json_output_serializer())
+    return Response(response=response_json, status=200, mimetype=JSON_MIMETYPE)
+
+
+# Metrics of all gunicorn workers are merged at scrape through snapshots in the shared directory
+METRICS = metrics.Registry({
+    'model_name': os.getenv(LEGION_MODEL_NAME, ''),
+    'model_version': os.getenv(LEGION_MODEL_VERSION, '')
+}, os.getenv(LEGION_METRICS_DIR) or None)
+PHASE_LATENCY = METRICS.register(metrics.Histogram(
+    'legion_model_request_phase_seconds', 'Duration of invoke request phases', ('phase',)
+))
+REQUEST_LATENCY = METRICS.register(metrics.Histogram(
+    'legion_model_request_seconds', 'Duration of invoke requests'
+))
+REQUESTS_IN_FLIGHT = METRICS.register(metrics.Gauge(
+    'legion_model_requests_in_flight', 'Count of invoke requests being processed'
+))
+REQUEST_SIZE = METRICS.register(metrics.Histogram(
+    'legion_model_request_size_bytes', 'Size of invoke request bodies', buckets=metrics.SIZE_BUCKETS
+))
+RESPONSE_SIZE = METRICS.register(metrics.Histogram(
+    'legion_model_response_size_bytes', 'Size of invoke response bodies', buckets=metrics.SIZE_BUCKETS
+))
+REQUEST_ERRORS = METRICS.register(metrics.Counter(
+    'legion_model_request_errors_total', 'Count of failed invoke requests by phase', ('phase',)
+))
+REQUESTS_EXPIRED = METRICS.register(metrics.Counter(
+    'legion_model_requests_expired_total', 'Count of invoke requests dropped because their deadline has passed'
+))
+if PREDICTION_CACHE:
+    for cache_counter in ('hits', 'misses', 'evictions'):
+        METRICS.register(metrics.CallbackMetric(
+            f'legion_model_prediction_cache_{cache_counter}_total', f'Count of prediction cache {cache_counter}',
+            'counter', lambda counter=cache_counter: PREDICTION_CACHE.stats()[counter]
+        ))
+
+
+@contextlib.contextmanager
+def track_request():
+    """
+    Track in-flight invoke requests and their duration
+    """
+    METRICS.ensure_flusher()
+    REQUESTS_IN_FLIGHT.inc()
+    try:
+        with REQUEST_LATENCY.time():
+            yield
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+
+
+class AdmissionRejected(Exception):
+    """
+    Prediction request is rejected by admission control
+    """
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f'Model server is overloaded ({reason}), retry after {retry_after} seconds')
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Limits count of admitted (in-flight and queued) predictions of the process
+    and estimated wait time of newly admitted ones
+    """
+
+    def __init__(self, max_queue_depth: int, max_wait: float, concurrency: int, smoothing: float = 0.2):
+        """
+        Build admission controller
+
+        :param max_queue_depth: max count of admitted predictions (0 disables the limit)
+        :param max_wait: max estimated wait time in seconds (0 disables the limit)
+        :param concurrency: count of predictions processed concurrently (threads)
+        :param smoothing: weight of the last request in exponential moving average of request duration
+        """
+        self.max_queue_depth = max_queue_depth
+        self.max_wait = max_wait
+        self.concurrency = max(1, concurrency)
+        self.smoothing = smoothing
+        self.admitted = 0
+        self.latency: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def estimated_wait(self) -> float:
+        """
+        Estimate wait time of a new request: admitted requests are processed by `concurrency` threads
+        with the average request duration
+
+        :return: wait time in seconds
+        """
+        return self.admitted / self.concurrency * (self.latency or 0.0)
+
+    def _retry_after(self) -> int:
+        return max(1, math.ceil(self.estimated_wait()))
+
+    @contextlib.contextmanager
+    def admit(self):
+        """
+        Admit prediction for the duration of the block
+
+        :raises AdmissionRejected: if the queue depth or the estimated wait time is exceeded
+        """
+        with self._lock:
+            if self.max_queue_depth and self.admitted >= self.max_queue_depth:
+                raise AdmissionRejected('queue_depth', self._retry_after())
+            if self.max_wait and self.estimated_wait() > self.max_wait:
+                raise AdmissionRejected('estimated_wait', self._retry_after())
+            self.admitted += 1
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self._lock:
+                self.admitted -= 1
+                if self.latency is None:
+                    self.latency = duration
+                else:
+                    self.latency += self.smoothing * (duration - self.latency)
+
+
+ADMISSION = AdmissionController(
+    max_queue_depth=int(os.getenv(LEGION_MAX_QUEUE_DEPTH, '0')),
+    max_wait=int(os.getenv(LEGION_MAX_ESTIMATED_WAIT_MS, '0')) / 1000,
+    concurrency=int(os.getenv(LEGION_PREDICT_THREADS, '4'))
+)
+REQUESTS_SHED = METRICS.register(metrics.Counter(
+    'legion_model_requests_shed_total', 'Count of invoke requests rejected by admission control', ('reason',)
+))
+METRICS.register(metrics.CallbackMetric(
+    'legion_model_estimated_wait_seconds', 'Estimated wait time of a new invoke request', 'gauge',
+    ADMISSION.estimated_wait, aggregate='max'
+))
+
+
+def build_overload_response(rejection: AdmissionRejected) -> Response:
+    """
+    Count rejected request and build 503 response with Retry-After header
+
+    :param rejection: admission rejection
+    :return: response
+    """
+    REQUESTS_SHED.inc(reason=rejection.reason)
+    resp = Response(response=json.dumps({'message': str(rejection)}), status=503, mimetype=JSON_MIMETYPE)
+    resp.headers['Retry-After'] = str(rejection.retry_after)
+
+    return resp
+
+
+def build_phase_error_response(phase: str, message: str, status: int = 500) -> Response:
+    """
+    Count failed request and build error response
+
+    :param phase: phase of request processing
+    :param message: error message
+    :param status: HTTP status of response
+    :return: response
+    """
+    REQUEST_ERRORS.inc(phase=phase)
+    return build_error_response(message, status)
+
+
+def build_prediction_log():
+    """
+    Build asynchronous prediction log if it is enabled using env. variables
+
+    :return: prediction log or None
+    """
+    location = os.getenv(LEGION_PREDICTION_LOG)
+    if not location:
+        return None
+
+    import legion_handler_log
+    try:
+        sink = legion_handler_log.build_sink(location)
+    except ValueError as sink_error:
+        LOGGER.warning('Prediction log is disabled: %s', sink_error)
+        return None
+
+    prediction_log = legion_handler_log.PredictionLog(
+        sink, lambda record: JSON_CODEC.dumps(record, get_json_output_serializer()),
+        int(os.getenv(LEGION_PREDICTION_LOG_QUEUE_MB, '64')) * 1024 * 1024
+    )
+    atexit.register(prediction_log.close)
+
+    return prediction_log
+
+
+
+PREDICTION_LOG = build_prediction_log()
+if PREDICTION_LOG:
+    METRICS.register(metrics.CallbackMetric(
+        'legion_model_prediction_log_written_total', 'Count of records written to the prediction log', 'counter',
+        lambda: PREDICTION_LOG.stats()['written']
+    ))
+    METRICS.register(metrics.CallbackMetric(
+        'legion_model_prediction_log_dropped_total', 'Count of dropped prediction log records', 'counter',
+        lambda: sum(PREDICTION_LOG.stats()['dropped'].values())
+    ))
+
+
+def process_prediction_request(data: bytes, mimetype: str, headers, response_mimetype: str,
+                               deadline: Optional[float] = None) -> Response:
+    """
+    Parse POST data, make prediction and serialize it (does not depend on Flask request context)
+
+    :param data: POST data
+    :param mimetype: content type of POST data
+    :param headers: request headers
+    :param response_mimetype: requested content type of response
+    :param deadline: (Optional). Deadline (time.monotonic() value), prediction is skipped if it has passed
+    :return: response
+    """
+    if not data:
+        return build_phase_error_response('read', 'Please provide data with this POST request')
+
+    start = time.perf_counter()
+    REQUEST_SIZE.observe(len(data))
+
+    if SUPPORTED_PREDICTION_MODE == 'objects' and mimetype in (NPY_MIMETYPE, ARROW_MIMETYPE):
+        return build_phase_error_response('parse', f'{mimetype} is a matrix format, '
+                                                   f'model in objects mode accepts only JSON objects', 415)
+
+    with PHASE_LATENCY.time(phase='parse'):
+        try:
+            data = decode_request_body(data, headers.get('Content-Encoding'))
+            parsed_data = parse_request_data(data, mimetype, headers)
+        except PayloadTooLarge as payload_too_large:
+            return build_phase_error_response('parse', str(payload_too_large), 413)
+        except ValueError as value_error:
+            return build_phase_error_response('parse', str(value_error))
+
+    with PHASE_LATENCY.time(phase='predict'):
+        if SUPPORTED_PREDICTION_MODE == 'matrix':
+            response_data = handle_prediction_on_matrix(parsed_data, deadline)
+        elif SUPPORTED_PREDICTION_MODE == 'objects':
+            response_data = handle_prediction_on_objects(parsed_data, deadline)
+            # Objects are not a matrix, so they are always serialized as JSON
+            response_mimetype = JSON_MIMETYPE
+        else:
+            return build_phase_error_response('predict',
+                                              f'Unknown model\'s return type: {SUPPORTED_PREDICTION_MODE}')
+
+    if isinstance(response_data, Response):
+        if response_data.status_code == 504:
+            REQUESTS_EXPIRED.inc()
+        else:
+            REQUEST_ERRORS.inc(phase='predict')
+        return response_data
+
+    with PHASE_LATENCY.time(phase='serialize'):
+        try:
+            resp = build_prediction_response(response_data, response_mimetype)
+        except (TypeError, ValueError) as serialization_error:
+            return build_phase_error_response(
+                'serialize', f'Can not serialize prediction as {response_mimetype}: {serialization_error}'
+            )
+        compress_response(resp, headers.get('Accept-Encoding'))
+
+    if PREDICTION_LOG:
+        PREDICTION_LOG.record(get_request_id(headers), parsed_data, response_data, time.perf_counter() - start)
+
+    RESPONSE_SIZE.observe(resp.content_length or 0)
+    return resp
+
+
+@app.route('/api/model/invoke', methods=['POST'])
+def predict():
+    with track_request():
+        try:
+            with ADMISSION.admit():
+                deadline = parse_deadline(request.headers)
+
+                with PHASE_LATENCY.time(phase='read'):
+                    data = request.get_data()
+
+                response_mimetype = request.accept_mimetypes.best_match(get_supported_mimetypes(),
+                                                                        default=JSON_MIMETYPE)
+                resp = process_prediction_request(data, request.mimetype, request.headers, response_mimetype,
+                                                  deadline)
+        except AdmissionRejected as rejection:
+            resp = build_overload_response(rejection)
+
+    return add_model_headers(resp)
+
+
+def process_batch_request(data: bytes, headers, deadline: Optional[float] = None) -> Response:
+    """
+    Parse JSON list of invoke payloads, make predictions and serialize their results to JSON list
+
+    :param data: POST data
+    :param headers: request headers
+    :param deadline: (Optional). Deadline (time.monotonic() value), predictions are skipped if it has passed
+    :return: response
+    """
+    if not data:
+        return build_phase_error_response('read', 'Please provide data with this POST request')
+
+    start = time.perf_counter()
+    REQUEST_SIZE.observe(len(data))
+
+    with PHASE_LATENCY.time(phase='parse'):
+        try:
+            items = JSON_CODEC.loads(decode_request_body(data, headers.get('Content-Encoding')))
+        except PayloadTooLarge as payload_too_large:
+            return build_phase_error_response('parse', str(payload_too_large), 413)
+        except ValueError as value_error:
+            return build_phase_error_response('parse', f'Can not parse input as JSON: {value_error}')
+        if not isinstance(items, list) or not items:
+            return build_phase_error_response('parse', 'List of invoke payloads is expected')
+
+    with PHASE_LATENCY.time(phase='predict'):
+        if SUPPORTED_PREDICTION_MODE == 'matrix':
+            results = predict_batch_on_matrix(items, deadline)
+        elif SUPPORTED_PREDICTION_MODE == 'objects':
+            results = predict_batch_on_objects(items, deadline)
+        else:
+            return build_phase_error_response('predict',
+                                              f'Unknown model\'s return type: {SUPPORTED_PREDICTION_MODE}')
+
+    with PHASE_LATENCY.time(phase='serialize'):
+        try:
+            resp = Response(response=JSON_CODEC.dumps(results, get_json_output_serializer()), status=200,
+                            mimetype=JSON_MIMETYPE)
+        except (TypeError, ValueError) as serialization_error:
+            return build_phase_error_response('serialize',
+                                              f'Can not serialize predictions as JSON: {serialization_error}')
+        compress_response(resp, headers.get('Accept-Encoding'))
+
+    if PREDICTION_LOG:
+        PREDICTION_LOG.record(get_request_id(headers), items, results, time.perf_counter() - start)
+
+    RESPONSE_SIZE.observe(resp.content_length or 0)
+    return resp
+
+
+@app.route('/api/model/batch', methods=['POST'])
+def predict_batch():
+    with track_request():
+        try:
+            with ADMISSION.admit():
+                deadline = parse_deadline(request.headers)
+
+                with PHASE_LATENCY.time(phase='read'):
+                    data = request.get_data()
+
+                resp = process_batch_request(data, request.headers, deadline)
+        except AdmissionRejected as rejection:
+            resp = build_overload_response(rejection)
+
+    return add_model_headers(resp)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(response=METRICS.render(), status=200, content_type=metrics.PROMETHEUS_MIMETYPE)
+
+
+# Max duration (seconds) and min sampling interval (milliseconds) of one profile
+PROFILE_MAX_SECONDS = 60
+PROFILE_MIN_INTERVAL_MS = 1
+PROFILER_TOKEN_SHA256 = os.getenv(LEGION_PROFILER_TOKEN_SHA256, '').lower()
+# Only one profile is collected at a time per process
+PROFILER_LOCK = threading.Lock()
+
+
+def is_profiler_token_valid(token: Optional[str]) -> bool:
+    """
+    Check profiler token against SHA-256 digest of the configured one (plain token is not stored in the image)
+
+    :param token: token provided by client
+    :return: is token valid
+    """
+    digest = hashlib.sha256((token or '').encode('utf-8')).hexdigest()
+    return bool(token) and hmac.compare_digest(digest, PROFILER_TOKEN_SHA256)
+
+
+@app.route('/api/model/profile', methods=['GET'])
+def profile():
+    """
+    Sample stacks of all threads of the worker for `seconds` (default 10) every `interval_ms` (default 10)
+    and return them in collapsed format (input of flamegraph.pl, inferno or speedscope)
+    """
+    if not PROFILER_TOKEN_SHA256:
+        return build_error_response('Profiler is disabled', 404)
+    if not is_profiler_token_valid(request.headers.get(PROFILER_TOKEN)):
+        return build_error_response(f'Valid {PROFILER_TOKEN} header is required', 401)
+
+    seconds = request.args.get('seconds', 10, type=float)
+    interval_ms = request.args.get('interval_ms', 10, type=float)
+    if not 0 < seconds <= PROFILE_MAX_SECONDS or interval_ms < PROFILE_MIN_INTERVAL_MS:
+        return build_error_response(f'seconds has to be in (0, {PROFILE_MAX_SECONDS}] and interval_ms '
+                                    f'has to be at least {PROFILE_MIN_INTERVAL_MS}', 400)
+
+    if not PROFILER_LOCK.acquire(blocking=False):
+        return build_error_response('Profile is already being collected', 409)
+
+    import legion_handler_profiler
+    try:
+        stacks, rounds = legion_handler_profiler.sample_stacks(seconds, interval_ms / 1000)
+    finally:
+        PROFILER_LOCK.release()
+
+    resp = Response(response=legion_handler_profiler.render_collapsed(stacks), status=200, mimetype='text/plain')
+    resp.headers['Content-Disposition'] = f'attachment; filename=profile-{os.getpid()}.collapsed'
+    resp.headers['Profile-Samples'] = str(rounds)
+
+    return resp
+
+
+def get_request_id(request_headers) -> Optional[str]:
+    return request_headers.get(MODEL_REQUEST_ID) or request_headers.get(REQUEST_ID)
+
+
+def build_model_headers(request_headers) -> Dict[str, str]:
+    """
+    Build model name, version and request ID headers
+
+    :param request_headers: request headers
+    :return: response headers
+    """
+    headers = {
+        MODEL_NAME: os.getenv(LEGION_MODEL_NAME),
+        MODEL_VERSION: os.getenv(LEGION_MODEL_VERSION)
+    }
+
+    request_id = get_request_id(request_headers)
+    if request_id:
+        headers[MODEL_REQUEST_ID] = request_id
+
+    return headers
+
+
+def add_model_headers(resp: Response) -> Response:
+    """
+    Add model name, version and request ID headers to the response
+
+    :param resp: response
+    :return: the same response
+    """
+    for name, value in build_model_headers(request.headers).items():
+        resp.headers[name] = value
+
+    return resp
+
+
+def read_ndjson_chunks(stream, chunk_size: int):
+    """
+    Read newline-delimited JSON rows from the stream by chunks
+
+    :param stream: file-like object with lines
+    :param chunk_size: max count of rows in chunk
+    :return: generator of row lists
+    """
+    chunk = []
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            chunk.append(JSON_CODEC.loads(line))
+        except ValueError as value_error:
+            raise ValueError(f'Can not parse input line as JSON: {value_error}')
+
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+STREAM_CHUNK_SIZE = int(os.getenv(LEGION_STREAM_CHUNK_SIZE, '1000'))
+
+
+def process_stream_request(stream, headers, scope: contextlib.ExitStack, deadline: Optional[float] = None) -> Response:
+    """
+    Make prediction on NDJSON rows (one JSON list per line) chunk by chunk (does not depend on Flask request context)
+
+    :param stream: file-like object with POST data
+    :param headers: request headers
+    :param scope: request tracking and admission, it is closed when the last chunk is streamed back
+    :param deadline: (Optional). Deadline (time.monotonic() value), chunks are not predicted if it has passed
+    :return: response
+    """
+    if SUPPORTED_PREDICTION_MODE != 'matrix':
+        return build_phase_error_response('predict', 'Streaming is supported only for matrix prediction mode')
+
+    if headers.get('Content-Length', '').isdigit():
+        REQUEST_SIZE.observe(int(headers['Content-Length']))
+
+    with PHASE_LATENCY.time(phase='parse'):
+        try:
+            columns = parse_columns_header(headers)
+            lines = decode_request_stream(stream, headers.get('Content-Encoding'))
+            chunks = read_ndjson_chunks(lines, STREAM_CHUNK_SIZE)
+            first_chunk = next(chunks, None)
+        except PayloadTooLarge as payload_too_large:
+            return build_phase_error_response('parse', str(payload_too_large), 413)
+        except ValueError as value_error:
+            return build_phase_error_response('parse', str(value_error))
+
+    if first_chunk is None:
+        return build_phase_error_response('read', 'Please provide data with this POST request')
+
+    request_id = get_request_id(headers)
+
+    def predict_chunk(chunk):
+        # Every chunk is a separate record of the prediction log
+        start = time.perf_counter()
+        with PHASE_LATENCY.time(phase='predict'):
+            chunk_prediction, chunk_columns = predict_on_matrix(chunk, columns, deadline)
+        if PREDICTION_LOG:
+            PREDICTION_LOG.record(request_id, {'columns': columns, 'data': chunk},
+                                  {'prediction': chunk_prediction, 'columns': chunk_columns},
+                                  time.perf_counter() - start)
+        return chunk_prediction, chunk_columns
+
+    try:
+        prediction, output_columns = predict_chunk(first_chunk)
+    except DeadlineExceeded:
+        REQUESTS_EXPIRED.inc()
+        return build_deadline_response()
+    except InputValidationError as validation_error:
+        return build_phase_error_response('predict', f'Invalid input: {validation_error}')
+    except Exception as predict_exception:
+        return build_phase_error_response('predict', f'Exception during prediction: {predict_exception}')
+
+    serializer = get_json_output_serializer()
+
+    def build_message(message: str) -> bytes:
+        return JSON_CODEC.dumps({'message': message}) + b'\n'
+
+    def generate(prediction):
+        try:
+            while True:
+                yield b''.join(JSON_CODEC.dumps(row, serializer) + b'\n' for row in prediction)
+
+                try:
+                    chunk = next(chunks, None)
+                except ValueError as value_error:
+                    REQUEST_ERRORS.inc(phase='parse')
+                    yield build_message(str(value_error))
+                    return
+                if chunk is None:
+                    return
+
+                try:
+                    prediction = predict_chunk(chunk)[0]
+                except DeadlineExceeded as deadline_exceeded:
+                    REQUESTS_EXPIRED.inc()
+                    yield build_message(str(deadline_exceeded))
+                    return
+                except InputValidationError as validation_error:
+                    REQUEST_ERRORS.inc(phase='predict')
+                    yield build_message(f'Invalid input: {validation_error}')
+                    return
+                except Exception as predict_exception:
+                    REQUEST_ERRORS.inc(phase='predict')
+                    yield build_message(f'Exception during prediction: {predict_exception}')
+                    return
+        finally:
+            scope.close()
+
+    resp = Response(generate(prediction), status=200, mimetype=NDJSON_MIMETYPE)
+    # Model may not return column names
+    if output_columns is not None:
+        resp.headers[DATA_COLUMNS] = json.dumps([str(column) for column in output_columns])
+    # Generator may be never started (e.g. client has disconnected), scope is closed with the response then
+    resp.call_on_close(scope.close)
+
+    return resp
+
+
+@app.route('/api/model/stream', methods=['POST'])
+def predict_stream():
+    """
+    Make prediction on NDJSON rows (one JSON list per line) chunk by chunk.
+
+    Input column names are passed in the Data-Columns header. Prediction rows are streamed back as NDJSON,
+    output column names are returned in the Data-Columns header. An error after the first chunk
+    is reported as a {"message": ...} line, because the status code has been already sent.
+    The request is tracked and admitted until the last chunk is streamed back.
+    """
+    scope = contextlib.ExitStack()
+    scope.enter_context(track_request())
+    try:
+        scope.enter_context(ADMISSION.admit())
+        deadline = parse_deadline(request.headers)
+        resp = process_stream_request(request.stream, request.headers, scope, deadline)
+    except AdmissionRejected as rejection:
+        resp = build_overload_response(rejection)
+    except BaseException:
+        scope.close()
+        raise
+
+    if not resp.is_streamed:
+        scope.close()
+
+    return add_model_headers(resp)
+
+
+def freeze_preloaded_objects():
+    """
+    Move all objects created during model loading to the permanent GC generation.
+
+    With gunicorn --preload the handler is imported in the master process before workers are forked.
+    Frozen objects are never scanned by GC in workers, so GC does not write to memory pages
+    shared with the master and they are not copied.
+    """
+    if not hasattr(gc, 'freeze'):
+        LOGGER.warning('gc.freeze is not supported by this Python version, copy-on-write sharing is not preserved')
+        return
+
+    gc.collect()
+    gc.freeze()
+    LOGGER.info('%d objects of preloaded model have been frozen', gc.get_freeze_count())
+
+
+class Warmup:
+    """
+    Replays synthetic rows built from example values of the model info to warm up the model
+    (JIT compilation, lazy loading) before the model reports readiness
+    """
+
+    def __init__(self, iterations: int, predict_function=legion_model.entrypoint.predict_on_matrix):
+        """
+        Build warmup
+
+        :param iterations: count of predictions on example rows, 0 disables warmup
+        :param predict_function: function with predict_on_matrix interface
+        """
+        self.iterations = iterations
+        self.predict_function = predict_function
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+        self._finished = threading.Event()
+
+    @staticmethod
+    def build_example_matrix() -> Tuple[List[List[Any]], List[str]]:
+        """
+        Build one row of example values from the model info
+
+        :return: matrix and column names
+        """
+        input_schema, _ = legion_model.entrypoint.info()
+
+        return [[prop['example'] for prop in input_schema]], [prop['name'] for prop in input_schema]
+
+    def run(self):
+        """
+        Run warmup predictions. Errors are logged and do not block readiness
+        """
+        start = time.perf_counter()
+        try:
+            if self.iterations > 0:
+                matrix, columns = self.build_example_matrix()
+                for _ in range(self.iterations):
+                    self.predict_function(matrix, provided_columns_names=columns)
+        except Exception as warmup_exception:
+            self.error = str(warmup_exception)
+            LOGGER.warning('Warmup has failed: %s', warmup_exception)
+        finally:
+            self.duration = time.perf_counter() - start
+            self._finished.set()
+            LOGGER.info('Warmup (%d iterations) has finished in %.3f seconds', self.iterations, self.duration)
+
+    def start(self, background: bool = True):
+        """
+        Start warmup
+
+        :param background: run warmup in a daemon thread, otherwise block until it finishes
+        """
+        if background:
+            threading.Thread(target=self.run, name='legion-warmup', daemon=True).start()
+        else:
+            self.run()
+
+    def is_ready(self) -> bool:
+        return self._finished.is_set()
+
+    def status(self) -> Dict[str, Any]:
+        """
+        Get warmup status
+
+        :return: readiness, count of iterations, duration (seconds) and error of warmup
+        """
+        return {
+            'ready': self.is_ready(),
+            'iterations': self.iterations,
+            'duration': self.duration,
+            'error': self.error
+        }
+
+
+# Preloaded model is warmed up in gunicorn master, where inference processes are not started
+WARMUP = Warmup(int(os.getenv(LEGION_WARMUP_ITERATIONS, '0')),
+                legion_model.entrypoint.predict_on_matrix if os.getenv(LEGION_PRELOAD) == 'true' else PREDICT_FUNCTION)
+
+METRICS.register(metrics.CallbackMetric(
+    'legion_model_warmup_seconds', 'Duration of the model warmup', 'gauge', lambda: WARMUP.duration,
+    aggregate='max'
+))
+
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    resp = jsonify(WARMUP.status())
+    resp.status_code = 200 if WARMUP.is_ready() else 503
+
+    return resp
+
+
+# Preloaded model is warmed up in the master process before forking, so workers share the warm state
+WARMUP.start(background=os.getenv(LEGION_PRELOAD) != 'true')
+
+if os.getenv(LEGION_PRELOAD) == 'true':
+    freeze_preloaded_objects()
+
+
+def start_grpc_server():
+    """
+    Start gRPC server of the model in the current process if LEGION_GRPC_PORT is set
+
+    :return: started server or None if gRPC is disabled
+    """
+    port = int(os.getenv(LEGION_GRPC_PORT, '0'))
+    if port <= 0:
+        return None
+
+    import legion_handler_grpc
+    server = legion_handler_grpc.build_server(port, int(os.getenv(LEGION_PREDICT_THREADS, '4')))
+    server.start()
+    LOGGER.info('gRPC server has been started on port %d', port)
+
+    return server
+
+
+def _start_grpc_server_in_worker(master_pid: int = os.getpid()):
+    global GRPC_SERVER
+    # Processes forked by workers (e.g. by the model) do not serve gRPC
+    if os.getppid() == master_pid:
+        GRPC_SERVER = start_grpc_server()
+
+
+GRPC_SERVER = None
+if os.getenv(LEGION_PRELOAD) != 'true':
+    GRPC_SERVER = start_grpc_server()
+elif hasattr(os, 'register_at_fork'):
+    # gRPC server must not be started in gunicorn master, every forked worker starts its own one
+    os.register_at_fork(after_in_child=_start_grpc_server_in_worker)
+elif int(os.getenv(LEGION_GRPC_PORT, '0')) > 0:
+    LOGGER.warning('gRPC server can not be started with preload on this Python version')
+
+
+def shutdown():
+    """
+    Stop background threads, processes and servers of the handler
+    (micro batcher, prediction log, metrics flusher, inference processes, gRPC)
+    and drop its exit hooks and metric callbacks, so the handler and the model can be garbage collected.
+    Is used by the multi-model host when the model is unloaded
+    """
+    if MICRO_BATCHER:
+        MICRO_BATCHER.close()
+    if PREDICTION_LOG:
+        atexit.unregister(PREDICTION_LOG.close)
+        PREDICTION_LOG.close()
+    if GRPC_SERVER:
+        GRPC_SERVER.stop(0)
+    if INFERENCE_POOL:
+        INFERENCE_POOL.close()
+    METRICS.close()
@@ -0,0 +1,102 @@
+#
+#    Copyright 2019 EPAM Systems
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+"""
+ASGI (Starlette) application for Legion's HTTP handler
+
+Request and response I/O of /api/model/invoke and /api/model/batch is handled on the event loop,
+parsing, prediction and serialization run in a bounded thread pool.
+Other endpoints are served by the WSGI application.
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Response as FlaskResponse
+from starlette.applications import Starlette
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+import legion_handler
+
+PREDICT_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv(legion_handler.LEGION_PREDICT_THREADS, '4')),
+                                      thread_name_prefix='legion-predict')
+
+
+def to_asgi_response(resp: FlaskResponse) -> Response:
+    """
+    Convert Flask response to Starlette response
+
+    :param resp: Flask response
+    :return: Starlette response
+    """
+    return Response(content=resp.get_data(), status_code=resp.status_code, headers=dict(resp.headers))
+
+
+async def predict(request: Request) -> Response:
+    with legion_handler.track_request():
+        try:
+            # Requests waiting for a thread of the pool are counted as admitted (queued)
+            with legion_handler.ADMISSION.admit():
+                # Relative timeout counts from the request arrival, so the deadline is parsed before queueing
+                deadline = legion_handler.parse_deadline(request.headers)
+
+                with legion_handler.PHASE_LATENCY.time(phase='read'):
+                    data = await request.body()
+
+                mimetype = request.headers.get('content-type', '').split(';')[0].strip()
+                accept = parse_accept_header(request.headers.get('accept'), MIMEAccept)
+                response_mimetype = accept.best_match(legion_handler.get_supported_mimetypes(),
+                                                      default=legion_handler.JSON_MIMETYPE)
+
+                resp = await asyncio.get_event_loop().run_in_executor(
+                    PREDICT_EXECUTOR, legion_handler.process_prediction_request,
+                    data, mimetype, request.headers, response_mimetype, deadline
+                )
+        except legion_handler.AdmissionRejected as rejection:
+            resp = legion_handler.build_overload_response(rejection)
+
+    resp.headers.update(legion_handler.build_model_headers(request.headers))
+    return to_asgi_response(resp)
+
+
+async def predict_batch(request: Request) -> Response:
+    with legion_handler.track_request():
+        try:
+            with legion_handler.ADMISSION.admit():
+                deadline = legion_handler.parse_deadline(request.headers)
+
+                with legion_handler.PHASE_LATENCY.time(phase='read'):
+                    data = await request.body()
+
+                resp = await asyncio.get_event_loop().run_in_executor(
+                    PREDICT_EXECUTOR, legion_handler.process_batch_request, data, request.headers, deadline
+                )
+        except legion_handler.AdmissionRejected as rejection:
+            resp = legion_handler.build_overload_response(rejection)
+
+    resp.headers.update(legion_handler.build_model_headers(request.headers))
+    return to_asgi_response(resp)
+
+
+app = Starlette(routes=[
+    Route('/api/model/invoke', predict, methods=['POST']),
+    Route('/api/model/batch', predict_batch, methods=['POST']),
+    Mount('/', app=WSGIMiddleware(legion_handler.app)),
+])
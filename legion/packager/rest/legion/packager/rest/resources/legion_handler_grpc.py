@@ -0,0 +1,108 @@
+#
+#    Copyright 2019 EPAM Systems
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+"""
+gRPC server of the model (legion.model.ModelService from legion_model_service.proto)
+
+Messages are encoded by the message codec of legion-sdk gRPC client, predictions are made
+by the same predict_on_matrix path (cache, micro batcher, inference pool) as REST invoke.
+"""
+import time
+from concurrent import futures
+from typing import Iterator
+
+import grpc
+
+import legion_handler
+
+try:
+    from legion.sdk.clients.model_grpc import encode_matrix_message, decode_matrix_message
+except ImportError:
+    # legion-sdk is not installed to model environment, its gRPC module is copied next to the handler
+    from legion_model_grpc import encode_matrix_message, decode_matrix_message
+
+SERVICE_NAME = 'legion.model.ModelService'
+
+
+def _predict(data: bytes, context) -> bytes:
+    start = time.perf_counter()
+    try:
+        matrix, columns = decode_matrix_message(data)
+    except (ValueError, TypeError) as decode_error:
+        context.abort(grpc.StatusCode.INVALID_ARGUMENT, f'Can not decode request: {decode_error}')
+
+    if legion_handler.is_empty_matrix(matrix):
+        context.abort(grpc.StatusCode.INVALID_ARGUMENT, 'Matrix is not provided')
+
+    time_remaining = context.time_remaining()
+    deadline = time.monotonic() + time_remaining if time_remaining is not None else None
+
+    try:
+        prediction, output_columns = legion_handler.predict_on_matrix(matrix, columns, deadline)
+    except legion_handler.DeadlineExceeded as deadline_exception:
+        context.abort(grpc.StatusCode.DEADLINE_EXCEEDED, str(deadline_exception))
+    except legion_handler.InputValidationError as validation_error:
+        context.abort(grpc.StatusCode.INVALID_ARGUMENT, f'Invalid input: {validation_error}')
+    except Exception as predict_exception:
+        context.abort(grpc.StatusCode.INTERNAL, f'Exception during prediction: {predict_exception}')
+
+    try:
+        response = encode_matrix_message(prediction, output_columns)
+    except (ValueError, TypeError) as encode_error:
+        context.abort(grpc.StatusCode.INTERNAL, f'Can not encode prediction: {encode_error}')
+
+    if legion_handler.PREDICTION_LOG:
+        legion_handler.PREDICTION_LOG.record(legion_handler.get_request_id(dict(context.invocation_metadata())),
+                                             {'data': matrix, 'columns': columns},
+                                             {'prediction': prediction, 'columns': output_columns},
+                                             time.perf_counter() - start)
+
+    return response
+
+
+def predict(request: bytes, context) -> bytes:
+    with legion_handler.track_request():
+        try:
+            with legion_handler.ADMISSION.admit():
+                return _predict(request, context)
+        except legion_handler.AdmissionRejected as rejection:
+            legion_handler.REQUESTS_SHED.inc(reason=rejection.reason)
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, str(rejection))
+
+
+def predict_stream(requests: Iterator[bytes], context) -> Iterator[bytes]:
+    for request in requests:
+        yield predict(request, context)
+
+
+def build_server(port: int, threads: int) -> grpc.Server:
+    """
+    Build gRPC server of the model
+
+    :param port: port to bind (on all interfaces)
+    :param threads: count of threads serving RPCs
+    :return: server (not started)
+    """
+    handler = grpc.method_handlers_generic_handler(SERVICE_NAME, {
+        'Predict': grpc.unary_unary_rpc_method_handler(predict),
+        'PredictStream': grpc.stream_stream_rpc_method_handler(predict_stream)
+    })
+
+    # Port is shared by gunicorn workers (SO_REUSEPORT is enabled by default on Linux)
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix='legion-grpc'),
+                         handlers=(handler,))
+    server.add_insecure_port(f'[::]:{port}')
+
+    return server
@@ -0,0 +1,258 @@
+#
+#    Copyright 2019 EPAM Systems
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+"""
+Asynchronous prediction log of Legion's HTTP handler
+
+Records of served predictions are serialized and put to an in-memory queue bounded by size in bytes
+(never blocking the request) and written by a background thread as gzip-compressed NDJSON batches
+to a file or a socket.
+Every batch is a separate gzip member, so the file (or the socket stream) is a valid multi-member gzip stream.
+"""
+import gzip
+import logging
+import queue
+import socket
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+# Count of records compressed and written at once
+BATCH_SIZE = 500
+# Max interval (seconds) between receiving a record and writing it
+FLUSH_INTERVAL = 1.0
+SOCKET_TIMEOUT = 5.0
+
+FILE_SCHEME = 'file://'
+TCP_SCHEME = 'tcp://'
+UNIX_SCHEME = 'unix://'
+
+LOGGER = logging.getLogger(__name__)
+
+
+class FileSink:
+    """
+    Appends batches to a local file. Every batch is appended by a single write,
+    so several workers can share the file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def write(self, data: bytes):
+        # File is reopened for every batch to follow log rotation
+        with open(self.path, 'ab', buffering=0) as stream:
+            stream.write(data)
+
+    def close(self):
+        pass
+
+    def __repr__(self):
+        return f'{FILE_SCHEME}{self.path}'
+
+
+class SocketSink:
+    """
+    Sends batches to a TCP or Unix socket, connection is (re)established on demand
+    """
+
+    def __init__(self, family: int, address: Any):
+        self.family = family
+        self.address = address
+        self._socket: Optional[socket.socket] = None
+
+    def write(self, data: bytes):
+        if self._socket is None:
+            self._socket = socket.socket(self.family, socket.SOCK_STREAM)
+            self._socket.settimeout(SOCKET_TIMEOUT)
+            try:
+                self._socket.connect(self.address)
+            except OSError:
+                self.close()
+                raise
+
+        try:
+            self._socket.sendall(data)
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def __repr__(self):
+        if self.family == socket.AF_UNIX:
+            return f'{UNIX_SCHEME}{self.address}'
+        return f'{TCP_SCHEME}{self.address[0]}:{self.address[1]}'
+
+
+def build_sink(location: str):
+    """
+    Build sink by location
+
+    :param location: tcp://host:port, unix:///path/to/socket, file:///path/to/file or path to file
+    :return: sink
+    """
+    if location.startswith(TCP_SCHEME):
+        host, _, port = location[len(TCP_SCHEME):].rpartition(':')
+        if not host or not port.isdigit():
+            raise ValueError(f'Invalid TCP address of prediction log: {location}')
+        return SocketSink(socket.AF_INET, (host, int(port)))
+    if location.startswith(UNIX_SCHEME):
+        return SocketSink(socket.AF_UNIX, location[len(UNIX_SCHEME):])
+    if location.startswith(FILE_SCHEME):
+        return FileSink(location[len(FILE_SCHEME):])
+
+    return FileSink(location)
+
+
+class PredictionLog:
+    """
+    Queue of serialized prediction records bounded by size in bytes with a background writer thread.
+    The thread is started on the first record, so a log built before forking workers works in every worker
+    """
+
+    def __init__(self, sink, serialize: Callable[[Dict[str, Any]], bytes], max_queue_bytes: int,
+                 batch_size: int = BATCH_SIZE, flush_interval: float = FLUSH_INTERVAL):
+        """
+        Build prediction log
+
+        :param sink: object with write(bytes) and close() methods
+        :param serialize: function that serializes one record to JSON bytes
+        :param max_queue_bytes: max size of serialized records waiting for writing,
+                                new records are dropped if it is exceeded
+        :param batch_size: max count of records in one batch
+        :param flush_interval: max time (seconds) a record waits for its batch to be filled
+        """
+        self.sink = sink
+        self.serialize = serialize
+        self.max_queue_bytes = max_queue_bytes
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped: Dict[str, int] = {}
+        self._queue: 'queue.Queue[Optional[bytes]]' = queue.Queue()
+        self._queued_bytes = 0
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def record(self, request_id: Optional[str], inputs: Any, outputs: Any, latency: float):
+        """
+        Serialize record of served prediction and enqueue it, so the queue does not reference request data
+
+        :param request_id: request ID (is used to join predictions with feedback)
+        :param inputs: parsed request data
+        :param outputs: response data
+        :param latency: duration of request processing in seconds
+        """
+        if not self._start():
+            self._drop('closed')
+            return
+        try:
+            line = self.serialize({
+                'request_id': request_id,
+                'time': time.time(),
+                'latency': latency,
+                'input': inputs,
+                'output': outputs
+            }) + b'\n'
+        except (TypeError, ValueError, OverflowError) as serialization_error:
+            LOGGER.warning('Can not serialize prediction log record: %s', serialization_error)
+            self._drop('serialization')
+            return
+
+        with self._lock:
+            if self._queued_bytes + len(line) > self.max_queue_bytes:
+                self.dropped['queue_full'] = self.dropped.get('queue_full', 0) + 1
+                return
+            self._queued_bytes += len(line)
+        self._queue.put_nowait(line)
+
+    def close(self):
+        """
+        Write enqueued records and stop the writer thread
+        """
+        with self._lock:
+            self._closed = True
+            thread, self._thread = self._thread, None
+
+        if thread:
+            self._queue.put(None)
+            thread.join()
+        self.sink.close()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get log statistics
+
+        :return: count of written records, dropped records by reason, count and size (bytes) of records in the queue
+        """
+        return {'written': self.written, 'dropped': dict(self.dropped), 'queued': self._queue.qsize(),
+                'queued_bytes': self._queued_bytes}
+
+    def _start(self) -> bool:
+        if self._thread is not None:
+            return True
+
+        with self._lock:
+            if self._closed:
+                return False
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='legion-prediction-log', daemon=True)
+                self._thread.start()
+
+        return True
+
+    def _drop(self, reason: str, count: int = 1):
+        with self._lock:
+            self.dropped[reason] = self.dropped.get(reason, 0) + count
+
+    def _run(self):
+        """
+        Collect records to batches by size or flush interval and write them until None is received
+        """
+        while True:
+            line = self._queue.get()
+            if line is None:
+                return
+
+            batch = [line]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    line = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if line is None:
+                    self._write(batch)
+                    return
+                batch.append(line)
+
+            self._write(batch)
+
+    def _write(self, lines: List[bytes]):
+        try:
+            self.sink.write(gzip.compress(b''.join(lines)))
+        except OSError as write_error:
+            LOGGER.warning('Can not write %d prediction log records to %r: %s', len(lines), self.sink, write_error)
+            self._drop('sink', len(lines))
+        else:
+            self.written += len(lines)
+        finally:
+            with self._lock:
+                self._queued_bytes -= sum(len(line) for line in lines)
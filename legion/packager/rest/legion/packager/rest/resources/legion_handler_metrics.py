@@ -0,0 +1,459 @@
+#
+#    Copyright 2019 EPAM Systems
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+"""
+Minimal Prometheus metrics (text exposition format) for Legion's HTTP handler.
+
+Metrics are collected per process (gunicorn worker). If a multiprocess directory is configured,
+every process periodically writes a snapshot of its values to `<directory>/<pid>-<start time>-<registry>.json`
+and the process serving a scrape merges snapshots of all processes: counters and histograms are summed
+over all processes (including exited ones, so they never go backwards), gauges are aggregated over live
+processes only. Process start time is a part of the snapshot name, so a process with a reused PID
+does not overwrite snapshot of the exited one.
+"""
+import atexit
+import contextlib
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+PROMETHEUS_MIMETYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+
+# Interval (seconds) between writes of process snapshot in multiprocess mode
+FLUSH_INTERVAL = 1.0
+
+Sample = Tuple[str, Dict[str, str], float]
+Values = Dict[Tuple[str, ...], Any]
+
+LOGGER = logging.getLogger(__name__)
+
+# Serial numbers of registries of the process (several registries may write snapshots to the same directory)
+_REGISTRY_SERIALS = itertools.count()
+
+
+def _escape_label_value(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label_value(value)}"' for name, value in labels.items()) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def get_process_start_time(pid: int) -> int:
+    """
+    Get start time of the process in clock ticks since boot (Linux only)
+
+    :param pid: process ID
+    :return: start time or 0 if it can not be read
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as stat_file:
+            # Process name may contain spaces, fields after it are separated by spaces
+            return int(stat_file.read().rpartition(')')[2].split()[19])
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _is_snapshot_process_alive(pid: int, start_time: int) -> bool:
+    if not _is_process_alive(pid):
+        return False
+    # Process with the same PID has been started after the one that wrote the snapshot
+    return not start_time or get_process_start_time(pid) in (0, start_time)
+
+
+class Metric:
+    """
+    Base class of metric with labels
+    """
+
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = ()):
+        """
+        Build metric
+
+        :param name: metric name
+        :param documentation: metric description
+        :param label_names: names of labels
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _labels(self, key: Tuple[str, ...]) -> Dict[str, str]:
+        return dict(zip(self.label_names, key))
+
+    def snapshot(self) -> Values:
+        """
+        Get copy of values of the metric
+
+        :return: value by label values
+        """
+        with self._lock:
+            return dict(self._values)
+
+    def combine(self, left: Any, right: Any) -> Any:
+        """
+        Combine values of the same labels from different processes
+
+        :param left: value
+        :param right: value
+        :return: combined value
+        """
+        return left + right
+
+    def samples_of(self, values: Values) -> List[Sample]:
+        """
+        Get samples of the metric with given values
+
+        :param values: value by label values
+        :return: list of (name, labels, value)
+        """
+        return [(self.name, self._labels(key), value) for key, value in values.items()]
+
+    def samples(self) -> List[Sample]:
+        """
+        Get samples of the metric
+
+        :return: list of (name, labels, value)
+        """
+        return self.samples_of(self.snapshot())
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing counter
+    """
+
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Value that can go up and down
+    """
+
+    type = 'gauge'
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """
+    Histogram with cumulative buckets
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = (),
+                 buckets: Iterable[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels: str):
+        """
+        Observe duration of the block in seconds
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> Values:
+        with self._lock:
+            return {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+
+    def combine(self, left: Any, right: Any) -> Any:
+        return [a + b for a, b in zip(left[0], right[0])], left[1] + right[1]
+
+    def samples_of(self, values: Values) -> List[Sample]:
+        result = []
+        for key, (counts, total) in values.items():
+            labels = self._labels(key)
+            for bound, count in zip(self.buckets, counts):
+                result.append((f'{self.name}_bucket', dict(labels, le=_format_value(bound)), count))
+            result.append((f'{self.name}_sum', labels, total))
+            result.append((f'{self.name}_count', labels, counts[-1]))
+        return result
+
+
+class CallbackMetric(Metric):
+    """
+    Metric which value is collected by callback during rendering
+    """
+
+    def __init__(self, name: str, documentation: str, metric_type: str, callback: Callable[[], Optional[float]],
+                 aggregate: str = 'sum'):
+        """
+        Build metric
+
+        :param name: metric name
+        :param documentation: metric description
+        :param metric_type: counter or gauge
+        :param callback: function returning the value (None if there is no value)
+        :param aggregate: how values of processes are combined in multiprocess mode: sum or max
+        """
+        super().__init__(name, documentation)
+        self.type = metric_type
+        self.aggregate = aggregate
+        self._callback = callback
+
+    def snapshot(self) -> Values:
+        value = self._callback()
+        return {} if value is None else {(): value}
+
+    def combine(self, left: Any, right: Any) -> Any:
+        return max(left, right) if self.aggregate == 'max' else left + right
+
+
+class Registry:
+    """
+    Set of metrics with constant labels
+    """
+
+    def __init__(self, constant_labels: Optional[Dict[str, str]] = None, multiprocess_dir: Optional[str] = None,
+                 flush_interval: float = FLUSH_INTERVAL):
+        """
+        Build registry
+
+        :param constant_labels: labels added to all samples
+        :param multiprocess_dir: (Optional) directory of snapshots shared by processes (workers) of the server
+        :param flush_interval: interval (seconds) between writes of process snapshot
+        """
+        self.constant_labels = constant_labels or {}
+        self.multiprocess_dir = multiprocess_dir
+        self.flush_interval = flush_interval
+        self._metrics: List[Metric] = []
+        self._serial = next(_REGISTRY_SERIALS)
+        self._snapshot_names: Dict[int, str] = {}
+        self._flusher_pid: Optional[int] = None
+        self._flusher: Optional[threading.Thread] = None
+        self._flusher_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+
+    def register(self, metric: Metric) -> Any:
+        self._metrics.append(metric)
+        return metric
+
+    def ensure_flusher(self):
+        """
+        Start the thread that writes snapshots of the current process (in multiprocess mode).
+        It is checked by PID, so a process forked from the one with the thread starts its own thread
+        """
+        pid = os.getpid()
+        if not self.multiprocess_dir or self._flusher_pid == pid:
+            return
+
+        with self._flusher_lock:
+            if self._flusher_pid != pid and not self._closed.is_set():
+                self._flusher_pid = pid
+                self._flusher = threading.Thread(target=self._flush_periodically, name='legion-metrics-flusher',
+                                                 daemon=True)
+                self._flusher.start()
+                atexit.register(self._flush_safely)
+
+    def close(self):
+        """
+        Stop the flusher thread, write the last snapshot without gauges (values of a closed registry
+        are not current anymore) and remove metrics (with their callbacks) from the registry
+        """
+        with self._flusher_lock:
+            self._closed.set()
+            flusher, self._flusher = self._flusher, None
+
+        if flusher and flusher.is_alive():
+            flusher.join()
+        atexit.unregister(self._flush_safely)
+
+        self._metrics = [metric for metric in self._metrics if metric.type != 'gauge']
+        self._flush_safely()
+        self._metrics = []
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.flush_interval):
+            self._flush_safely()
+
+    def _flush_safely(self):
+        try:
+            self.flush()
+        except OSError as flush_error:
+            LOGGER.warning('Can not write metrics snapshot: %s', flush_error)
+
+    def _snapshot_name(self) -> str:
+        """
+        Get snapshot file name of the registry in the current process (it is different in forked processes)
+
+        :return: file name
+        """
+        pid = os.getpid()
+        if pid not in self._snapshot_names:
+            self._snapshot_names[pid] = f'{pid}-{get_process_start_time(pid)}-{self._serial}.json'
+        return self._snapshot_names[pid]
+
+    def flush(self):
+        """
+        Write snapshot of metrics of the current process to the multiprocess directory
+        """
+        if not self.multiprocess_dir:
+            return
+
+        snapshot = {metric.name: [[list(key), value] for key, value in metric.snapshot().items()]
+                    for metric in self._metrics}
+        path = os.path.join(self.multiprocess_dir, self._snapshot_name())
+        # Periodic and exit flushes must not write the same temporary file
+        with self._flush_lock:
+            with open(f'{path}.tmp', 'w') as stream:
+                json.dump(snapshot, stream)
+            os.replace(f'{path}.tmp', path)
+
+    def _read_snapshots(self) -> List[Tuple[bool, Dict[str, Any]]]:
+        """
+        Read snapshots of other processes (and other registries of the current process)
+
+        :return: list of (is process alive, snapshot)
+        """
+        snapshots = []
+        own_name = self._snapshot_name()
+        for file_name in os.listdir(self.multiprocess_dir):
+            name, extension = os.path.splitext(file_name)
+            parts = name.split('-')
+            if extension != '.json' or len(parts) != 3 or not all(part.isdigit() for part in parts) \
+                    or file_name == own_name:
+                continue
+
+            try:
+                with open(os.path.join(self.multiprocess_dir, file_name)) as stream:
+                    snapshots.append((_is_snapshot_process_alive(int(parts[0]), int(parts[1])), json.load(stream)))
+            except (OSError, ValueError) as read_error:
+                LOGGER.warning('Can not read metrics snapshot %s: %s', file_name, read_error)
+
+        return snapshots
+
+    def collect(self) -> List[Tuple[Metric, Values]]:
+        """
+        Collect values of metrics of the current process merged with other processes in multiprocess mode
+
+        :return: list of (metric, values)
+        """
+        collected = [(metric, metric.snapshot()) for metric in self._metrics]
+        if not self.multiprocess_dir:
+            return collected
+
+        self.ensure_flusher()
+        snapshots = self._read_snapshots()
+        for metric, values in collected:
+            for alive, snapshot in snapshots:
+                if metric.type == 'gauge' and not alive:
+                    continue
+                for key, value in snapshot.get(metric.name, ()):
+                    key = tuple(key)
+                    values[key] = metric.combine(values[key], value) if key in values else value
+
+        return collected
+
+    def render(self) -> str:
+        """
+        Render metrics in Prometheus text exposition format
+
+        :return: metrics text
+        """
+        return render_registries([self])
+
+
+def render_registries(registries: Iterable[Registry]) -> str:
+    """
+    Render metrics of several registries (e.g. of several models with different constant labels)
+    in Prometheus text exposition format, samples of metrics with the same name are grouped
+
+    :param registries: registries
+    :return: metrics text
+    """
+    families: Dict[str, Tuple[Metric, List[str]]] = {}
+    for registry in registries:
+        for metric, values in registry.collect():
+            samples = metric.samples_of(values)
+            if not samples:
+                continue
+
+            _, lines = families.setdefault(metric.name, (metric, []))
+            for name, labels, value in samples:
+                lines.append(f'{name}{_format_labels(dict(registry.constant_labels, **labels))} '
+                             f'{_format_value(value)}')
+
+    lines = []
+    for name, (metric, samples) in families.items():
+        lines.append(f'# HELP {name} {metric.documentation}')
+        lines.append(f'# TYPE {name} {metric.type}')
+        lines.extend(samples)
+
+    return '\n'.join(lines) + '\n'
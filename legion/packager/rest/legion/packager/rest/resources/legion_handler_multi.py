@@ -0,0 +1,478 @@
+#
+#    Copyright 2019 EPAM Systems
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+"""
+Multi-model host: one HTTP server process serves several GPPI models
+
+Every subdirectory of LEGION_MODELS_LOCATION is a GPPI model named by the subdirectory.
+Models are loaded lazily on the first request, least recently used models are unloaded
+when estimated memory of loaded models exceeds LEGION_MODELS_MEMORY_BUDGET_MB.
+Every model is served by its own instance of Legion's HTTP handler (legion_handler module), so requests
+are parsed, predicted and formatted the same way as by the single model server.
+Unloaded handler is shut down (its threads are stopped), so the model is garbage collected.
+"""
+import collections
+import contextlib
+import gc
+import hashlib
+import importlib
+import importlib.machinery
+import importlib.util
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import typing
+from typing import Any, Dict, List, Optional, Tuple
+
+from flask import Flask, jsonify, Response
+
+import legion_handler_metrics as metrics
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+app = Flask(__name__)
+
+JSON_MIMETYPE = 'application/json'
+PROJECT_FILE = 'legion.project.yaml'
+DEFAULT_WORK_DIR = 'legion_model'
+DEFAULT_ENTRYPOINT = 'entrypoint'
+MODELS_PACKAGE_PREFIX = 'legion_models_'
+HANDLERS_MODULE_PREFIX = 'legion_handlers_'
+# Package of the model imported by the handler
+HANDLER_MODEL_PACKAGE = 'legion_model'
+HANDLER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'legion_handler.py')
+
+LEGION_MODELS_LOCATION = "LEGION_MODELS_LOCATION"
+LEGION_MODELS_MEMORY_BUDGET_MB = "LEGION_MODELS_MEMORY_BUDGET_MB"
+LEGION_MODEL_NAME = "LEGION_MODEL_NAME"
+LEGION_METRICS_DIR = "LEGION_METRICS_DIR"
+
+LOGGER = logging.getLogger(__name__)
+
+
+def build_error_response(message, status=500):
+    return Response(response=json.dumps({'message': message}), status=status, mimetype=JSON_MIMETYPE)
+
+
+def get_process_memory() -> int:
+    """
+    Get resident memory of the current process (Linux only)
+
+    :return: RSS in bytes or 0 if it can not be read
+    """
+    try:
+        with open('/proc/self/statm') as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def get_module_suffix(name: str) -> str:
+    """
+    Build suffix of package and handler module names of the model: different model names
+    that are the same after replacement of non-identifier characters (e.g. a-b and a.b) get different suffixes
+
+    :param name: model name
+    :return: suffix
+    """
+    return re.sub(r'\W', '_', name) + '_' + hashlib.sha1(name.encode('utf-8')).hexdigest()[:8]
+
+
+@contextlib.contextmanager
+def override_environment(**variables: Optional[str]):
+    """
+    Set env. variables (remove None ones) for the duration of the block
+
+    :param variables: env. variables
+    """
+    previous = {name: os.environ.get(name) for name in variables}
+    try:
+        for name, value in variables.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def read_model_project(model_dir: str) -> Tuple[str, str]:
+    """
+    Read working directory and entrypoint of GPPI model from its project file
+    (default layout is used if the file or PyYAML is not available)
+
+    :param model_dir: root directory of GPPI model
+    :return: working directory and entrypoint module name
+    """
+    project_file = os.path.join(model_dir, PROJECT_FILE)
+    if yaml is None or not os.path.exists(project_file):
+        return DEFAULT_WORK_DIR, DEFAULT_ENTRYPOINT
+
+    with open(project_file) as stream:
+        model = (yaml.safe_load(stream) or {}).get('model', {})
+
+    return model.get('workDir', DEFAULT_WORK_DIR), model.get('entrypoint', DEFAULT_ENTRYPOINT)
+
+
+class LoadedModel:
+    """
+    Imported GPPI model with its handler
+    """
+
+    def __init__(self, name: str, package: str, entrypoint: Any, handler: Any, size: int, load_time: float):
+        self.name = name
+        self.package = package
+        self.entrypoint = entrypoint
+        self.handler = handler
+        self.mode = handler.SUPPORTED_PREDICTION_MODE
+        self.size = size
+        self.load_time = load_time
+
+
+class ModelHost:
+    """
+    Set of lazily loaded GPPI models with memory-bounded LRU eviction
+
+    Every model is imported as a separate package (legion_models_<suffix>) with a separate handler module
+    (legion_handlers_<suffix>), so models with the same work directory name do not clash.
+    Entrypoints must not import their own package by absolute name.
+    Memory of a model is estimated as the growth of process RSS during its import and init.
+    Handler of every model is labelled by the model name in metrics and writes metrics snapshots
+    to its own subdirectory of the metrics directory.
+    """
+
+    def __init__(self, location: str, memory_budget: int, metrics_dir: Optional[str] = None):
+        """
+        Build host
+
+        :param location: directory with GPPI models (one per subdirectory)
+        :param memory_budget: max estimated memory of loaded models in bytes (0 disables eviction)
+        :param metrics_dir: (Optional) directory of metrics snapshots shared by workers
+        """
+        self.location = location
+        self.memory_budget = memory_budget
+        self.metrics_dir = metrics_dir
+        self._models: 'collections.OrderedDict[str, LoadedModel]' = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # Loads and unloads are serialized: env. variables of the handler and legion_model module are shared
+        # by the process
+        self._load_lock = threading.Lock()
+        self.evictions = 0
+
+    def available_models(self) -> List[str]:
+        """
+        Get names of models in the location
+
+        :return: sorted model names
+        """
+        if not os.path.isdir(self.location):
+            return []
+
+        return sorted(name for name in os.listdir(self.location)
+                      if os.path.isdir(os.path.join(self.location, name)) and not name.startswith('.'))
+
+    def get(self, name: str) -> LoadedModel:
+        """
+        Get model, load it if it is not loaded yet
+
+        :param name: model name
+        :raises KeyError: if model does not exist
+        :return: loaded model
+        """
+        with self._lock:
+            model = self._models.get(name)
+            if model:
+                self._models.move_to_end(name)
+                return model
+
+        if name not in self.available_models():
+            raise KeyError(name)
+
+        with self._load_lock:
+            with self._lock:
+                model = self._models.get(name)
+                if model:
+                    self._models.move_to_end(name)
+                    return model
+
+            model = self._load(name)
+
+            with self._lock:
+                self._models[name] = model
+                evicted = self._collect_evicted(name)
+
+            if evicted:
+                while evicted:
+                    self._unload(evicted.pop())
+                # Reference cycles of the handlers are collected when the host does not reference them anymore
+                gc.collect()
+
+        return model
+
+    def _load(self, name: str) -> LoadedModel:
+        """
+        Import model entrypoint and handler of the model (handler inits the model)
+        (must be called under the load lock)
+
+        :param name: model name
+        :return: loaded model
+        """
+        model_dir = os.path.abspath(os.path.join(self.location, name))
+        work_dir, entrypoint_name = read_model_project(model_dir)
+        suffix = get_module_suffix(name)
+        package = MODELS_PACKAGE_PREFIX + suffix
+        metrics_dir = None
+        if self.metrics_dir:
+            metrics_dir = os.path.join(self.metrics_dir, suffix)
+            os.makedirs(metrics_dir, exist_ok=True)
+
+        LOGGER.info('Loading model %s from %s', name, model_dir)
+        memory_before = get_process_memory()
+        start = time.perf_counter()
+
+        # Modules of a host that has not unloaded the model (e.g. of a failed load) are not reused
+        self._remove_modules(package)
+        spec = importlib.machinery.ModuleSpec(package, None, is_package=True)
+        spec.submodule_search_locations = [os.path.join(model_dir, work_dir)]
+        sys.modules[package] = importlib.util.module_from_spec(spec)
+
+        previous_modules = {module_name: sys.modules.get(module_name)
+                            for module_name in (HANDLER_MODEL_PACKAGE, f'{HANDLER_MODEL_PACKAGE}.entrypoint')}
+        environment = {'MODEL_LOCATION': os.path.join(model_dir, work_dir), LEGION_MODEL_NAME: name,
+                       LEGION_METRICS_DIR: metrics_dir}
+        try:
+            with override_environment(**environment):
+                entrypoint = importlib.import_module(f'{package}.{entrypoint_name}')
+                # Handler imports legion_model.entrypoint, the model is exposed by this name during the import
+                sys.modules[package].entrypoint = entrypoint
+                sys.modules[HANDLER_MODEL_PACKAGE] = sys.modules[package]
+                sys.modules[f'{HANDLER_MODEL_PACKAGE}.entrypoint'] = entrypoint
+                handler = self._import_handler(HANDLERS_MODULE_PREFIX + suffix)
+        except Exception:
+            self._remove_modules(package)
+            self._remove_modules(HANDLERS_MODULE_PREFIX + suffix)
+            raise
+        finally:
+            for module_name, module in previous_modules.items():
+                if module is None:
+                    sys.modules.pop(module_name, None)
+                else:
+                    sys.modules[module_name] = module
+
+        size = max(0, get_process_memory() - memory_before)
+        load_time = time.perf_counter() - start
+        loaded_model = LoadedModel(name, package, entrypoint, handler, size, load_time)
+        LOGGER.info('Model %s (%s mode) has been loaded in %.3f seconds, estimated size %d bytes',
+                    name, loaded_model.mode, load_time, size)
+
+        return loaded_model
+
+    @staticmethod
+    def _import_handler(module_name: str) -> Any:
+        """
+        Import a separate instance of legion_handler module
+
+        :param module_name: name of the instance
+        :return: handler module
+        """
+        spec = importlib.util.spec_from_file_location(module_name, HANDLER_FILE)
+        handler = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = handler
+        spec.loader.exec_module(handler)
+
+        return handler
+
+    def _collect_evicted(self, keep: str) -> List[LoadedModel]:
+        """
+        Remove least recently used models from the host until loaded models fit the memory budget
+        (must be called under the lock)
+
+        :param keep: name of model that is never evicted (just loaded)
+        :return: evicted models
+        """
+        evicted = []
+        if not self.memory_budget:
+            return evicted
+
+        while sum(model.size for model in self._models.values()) > self.memory_budget:
+            name = next((name for name in self._models if name != keep), None)
+            if name is None:
+                break
+            evicted.append(self._models.pop(name))
+            self.evictions += 1
+
+        return evicted
+
+    @staticmethod
+    def _remove_modules(package: str):
+        for module_name in [module_name for module_name in sys.modules
+                            if module_name == package or module_name.startswith(package + '.')]:
+            del sys.modules[module_name]
+
+    def _unload(self, model: LoadedModel):
+        """
+        Shut down handler of the model and unload model and handler modules,
+        memory is released when in-flight predictions finish
+        (must be called under the load lock)
+
+        :param model: evicted model
+        """
+        LOGGER.info('Unloading model %s (estimated size %d bytes)', model.name, model.size)
+        try:
+            model.handler.shutdown()
+        except Exception:
+            LOGGER.exception('Can not shut down handler of model %s', model.name)
+        self._remove_modules(model.package)
+        self._remove_modules(model.handler.__name__)
+        # Cache of typing generics (e.g. List[_BatchItem]) references classes of the handler
+        for clear_cache in getattr(typing, '_cleanups', ()):
+            clear_cache()
+
+    def loaded_models(self) -> List[LoadedModel]:
+        """
+        Get loaded models
+
+        :return: loaded models from least to most recently used
+        """
+        with self._lock:
+            return list(self._models.values())
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get host statistics
+
+        :return: loaded models (from least to most recently used), memory and evictions
+        """
+        with self._lock:
+            loaded = [{'name': model.name, 'mode': model.mode, 'size': model.size, 'load_time': model.load_time}
+                      for model in self._models.values()]
+
+        return {
+            'models': self.available_models(),
+            'loaded': loaded,
+            'memory': sum(model['size'] for model in loaded),
+            'memory_budget': self.memory_budget,
+            'evictions': self.evictions
+        }
+
+
+HOST = ModelHost(os.getenv(LEGION_MODELS_LOCATION, '.'),
+                 int(os.getenv(LEGION_MODELS_MEMORY_BUDGET_MB, '0')) * 1024 * 1024,
+                 os.getenv(LEGION_METRICS_DIR) or None)
+
+
+def get_model(name: str) -> Tuple[Optional[LoadedModel], Optional[Response]]:
+    """
+    Get model by name or build error response
+
+    :param name: model name
+    :return: model or error response
+    """
+    try:
+        return HOST.get(name), None
+    except KeyError:
+        return None, build_error_response(f'Model {name} is not found', 404)
+    except Exception as load_exception:
+        LOGGER.exception('Can not load model %s', name)
+        return None, build_error_response(f'Can not load model {name}: {load_exception}')
+
+
+@app.route('/api/models', methods=['GET'])
+def models():
+    return jsonify(HOST.stats())
+
+
+@app.route('/api/models/<name>/info', methods=['GET'])
+def info(name):
+    model, error = get_model(name)
+    if error:
+        return error
+
+    return model.handler.info()
+
+
+@app.route('/api/models/<name>/invoke', methods=['POST'])
+def predict(name):
+    model, error = get_model(name)
+    if error:
+        return error
+
+    return model.handler.predict()
+
+
+@app.route('/api/models/<name>/batch', methods=['POST'])
+def predict_batch(name):
+    model, error = get_model(name)
+    if error:
+        return error
+
+    return model.handler.predict_batch()
+
+
+@app.route('/api/models/<name>/stream', methods=['POST'])
+def predict_stream(name):
+    model, error = get_model(name)
+    if error:
+        return error
+
+    return model.handler.predict_stream()
+
+
+@app.route('/api/models/<name>/ready', methods=['GET'])
+def model_ready(name):
+    model, error = get_model(name)
+    if error:
+        return error
+
+    return model.handler.ready()
+
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """
+    Host is ready when warmups of all loaded models have finished (models are loaded lazily)
+    """
+    statuses = {model.name: model.handler.WARMUP.status() for model in HOST.loaded_models()}
+    is_ready = all(status['ready'] for status in statuses.values())
+    resp = jsonify({'ready': is_ready, 'models': statuses})
+    resp.status_code = 200 if is_ready else 503
+
+    return resp
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Metrics of models loaded by the worker (merged with snapshots of other workers), labelled by model name
+    """
+    text = metrics.render_registries(model.handler.METRICS for model in HOST.loaded_models())
+    return Response(response=text, status=200, content_type=metrics.PROMETHEUS_MIMETYPE)
+
+
+@app.route('/healthcheck', methods=['GET'])
+def ping():
+    return jsonify({'status': True})
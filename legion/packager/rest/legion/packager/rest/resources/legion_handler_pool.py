@@ -0,0 +1,310 @@
+#
+#    Copyright 2019 EPAM Systems
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+"""
+Pool of dedicated inference processes for Legion's HTTP handler
+
+HTTP workers hand matrices to inference processes and receive predictions through shared memory blocks
+(multiprocessing.shared_memory, Python 3.8+), only small task descriptors are pickled.
+Non-numeric matrices, matrices that do not fit free space of /dev/shm and Python < 3.8 fall back to pickled copies.
+"""
+import concurrent.futures
+import importlib
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+SHARED = 'shared'
+PICKLED = 'pickled'
+ERROR = 'error'
+# Kinds of numpy dtypes passed through shared memory (bool, signed and unsigned integer, float),
+# other matrices (strings, objects, mixed values) are pickled as is
+SHARED_DTYPE_KINDS = 'biuf'
+# Interval (seconds) of checking that inference processes are alive
+PROCESS_CHECK_INTERVAL = 1.0
+# Max time (seconds) to wait for a prediction of inference process if the request has no deadline
+TASK_TIMEOUT = 60.0
+# Shared memory blocks are files of this tmpfs on Linux (64MB by default in Docker and Kubernetes),
+# writing to a block beyond its free space kills the process by SIGBUS
+SHARED_MEMORY_DIR = '/dev/shm'
+
+LOGGER = logging.getLogger(__name__)
+
+Payload = Tuple[Any, ...]
+
+
+def has_shared_memory_space(size: int) -> bool:
+    """
+    Check that shared memory has free space for a block
+
+    :param size: size of block in bytes
+    :return: is there enough free space (True if shared memory is not a file system)
+    """
+    try:
+        stat = os.statvfs(SHARED_MEMORY_DIR)
+    except (OSError, AttributeError):
+        return True
+
+    return stat.f_bavail * stat.f_frsize >= size
+
+
+def encode_array(value: Any) -> Tuple[Payload, Optional[Any]]:
+    """
+    Put numeric matrix to a new shared memory block
+
+    :param value: matrix (numpy array or list of rows)
+    :return: payload and shared memory block (owned by caller) or pickled payload and None
+    """
+    if shared_memory is None:
+        return (PICKLED, value), None
+
+    try:
+        array = numpy.asarray(value)
+    except ValueError:
+        # Rows of different lengths
+        return (PICKLED, value), None
+    if array.dtype.kind not in SHARED_DTYPE_KINDS or array.nbytes == 0:
+        return (PICKLED, value), None
+
+    if not has_shared_memory_space(array.nbytes):
+        LOGGER.warning('Shared memory has no space for %d bytes, matrix is pickled', array.nbytes)
+        return (PICKLED, value), None
+    try:
+        block = shared_memory.SharedMemory(create=True, size=array.nbytes)
+    except OSError as allocation_error:
+        LOGGER.warning('Can not allocate shared memory block, matrix is pickled: %s', allocation_error)
+        return (PICKLED, value), None
+    numpy.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+
+    return (SHARED, block.name, array.shape, array.dtype.str), block
+
+
+def attach_array(payload: Payload) -> Tuple[Any, Optional[Any]]:
+    """
+    Get matrix from payload
+
+    :param payload: payload built by encode_array
+    :return: matrix (view of shared memory for shared payload) and attached block (owned by caller)
+    """
+    if payload[0] == PICKLED:
+        return payload[1], None
+
+    _, name, shape, dtype = payload
+    block = shared_memory.SharedMemory(name=name)
+
+    return numpy.ndarray(shape, dtype=numpy.dtype(dtype), buffer=block.buf), block
+
+
+def release_block(block: Optional[Any], unlink: bool = False):
+    if block is None:
+        return
+
+    try:
+        block.close()
+    except BufferError:
+        # Model still references the matrix, mapping is released when the reference is collected
+        LOGGER.warning('Shared memory block %s is still in use', block.name)
+    if unlink:
+        block.unlink()
+
+
+def run_inference_process(entrypoint_module: str, tasks, results):
+    """
+    Main function of inference process: load the model and predict tasks until None is received
+
+    :param entrypoint_module: name of model entrypoint module
+    :param tasks: queue of (task id, matrix payload, columns)
+    :param results: queue of (task id, prediction payload, columns)
+    """
+    entrypoint = importlib.import_module(entrypoint_module)
+    entrypoint.init()
+
+    for task_id, payload, columns in iter(tasks.get, None):
+        matrix = prediction = block = None
+        try:
+            matrix, block = attach_array(payload)
+            prediction, output_columns = entrypoint.predict_on_matrix(matrix, provided_columns_names=columns)
+            # Prediction is copied to a new block, its owner is the HTTP worker
+            output_payload, output_block = encode_array(prediction)
+            release_block(output_block)
+            result = (task_id, output_payload, list(output_columns) if output_columns is not None else None)
+        except Exception as predict_exception:
+            result = (task_id, (ERROR, str(predict_exception)), None)
+        finally:
+            # Views of shared memory have to be released before the block is closed
+            matrix = prediction = None
+            release_block(block)
+
+        results.put(result)
+
+
+class InferencePool:
+    """
+    Pool of inference processes with predict_on_matrix interface
+
+    Processes are started with `spawn` method, so they do not inherit threads of the HTTP worker.
+    They are started on the first prediction if start() has not been called.
+    """
+
+    def __init__(self, entrypoint_module: str, processes: int, timeout: float = TASK_TIMEOUT):
+        """
+        Build pool
+
+        :param entrypoint_module: name of model entrypoint module
+        :param processes: count of inference processes
+        :param timeout: max time (seconds) to wait for a prediction if the request has no deadline
+        """
+        self._entrypoint_module = entrypoint_module
+        self._size = processes
+        self.timeout = timeout
+        self._context = multiprocessing.get_context('spawn')
+        self._tasks = None
+        self._results = None
+        self._processes: List[Any] = []
+        self._futures: Dict[int, Future] = {}
+        self._task_ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def predict(self, matrix: Any, provided_columns_names: Optional[List[str]] = None,
+                deadline: Optional[float] = None) -> Tuple[Any, Any]:
+        """
+        Make prediction in an inference process
+
+        :param matrix: data for prediction
+        :param provided_columns_names: (Optional). Name of columns for provided matrix.
+        :param deadline: (Optional). Deadline (time.monotonic() value) of the request, pool timeout is used without it
+        :raises TimeoutError: if the inference process has not answered before the deadline or the timeout
+        :return: result matrix and result column names
+        """
+        self.start()
+
+        timeout = self.timeout if deadline is None else max(0.0, deadline - time.monotonic())
+        payload, block = encode_array(matrix)
+        future = Future()
+        try:
+            with self._lock:
+                task_id = next(self._task_ids)
+                self._futures[task_id] = future
+            self._tasks.put((task_id, payload, provided_columns_names))
+
+            try:
+                output_payload, columns = future.result(timeout)
+            except concurrent.futures.TimeoutError:
+                # Late result is released by the collecting thread
+                with self._lock:
+                    self._futures.pop(task_id, None)
+                raise TimeoutError(f'Inference process has not predicted in {timeout:.3f} seconds')
+        finally:
+            release_block(block, unlink=True)
+
+        if output_payload[0] == ERROR:
+            raise Exception(output_payload[1])
+
+        prediction, output_block = attach_array(output_payload)
+        if output_block is not None:
+            prediction = prediction.copy()
+            release_block(output_block, unlink=True)
+
+        return prediction, columns
+
+    def start(self):
+        """
+        Start inference processes if they have not been started yet
+        """
+        if self._processes:
+            return
+
+        with self._lock:
+            if self._processes:
+                return
+
+            self._tasks = self._context.Queue()
+            self._results = self._context.Queue()
+            if shared_memory is None:
+                LOGGER.warning('multiprocessing.shared_memory is not available, matrices are pickled')
+            self._processes = [self._start_process() for _ in range(self._size)]
+            threading.Thread(target=self._collect_results, name='legion-inference-results', daemon=True).start()
+
+    def close(self):
+        """
+        Stop inference processes
+        """
+        with self._lock:
+            processes, self._processes = self._processes, []
+
+        for _ in processes:
+            self._tasks.put(None)
+        for process in processes:
+            process.join()
+
+    def _start_process(self):
+        process = self._context.Process(target=run_inference_process, name='legion-inference', daemon=True,
+                                        args=(self._entrypoint_module, self._tasks, self._results))
+        process.start()
+        return process
+
+    def _collect_results(self):
+        """
+        Resolve futures by results of inference processes and restart processes that have died
+        """
+        last_check = time.monotonic()
+        while True:
+            try:
+                task_id, output_payload, columns = self._results.get(timeout=PROCESS_CHECK_INTERVAL)
+            except queue.Empty:
+                task_id = None
+
+            if time.monotonic() - last_check >= PROCESS_CHECK_INTERVAL:
+                self._check_processes()
+                last_check = time.monotonic()
+            if task_id is None:
+                continue
+
+            with self._lock:
+                future = self._futures.pop(task_id, None)
+            if future:
+                future.set_result((output_payload, columns))
+            elif output_payload[0] == SHARED:
+                # Request has timed out, nobody owns the prediction block
+                release_block(shared_memory.SharedMemory(name=output_payload[1]), unlink=True)
+
+    def _check_processes(self):
+        dead = [index for index, process in enumerate(self._processes) if not process.is_alive()]
+        if not dead:
+            return
+
+        # Tasks of the dead process are unknown, so all pending tasks fail
+        with self._lock:
+            futures, self._futures = self._futures, {}
+        for future in futures.values():
+            future.set_result(((ERROR, 'Inference process has died'), None))
+
+        for index in dead:
+            LOGGER.warning('Inference process %d has died with code %s, restarting',
+                           self._processes[index].pid, self._processes[index].exitcode)
+            self._processes[index] = self._start_process()
@@ -0,0 +1,83 @@
+#
+#    Copyright 2019 EPAM Systems
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+"""
+Stack-sampling profiler of Legion's HTTP handler
+
+Stacks of all threads of the process are sampled with sys._current_frames() at a fixed interval
+and aggregated to collapsed stacks (`frame;frame;frame count` lines), the input format of
+flamegraph.pl, inferno and speedscope. Frames are labeled as `module:function`.
+"""
+import collections
+import sys
+import threading
+import time
+from typing import Counter, Iterable, Optional, Tuple
+
+Stack = Tuple[str, ...]
+
+
+def walk_stack(frame) -> Stack:
+    """
+    Build stack of frame labels from the outermost frame to the given one
+
+    :param frame: innermost frame
+    :return: stack
+    """
+    labels = []
+    while frame is not None:
+        labels.append(f'{frame.f_globals.get("__name__", "?")}:{frame.f_code.co_name}')
+        frame = frame.f_back
+    labels.reverse()
+
+    return tuple(labels)
+
+
+def sample_stacks(duration: float, interval: float, exclude_threads: Optional[Iterable[int]] = None) \
+        -> Tuple[Counter[Stack], int]:
+    """
+    Sample stacks of all threads of the process
+
+    :param duration: sampling duration in seconds
+    :param interval: interval between samples in seconds
+    :param exclude_threads: idents of threads that are not sampled (the sampling thread is always excluded)
+    :return: count of samples per stack and count of sampling rounds
+    """
+    excluded = set(exclude_threads or ()) | {threading.get_ident()}
+    stacks: Counter[Stack] = collections.Counter()
+    rounds = 0
+
+    deadline = time.monotonic() + duration
+    next_sample = time.monotonic()
+    while next_sample < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id not in excluded:
+                stacks[walk_stack(frame)] += 1
+        rounds += 1
+
+        next_sample += interval
+        time.sleep(max(0.0, next_sample - time.monotonic()))
+
+    return stacks, rounds
+
+
+def render_collapsed(stacks: Counter[Stack]) -> str:
+    """
+    Render stacks in collapsed format (one `frame;frame;frame count` line per stack)
+
+    :param stacks: count of samples per stack
+    :return: collapsed stacks
+    """
+    return ''.join(f'{";".join(stack)} {count}\n' for stack, count in sorted(stacks.items()))
@@ -0,0 +1,22 @@
+# Native thread pools (OpenMP, MKL, OpenBLAS, numexpr) of all workers share CPUs of the container,
+# LEGION_NATIVE_THREADS environment variable overrides the limit of one worker (or inference process)
+{%- if native_threads|int %}
+LEGION_NATIVE_THREADS=${LEGION_NATIVE_THREADS:-{{ native_threads }}}
+{%- else %}
+if [ -z "$LEGION_NATIVE_THREADS" ]; then
+    CPUS=$(env -u OMP_NUM_THREADS -u OMP_THREAD_LIMIT nproc)
+    if [ -r /sys/fs/cgroup/cpu.max ]; then
+        read -r QUOTA PERIOD < /sys/fs/cgroup/cpu.max
+    elif [ -r /sys/fs/cgroup/cpu/cpu.cfs_quota_us ]; then
+        read -r QUOTA < /sys/fs/cgroup/cpu/cpu.cfs_quota_us
+        read -r PERIOD < /sys/fs/cgroup/cpu/cpu.cfs_period_us
+    fi
+    if [ "${QUOTA:-max}" != "max" ] && [ "$QUOTA" -gt 0 ]; then
+        CPUS=$(( QUOTA / PERIOD ))
+    fi
+    LEGION_NATIVE_THREADS=$(( CPUS / {{ native_thread_consumers }} ))
+    if [ "$LEGION_NATIVE_THREADS" -lt 1 ]; then
+        LEGION_NATIVE_THREADS=1
+    fi
+fi
+{%- endif %}
@@ -18,7 +18,7 @@ Template helper
 """
 from os import path
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
 
 import pydantic
 from jinja2 import Environment, FileSystemLoader
@@ -48,15 +48,82 @@ class DockerTemplateContext(pydantic.BaseModel):
     port: str
     workers: str
     threads: str
+    server_mode: str
+    worker_class: str
+    autotune_summary: str
+    preload: bool
+    warmup_iterations: str
+    max_queue_depth: str
+    max_estimated_wait_ms: str
+    compression_min_size: str
+    zstd_compression: bool
+    max_decompressed_mb: str
+    inference_processes: str
+    native_threads: str
+    native_thread_consumers: str
+    grpc_port: str
+    input_validation: bool
+    reorder_columns: bool
+    prediction_log: str
+    prediction_log_queue_mb: str
+    profiler_token_sha256: str
+    batch_max_size: str
+    batch_max_wait_ms: str
+    stream_chunk_size: str
+    prediction_cache_size: str
+    prediction_cache_ttl: str
+    json_codec: str
+    models_location: str
+    models_memory_budget_mb: str
     pythonpath: str
     wsgi_handler: str
     model_location: str
     entrypoint_target: str
     handler_file: str
+    handler_extension_files: List[str]
     base_image: str
     conda_installation_content: str
     conda_file_name: str
     entrypoint_docker: str
+    # Legion's env. variables of the model server (see build_server_environment)
+    server_environment: Dict[str, str] = {}
+
+
+def build_server_environment(context: DockerTemplateContext) -> Dict[str, str]:
+    """
+    Build Legion's env. variables of the model server that are set by the entrypoints
+    (variables computed by the entrypoint at start, e.g. native thread limits, are not included)
+
+    :param context: template context
+    :return: env. variables
+    """
+    def flag(value: bool) -> str:
+        return 'true' if value else 'false'
+
+    return {
+        'LEGION_BATCH_MAX_SIZE': context.batch_max_size,
+        'LEGION_BATCH_MAX_WAIT_MS': context.batch_max_wait_ms,
+        'LEGION_STREAM_CHUNK_SIZE': context.stream_chunk_size,
+        'LEGION_PREDICTION_CACHE_SIZE': context.prediction_cache_size,
+        'LEGION_PREDICTION_CACHE_TTL': context.prediction_cache_ttl,
+        'LEGION_PREDICT_THREADS': context.threads,
+        'LEGION_JSON_CODEC': context.json_codec,
+        'LEGION_PRELOAD': flag(context.preload),
+        'LEGION_WARMUP_ITERATIONS': context.warmup_iterations,
+        'LEGION_MAX_QUEUE_DEPTH': context.max_queue_depth,
+        'LEGION_MAX_ESTIMATED_WAIT_MS': context.max_estimated_wait_ms,
+        'LEGION_COMPRESSION_MIN_SIZE': context.compression_min_size,
+        'LEGION_MAX_DECOMPRESSED_MB': context.max_decompressed_mb,
+        'LEGION_INFERENCE_PROCESSES': context.inference_processes,
+        'LEGION_GRPC_PORT': context.grpc_port,
+        'LEGION_INPUT_VALIDATION': flag(context.input_validation),
+        'LEGION_REORDER_COLUMNS': flag(context.reorder_columns),
+        'LEGION_PREDICTION_LOG': context.prediction_log,
+        'LEGION_PREDICTION_LOG_QUEUE_MB': context.prediction_log_queue_mb,
+        'LEGION_PROFILER_TOKEN_SHA256': context.profiler_token_sha256,
+        'LEGION_MODELS_LOCATION': context.models_location,
+        'LEGION_MODELS_MEMORY_BUDGET_MB': context.models_memory_budget_mb,
+    }
 
 
 def render_packager_template(template_name: str, values: Optional[Dict[str, Any]] = None) -> str:
@@ -52,7 +52,8 @@ setup(
     license='Apache v2',
     entry_points={
         'console_scripts': [
-            'legion-pack-to-rest=legion.packager.rest:work_resource_file'
+            'legion-pack-to-rest=legion.packager.rest:work_resource_file',
+            'legion-pack-to-rest-benchmark=legion.packager.rest.benchmark:benchmark'
         ],
     },
     install_requires=requirements,
@@ -0,0 +1,46 @@
+#
+#    Copyright 2019 EPAM Systems
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+import importlib
+import os
+import sys
+
+import pytest
+
+from legion.packager.rest.constants import RESOURCES_FOLDER, HANDLER_MODULE
+
+TEST_MODEL_FOLDER = os.path.join(os.path.dirname(__file__), 'resources')
+
+
+@pytest.fixture(scope='session')
+def legion_handler():
+    """
+    Import REST handler with the test model (sum of row values)
+    """
+    sys.path.insert(0, TEST_MODEL_FOLDER)
+    sys.path.insert(0, RESOURCES_FOLDER)
+    try:
+        yield importlib.import_module(HANDLER_MODULE)
+    finally:
+        sys.path.remove(RESOURCES_FOLDER)
+        sys.path.remove(TEST_MODEL_FOLDER)
+
+
+@pytest.fixture
+def handler_client(legion_handler):
+    """
+    Flask test client for REST handler
+    """
+    return legion_handler.app.test_client()
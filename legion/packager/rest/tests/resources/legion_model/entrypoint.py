@@ -0,0 +1,77 @@
+from typing import Tuple, List, Dict, Any, Optional, Type
+
+CALLS: List[int] = []
+
+
+def init() -> str:
+    """
+    Initialize model and return prediction type
+
+    :return: prediction type (matrix or objects)
+    """
+    return 'matrix'
+
+
+def predict_on_matrix(input_matrix: List[List[Any]], provided_columns_names: Optional[List[str]] = None) \
+        -> Tuple[List[List[Any]], Tuple[str, ...]]:
+    """
+    Make prediction on a Matrix of values (sum of each row)
+
+    :param input_matrix: data for prediction
+    :param provided_columns_names: (Optional). Name of columns for provided matrix.
+    :return: result matrix and result column names
+    """
+    CALLS.append(len(input_matrix))
+
+    return [[sum(row)] for row in input_matrix], ('sum',)
+
+
+def predict_on_objects(objects: Any) -> List[Dict[str, Any]]:
+    """
+    Make prediction on objects (sum of `a` and `b` fields)
+
+    :param objects: dict of columns
+    :return: list of dicts
+    """
+    CALLS.append(len(objects['a']))
+    return [{'sum': int(a + b)} for a, b in zip(objects['a'], objects['b'])]
+
+
+def info() -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Get input and output schemas
+
+    :return: OpenAPI specifications. Each specification is assigned as (input / output)
+    """
+    input_sample = [
+        {
+            'name': "a",
+            'type': "integer",
+            'required': True,
+            'example': 1
+        },
+        {
+            'name': "b",
+            'type': "integer",
+            'example': 2
+        }
+    ]
+    output_sample = [
+        {
+            'name': "sum",
+            'type': "integer",
+            'required': True,
+            'example': 3
+        }
+    ]
+
+    return input_sample, output_sample
+
+
+def get_output_json_serializer() -> Optional[Type]:
+    """
+    Returns JSON serializer to be used in output
+
+    :return: JSON serializer
+    """
+    return None
@@ -0,0 +1,91 @@
+#
+#    Copyright 2019 EPAM Systems
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+import os
+import sys
+
+import pytest
+
+from legion.packager.rest.autotune import Calibration, read_cpu_limit, choose_server_settings, calibrate, autotune
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as stream:
+        stream.write(content)
+
+
+def test_cgroup_v2_cpu_limit(tmpdir):
+    write(os.path.join(str(tmpdir), 'cpu.max'), '250000 100000\n')
+
+    assert read_cpu_limit(str(tmpdir)) == 2.5
+
+
+def test_cgroup_v1_cpu_limit(tmpdir):
+    write(os.path.join(str(tmpdir), 'cpu,cpuacct', 'cpu.cfs_quota_us'), '300000\n')
+    write(os.path.join(str(tmpdir), 'cpu,cpuacct', 'cpu.cfs_period_us'), '100000\n')
+
+    assert read_cpu_limit(str(tmpdir)) == 3
+
+
+def test_unlimited_cpu(tmpdir):
+    write(os.path.join(str(tmpdir), 'cpu.max'), 'max 100000\n')
+
+    assert read_cpu_limit(str(tmpdir)) == len(os.sched_getaffinity(0))
+
+
+@pytest.mark.parametrize('calibration, expected', [
+    # GIL-bound prediction
+    (Calibration(0.001, 1.0, 1.0), (4, 2, 'wsgi')),
+    # Prediction uses 2 CPUs (multithreaded BLAS)
+    (Calibration(0.01, 2.0, 1.1), (2, 2, 'wsgi')),
+    # Prediction runs outside the GIL
+    (Calibration(0.01, 0.9, 3.0), (4, 4, 'wsgi')),
+    # Prediction mostly waits
+    (Calibration(0.05, 0.1, 3.9), (4, 20, 'asgi')),
+])
+def test_choose_server_settings(calibration, expected):
+    settings = choose_server_settings(4, calibration)
+
+    assert (settings.workers, settings.threads, settings.server_mode) == expected
+
+
+def test_calibration_of_broken_model(tmpdir):
+    write(os.path.join(str(tmpdir), 'legion_model', 'entrypoint.py'), 'raise ImportError("no model deps")\n')
+
+    assert calibrate(str(tmpdir), sys.executable, 0.01) is None
+    assert autotune(str(tmpdir), sys.executable, 4) is None
+
+
+def test_calibration_sets_model_location(tmpdir):
+    write(os.path.join(str(tmpdir), 'legion_model', 'entrypoint.py'), '''
+import os
+
+assert os.environ['MODEL_LOCATION'] == 'legion_model'
+
+
+def init():
+    return 'matrix'
+
+
+def info():
+    return [{'name': 'a', 'example': 1}], []
+
+
+def predict_on_matrix(matrix, provided_columns_names=None):
+    return [[row[0]] for row in matrix], ('a',)
+''')
+
+    assert calibrate(str(tmpdir), sys.executable, 0.01) is not None
@@ -0,0 +1,90 @@
+#
+#    Copyright 2019 EPAM Systems
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+import os
+import sys
+
+import click
+import pytest
+
+from legion.packager.rest.benchmark import read_server_settings, read_model_description, parse_int_list, \
+    build_server_command, resolve_gunicorn_bin, start_server
+from legion.packager.rest.constants import ENTRYPOINT_TEMPLATE, SERVER_SETTINGS_FILE
+from legion.packager.rest.data_models import PackagingResourceArguments
+from legion.packager.rest.pipeline import work
+
+TEST_MODEL_FOLDER = os.path.join(os.path.dirname(__file__), 'resources')
+
+
+def pack(output_folder, **arguments) -> str:
+    target = os.path.join(str(output_folder), 'output')
+    work(TEST_MODEL_FOLDER, target, conda_env='create', ignore_conda=True, conda_env_name='test-env',
+         dockerfile=True, arguments=PackagingResourceArguments(**arguments))
+    return target
+
+
+def read(folder, file_name) -> str:
+    with open(os.path.join(folder, file_name)) as stream:
+        return stream.read()
+
+
+def test_read_server_settings(tmpdir):
+    output = pack(tmpdir, serverMode='asgi', workers=3, threads=6, timeout=30, preload=True, batchMaxSize=8)
+    settings = read_server_settings(output)
+
+    assert settings['server_mode'] == 'asgi'
+    assert settings['preload']
+    assert (settings['workers'], settings['threads'], settings['timeout']) == (3, 6, 30)
+    assert settings['env']['LEGION_BATCH_MAX_SIZE'] == '8'
+    assert 'LEGION_NATIVE_THREADS' not in settings['env']
+    assert settings['gunicorn_bin'].endswith('/bin/gunicorn')
+    # Entrypoint sets the same variables
+    entrypoint = read(output, ENTRYPOINT_TEMPLATE)
+    assert all(f'\n{name}={value} \\\n' in entrypoint for name, value in settings['env'].items())
+    assert resolve_gunicorn_bin(settings, '/opt/gunicorn') == '/opt/gunicorn'
+    assert resolve_gunicorn_bin(settings, None) == 'gunicorn'
+    assert resolve_gunicorn_bin(dict(settings, gunicorn_bin=sys.executable), None) == sys.executable
+    assert read_model_description(output) == {'name': 'sum-model', 'version': '1.0'}
+
+    command = build_server_command(output, settings['server_mode'], '127.0.0.1', 5050, 2, 4,
+                                   preload=settings['preload'], timeout=settings['timeout'])
+    assert command[-3:] == ['-k', 'uvicorn.workers.UvicornWorker', 'legion_handler_asgi:app']
+    assert '--preload' in command and '30' in command
+
+
+def test_read_server_settings_of_old_output(tmpdir):
+    output = pack(tmpdir)
+    os.remove(os.path.join(output, SERVER_SETTINGS_FILE))
+
+    with pytest.raises(click.ClickException):
+        read_server_settings(output)
+
+
+def test_parse_int_list():
+    assert parse_int_list('1, 10,100') == [1, 10, 100]
+
+    with pytest.raises(click.BadParameter):
+        parse_int_list('1,x')
+    with pytest.raises(click.BadParameter):
+        parse_int_list('0')
+
+
+def test_start_server_shows_output_of_failed_server():
+    with pytest.raises(Exception) as error:
+        with start_server([sys.executable, '-c', 'print("model can not be loaded"); exit(3)'], 'http://127.0.0.1:1'):
+            pass
+
+    assert 'exited with code 3' in str(error.value)
+    assert 'model can not be loaded' in str(error.value)
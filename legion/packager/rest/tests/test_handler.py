@@ -0,0 +1,993 @@
+#
+#    Copyright 2019 EPAM Systems
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+import gzip
+import hashlib
+import importlib
+import json
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import types
+
+import numpy
+import pytest
+from legion.sdk.clients.model import ModelClient, encode_matrix, NPY_FORMAT, ARROW_FORMAT, GZIP_ENCODING, \
+    ZSTD_ENCODING
+
+
+def test_invoke(handler_client):
+    response = handler_client.post('/api/model/invoke', data=json.dumps({'columns': ['a', 'b'],
+                                                                         'data': [[1, 2], [3, 4]]}))
+
+    assert response.status_code == 200
+    assert json.loads(response.data) == {'prediction': [[3], [7]], 'columns': ['sum']}
+
+
+def test_micro_batcher_coalesces_concurrent_requests(legion_handler):
+    calls = []
+    release = threading.Event()
+
+    def predict(matrix, provided_columns_names=None):
+        calls.append(len(matrix))
+        release.wait(1)
+        return legion_handler.legion_model.entrypoint.predict_on_matrix(matrix, provided_columns_names)
+
+    batcher = legion_handler.MicroBatcher(predict, max_size=100, max_wait=0.05)
+    results = {}
+
+    def invoke(index):
+        results[index] = batcher.predict([[index, index]], ['a', 'b'])
+
+    def wait_for(condition):
+        for _ in range(100):
+            if condition():
+                return
+            time.sleep(0.01)
+
+    threads = [threading.Thread(target=invoke, args=(index,)) for index in range(5)]
+    threads[0].start()
+    # First request is being predicted, the rest should wait in the queue
+    wait_for(lambda: calls)
+    for thread in threads[1:]:
+        thread.start()
+    wait_for(lambda: batcher._queue.qsize() == 4)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [1, 4]
+    for index in range(5):
+        assert results[index] == ([[index * 2]], ('sum',))
+
+
+def test_micro_batcher_propagates_errors(legion_handler):
+    def predict(matrix, provided_columns_names=None):
+        raise ValueError('broken model')
+
+    batcher = legion_handler.MicroBatcher(predict, max_size=100, max_wait=0.01)
+
+    try:
+        batcher.predict([[1, 2]])
+        assert False, 'Exception expected'
+    except ValueError as error:
+        assert str(error) == 'broken model'
+
+
+def test_micro_batcher_predicts_matrices_of_different_widths(legion_handler):
+    batcher = legion_handler.MicroBatcher(legion_handler.legion_model.entrypoint.predict_on_matrix,
+                                          max_size=100, max_wait=0.01)
+    items = [legion_handler._BatchItem(numpy.array([[1, 2]]), None),
+             legion_handler._BatchItem(numpy.array([[1, 2, 3]]), None)]
+
+    batcher._predict_group(items)
+
+    assert items[0].future.result(timeout=1) == ([[3]], ('sum',))
+    assert items[1].future.result(timeout=1) == ([[6]], ('sum',))
+
+
+def test_micro_batcher_survives_broken_batches(legion_handler, monkeypatch):
+    def predict(matrix, provided_columns_names=None):
+        # Scalar prediction of a batch
+        return 42 if len(matrix) > 1 else [[sum(matrix[0])]], ('sum',)
+
+    batcher = legion_handler.MicroBatcher(predict, max_size=100, max_wait=0.01)
+    items = [legion_handler._BatchItem([[1, 2]], None), legion_handler._BatchItem([[3, 4]], None)]
+    batcher._predict_group(items)
+
+    for item in items:
+        with pytest.raises(TypeError):
+            item.future.result(timeout=1)
+
+    def broken_predict_group(group):
+        raise RuntimeError('bug')
+
+    monkeypatch.setattr(batcher, '_predict_group', broken_predict_group)
+    with pytest.raises(RuntimeError):
+        batcher.predict([[1, 2]])
+    monkeypatch.undo()
+
+    # Worker thread is still alive
+    assert batcher.predict([[1, 2]]) == ([[3]], ('sum',))
+
+
+def test_invoke_npy_format(handler_client):
+    client = ModelClient(url='', http_client=handler_client, data_format=NPY_FORMAT)
+
+    result = client.invoke(columns=['a', 'b'], data=numpy.array([[1, 2], [3, 4]]))
+
+    assert result['columns'] == ['sum']
+    assert result['prediction'].tolist() == [[3], [7]]
+
+
+def test_invoke_arrow_format(handler_client):
+    client = ModelClient(url='', http_client=handler_client, data_format=ARROW_FORMAT)
+
+    result = client.invoke(columns=['a', 'b'], data=[[1.5, 2], [3, 4]])
+
+    assert result['columns'] == ['sum']
+    assert result['prediction'].tolist() == [[3.5], [7.0]]
+
+
+def test_invoke_npy_request_with_json_response(handler_client):
+    body, headers = encode_matrix([[1, 2]], ['a', 'b'], NPY_FORMAT)
+
+    response = handler_client.post('/api/model/invoke', data=body, headers=headers, content_type=NPY_FORMAT)
+
+    assert response.mimetype == 'application/json'
+    assert json.loads(response.data) == {'prediction': [[3]], 'columns': ['sum']}
+
+
+def test_invoke_stream(handler_client, legion_handler, monkeypatch):
+    monkeypatch.setattr(legion_handler, 'STREAM_CHUNK_SIZE', 2)
+    calls = legion_handler.legion_model.entrypoint.CALLS
+    calls.clear()
+
+    response = handler_client.post('/api/model/stream', data='[1, 2]\n[3, 4]\n\n[5, 6]\n',
+                                   headers={'Data-Columns': '["a", "b"]'})
+
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    assert json.loads(response.headers['Data-Columns']) == ['sum']
+    assert response.data.decode('utf-8').splitlines() == ['[3]', '[7]', '[11]']
+    assert calls == [2, 1]
+
+
+def test_invoke_stream_without_output_columns(handler_client, legion_handler, monkeypatch):
+    monkeypatch.setattr(legion_handler, 'PREDICT_FUNCTION',
+                        lambda matrix, provided_columns_names=None: ([[sum(row)] for row in matrix], None))
+
+    response = handler_client.post('/api/model/stream', data='[1, 2]\n[3, 4]\n')
+
+    assert response.data.decode('utf-8').splitlines() == ['[3]', '[7]']
+    assert response.status_code == 200
+    assert 'Data-Columns' not in response.headers
+
+
+def test_invoke_stream_is_logged(handler_client, legion_handler, monkeypatch, tmpdir):
+    monkeypatch.setattr(legion_handler, 'STREAM_CHUNK_SIZE', 1)
+    legion_handler_log = importlib.import_module('legion_handler_log')
+    path = str(tmpdir.join('predictions.ndjson.gz'))
+    prediction_log = legion_handler_log.PredictionLog(legion_handler_log.FileSink(path),
+                                                      legion_handler.JSON_CODEC.dumps, 10 ** 6)
+    monkeypatch.setattr(legion_handler, 'PREDICTION_LOG', prediction_log)
+
+    response = handler_client.post('/api/model/stream', data='[1, 2]\n[3, 4]\n',
+                                   headers={'Data-Columns': '["a", "b"]', 'x-request-id': 'abc'})
+    assert response.data.decode('utf-8').splitlines() == ['[3]', '[7]']
+    prediction_log.close()
+
+    records = read_prediction_log(path)
+    assert [record['request_id'] for record in records] == ['abc', 'abc']
+    assert records[1]['input'] == {'columns': ['a', 'b'], 'data': [[3, 4]]}
+    assert records[1]['output'] == {'prediction': [[7]], 'columns': ['sum']}
+
+
+def test_invoke_stream_compressed(handler_client):
+    response = handler_client.post('/api/model/stream', data=gzip.compress(b'[1, 2]\n[3, 4]\n'),
+                                   headers={'Content-Encoding': 'gzip'})
+
+    assert response.status_code == 200
+    assert response.data.decode('utf-8').splitlines() == ['[3]', '[7]']
+
+
+def test_invoke_stream_admission_and_deadline(handler_client, legion_handler, monkeypatch):
+    monkeypatch.setattr(legion_handler.ADMISSION, 'max_queue_depth', 1)
+    monkeypatch.setattr(legion_handler.ADMISSION, 'admitted', 1)
+
+    assert handler_client.post('/api/model/stream', data='[1, 2]\n').status_code == 503
+
+    monkeypatch.setattr(legion_handler.ADMISSION, 'admitted', 0)
+    monkeypatch.setattr(legion_handler.REQUESTS_EXPIRED, '_values', {})
+    expired = handler_client.post('/api/model/stream', data='[1, 2]\n', headers={'Request-Timeout-Ms': '0'})
+
+    assert expired.status_code == 504
+    assert legion_handler.ADMISSION.admitted == 0
+    assert legion_handler.REQUESTS_EXPIRED._values == {(): 1}
+
+
+def test_invoke_stream_releases_admission(handler_client, legion_handler, monkeypatch):
+    monkeypatch.setattr(legion_handler, 'STREAM_CHUNK_SIZE', 1)
+    in_flight = legion_handler.REQUESTS_IN_FLIGHT._values.get((), 0)
+
+    response = handler_client.post('/api/model/stream', data='[1, 2]\n[3, 4]\n')
+
+    assert response.data.decode('utf-8').splitlines() == ['[3]', '[7]']
+    response.close()
+    assert legion_handler.ADMISSION.admitted == 0
+    assert legion_handler.REQUESTS_IN_FLIGHT._values.get((), 0) == in_flight
+
+
+def test_invoke_stream_bad_line(handler_client):
+    response = handler_client.post('/api/model/stream', data='[1, 2]\n[3, ')
+
+    assert response.status_code == 500
+    assert 'Can not parse input line as JSON' in json.loads(response.data)['message']
+
+
+def test_prediction_cache_predicts_only_missing_rows(legion_handler):
+    calls = []
+
+    def predict(matrix, columns):
+        calls.append(list(matrix))
+        return [[sum(row)] for row in matrix], ('sum',)
+
+    cache = legion_handler.PredictionCache(max_size=10, ttl=0)
+
+    assert cache.predict([[1, 2], [3, 4]], ['a', 'b'], predict) == ([[3], [7]], ('sum',))
+    assert cache.predict([[3, 4], [5, 6]], ['a', 'b'], predict) == ([[7], [11]], ('sum',))
+    assert cache.predict([[3, 4]], ['b', 'a'], predict) == ([[7]], ('sum',))
+
+    assert calls == [[[1, 2], [3, 4]], [[5, 6]], [[3, 4]]]
+    assert cache.stats() == {'size': 4, 'hits': 1, 'misses': 4, 'evictions': 0}
+
+
+def test_prediction_cache_eviction_and_ttl(legion_handler):
+    cache = legion_handler.PredictionCache(max_size=2, ttl=0)
+    for key in (b'a', b'b', b'c'):
+        cache.put(key, (key, None))
+
+    assert cache.get(b'a') is None
+    assert cache.get(b'c') == (b'c', None)
+    assert cache.stats()['evictions'] == 1
+
+    expiring_cache = legion_handler.PredictionCache(max_size=2, ttl=-1)
+    expiring_cache.put(b'a', (b'a', None))
+    assert expiring_cache.get(b'a') is None
+
+
+def test_asgi_invoke(legion_handler):
+    TestClient = pytest.importorskip('starlette.testclient').TestClient
+    legion_handler_asgi = importlib.import_module('legion_handler_asgi')
+    client = TestClient(legion_handler_asgi.app)
+
+    response = client.post('/api/model/invoke', json={'columns': ['a', 'b'], 'data': [[1, 2], [3, 4]]},
+                           headers={'request-id': '42'})
+
+    assert response.status_code == 200
+    assert response.json() == {'prediction': [[3], [7]], 'columns': ['sum']}
+    assert response.headers['request-id'] == '42'
+    assert client.get('/healthcheck').json() == {'status': True}
+
+    batch = client.post('/api/model/batch', json=[{'data': [[1, 2]]}, {'data': [[3, 4]]}])
+    assert batch.json() == [{'prediction': [[3]], 'columns': ['sum']}, {'prediction': [[7]], 'columns': ['sum']}]
+
+
+def test_info_etag(handler_client):
+    response = handler_client.get('/api/model/info')
+
+    assert response.status_code == 200
+    assert response.headers['ETag']
+    properties = response.json['paths']['/api/model/invoke']['post']['parameters'][0]['schema']['properties']
+    assert properties['columns']['example'] == ['a', 'b']
+
+    not_modified = handler_client.get('/api/model/info', headers={'If-None-Match': response.headers['ETag']})
+    assert not_modified.status_code == 304
+    assert not not_modified.data
+
+
+@pytest.mark.parametrize('codec_name', ['json', 'orjson', 'ujson'])
+def test_json_codecs(legion_handler, codec_name):
+    pytest.importorskip(codec_name)
+    codec = legion_handler.build_json_codec(codec_name)
+
+    assert codec.name == codec_name
+    assert codec.loads(b'{"data": [[1, 2.5]]}') == {'data': [[1, 2.5]]}
+    encoded = codec.dumps({'prediction': numpy.array([[1.5], [2.5]]), 'columns': ('sum',), 'count': numpy.int64(2)})
+    assert json.loads(encoded) == {'prediction': [[1.5], [2.5]], 'columns': ['sum'], 'count': 2}
+
+
+def test_unknown_json_codec_falls_back_to_stdlib(legion_handler):
+    assert legion_handler.build_json_codec('simdjson').name == 'json'
+
+
+def test_metrics(handler_client):
+    handler_client.post('/api/model/invoke', data=json.dumps({'columns': ['a', 'b'], 'data': [[1, 2]]}))
+    handler_client.post('/api/model/invoke', data='not a json')
+
+    response = handler_client.get('/metrics')
+    text = response.data.decode('utf-8')
+
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    assert '# TYPE legion_model_request_phase_seconds histogram' in text
+    assert 'legion_model_request_phase_seconds_count{model_name="",model_version="",phase="predict"}' in text
+    assert 'legion_model_request_errors_total{model_name="",model_version="",phase="parse"}' in text
+    assert 'legion_model_requests_in_flight{model_name="",model_version=""} 0' in text
+    assert 'legion_model_request_size_bytes_bucket{model_name="",model_version="",le="+Inf"}' in text
+
+
+def test_metrics_merge_processes(legion_handler, tmp_path):
+    metrics = legion_handler.metrics
+    registry = metrics.Registry({'model_name': 'm'}, str(tmp_path))
+    counter = registry.register(metrics.Counter('requests_total', 'Requests'))
+    gauge = registry.register(metrics.Gauge('in_flight', 'In flight'))
+    histogram = registry.register(metrics.Histogram('latency_seconds', 'Latency', buckets=(1.0, float('inf'))))
+    registry.register(metrics.CallbackMetric('wait_seconds', 'Wait', 'gauge', lambda: 2.0, aggregate='max'))
+
+    counter.inc(3)
+    gauge.inc(2)
+    histogram.observe(0.5)
+    registry.flush()
+    own_snapshot = str(next(tmp_path.iterdir()))
+    # Snapshots of another live worker (parent process) and of an exited one
+    exited = subprocess.Popen(['true'])
+    exited.wait()
+    parent_start_time = metrics.get_process_start_time(os.getppid())
+    shutil.copy(own_snapshot, str(tmp_path / f'{exited.pid}-0-0.json'))
+    shutil.copy(own_snapshot, str(tmp_path / f'{os.getppid()}-{parent_start_time}-0.json'))
+    os.remove(own_snapshot)
+
+    text = registry.render()
+
+    assert 'requests_total{model_name="m"} 9.0' in text
+    assert 'in_flight{model_name="m"} 4.0' in text
+    assert 'latency_seconds_bucket{model_name="m",le="1.0"} 3' in text
+    assert 'latency_seconds_sum{model_name="m"} 1.5' in text
+    assert 'wait_seconds{model_name="m"} 2.0' in text
+
+
+def test_metrics_of_reused_pid(legion_handler, tmp_path):
+    metrics = legion_handler.metrics
+    registry = metrics.Registry({}, str(tmp_path))
+    counter = registry.register(metrics.Counter('requests_total', 'Requests'))
+    gauge = registry.register(metrics.Gauge('in_flight', 'In flight'))
+    start_time = metrics.get_process_start_time(os.getpid())
+    if not start_time:
+        pytest.skip('Process start time is not available')
+
+    counter.inc(3)
+    gauge.inc(2)
+    registry.flush()
+    # Snapshot of an exited process which PID has been reused by the current one
+    own_snapshot = str(next(tmp_path.iterdir()))
+    reused_snapshot = str(tmp_path / f'{os.getpid()}-{start_time - 1}-0.json')
+    shutil.copy(own_snapshot, reused_snapshot)
+    registry.flush()
+
+    text = registry.render()
+
+    assert 'requests_total 6.0' in text
+    assert 'in_flight 2.0' in text
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_warmup_replays_example_rows(handler_client, legion_handler, monkeypatch):
+    calls = legion_handler.legion_model.entrypoint.CALLS
+    warmup = legion_handler.Warmup(3)
+    monkeypatch.setattr(legion_handler, 'WARMUP', warmup)
+
+    assert handler_client.get('/ready').status_code == 503
+
+    del calls[:]
+    warmup.start(background=False)
+    response = handler_client.get('/ready')
+
+    assert calls == [1, 1, 1]
+    assert response.status_code == 200
+    assert response.json['ready'] is True
+    assert response.json['iterations'] == 3
+    assert response.json['duration'] >= 0
+    assert response.json['error'] is None
+
+
+def test_admission_control_sheds_requests(handler_client, legion_handler, monkeypatch):
+    admission = legion_handler.AdmissionController(max_queue_depth=1, max_wait=0, concurrency=1)
+    monkeypatch.setattr(legion_handler, 'ADMISSION', admission)
+    body = json.dumps({'columns': ['a', 'b'], 'data': [[1, 2]]})
+
+    with admission.admit():
+        response = handler_client.post('/api/model/invoke', data=body)
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert 'queue_depth' in response.json['message']
+    assert handler_client.post('/api/model/invoke', data=body).status_code == 200
+    assert admission.admitted == 0
+    assert 'legion_model_requests_shed_total{model_name="",model_version="",reason="queue_depth"}' in \
+        handler_client.get('/metrics').data.decode('utf-8')
+
+
+def test_admission_control_estimated_wait(legion_handler):
+    admission = legion_handler.AdmissionController(max_queue_depth=0, max_wait=0.5, concurrency=2)
+    admission.latency = 3.0
+
+    with admission.admit():
+        with pytest.raises(legion_handler.AdmissionRejected) as rejection:
+            with admission.admit():
+                pass
+
+    assert rejection.value.reason == 'estimated_wait'
+    assert rejection.value.retry_after == 2
+    assert admission.admitted == 0
+
+
+def test_expired_deadline_skips_prediction(handler_client, legion_handler):
+    calls = legion_handler.legion_model.entrypoint.CALLS
+    del calls[:]
+    body = json.dumps({'columns': ['a', 'b'], 'data': [[1, 2]]})
+
+    response = handler_client.post('/api/model/invoke', data=body, headers={'Request-Timeout-Ms': '0'})
+    assert response.status_code == 504
+    response = handler_client.post('/api/model/invoke', data=body, headers={'Request-Deadline': str(time.time() - 1)})
+    assert response.status_code == 504
+    assert calls == []
+
+    response = handler_client.post('/api/model/invoke', data=body, headers={'Request-Timeout-Ms': '10000'})
+    assert response.status_code == 200
+    assert calls == [1]
+    assert 'legion_model_requests_expired_total{model_name="",model_version=""} 2.0' in \
+        handler_client.get('/metrics').data.decode('utf-8')
+
+
+def test_micro_batcher_drops_expired_items(legion_handler):
+    calls = []
+
+    def predict(matrix, provided_columns_names=None):
+        calls.append(len(matrix))
+        return legion_handler.legion_model.entrypoint.predict_on_matrix(matrix, provided_columns_names)
+
+    batcher = legion_handler.MicroBatcher(predict, max_size=100, max_wait=0.01)
+
+    with pytest.raises(legion_handler.DeadlineExceeded):
+        batcher.predict([[1, 2]], deadline=time.monotonic() - 1)
+    assert batcher.predict([[1, 2]], deadline=time.monotonic() + 10) == ([[3]], ('sum',))
+    assert calls == [1]
+
+
+def test_model_client_sends_timeout_as_deadline():
+    assert ModelClient(timeout=1.5)._invoke_kwargs['headers'] == {'Request-Timeout-Ms': '1500'}
+    assert ModelClient(timeout=(3, 2))._invoke_kwargs['headers'] == {'Request-Timeout-Ms': '2000'}
+    assert 'headers' not in ModelClient()._invoke_kwargs
+
+
+def get_codec(encoding):
+    """
+    Get compress and decompress functions of the encoding (zstd tests are skipped without zstandard)
+    """
+    if encoding == ZSTD_ENCODING:
+        zstandard = pytest.importorskip('zstandard')
+        return zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+    return gzip.compress, gzip.decompress
+
+
+@pytest.mark.parametrize('encoding', [GZIP_ENCODING, ZSTD_ENCODING])
+def test_compressed_invoke(handler_client, encoding):
+    compress, decompress = get_codec(encoding)
+    data = [[index, index] for index in range(1000)]
+    body = compress(json.dumps({'columns': ['a', 'b'], 'data': data}).encode('utf-8'))
+
+    response = handler_client.post('/api/model/invoke', data=body, content_type='application/json',
+                                   headers={'Content-Encoding': encoding, 'Accept-Encoding': encoding})
+
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == encoding
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert json.loads(decompress(response.data))['prediction'][999] == [1998]
+
+
+def test_small_response_is_not_compressed(handler_client):
+    response = handler_client.post('/api/model/invoke', data=json.dumps({'columns': ['a', 'b'], 'data': [[1, 2]]}),
+                                   headers={'Accept-Encoding': 'gzip'})
+
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
+
+
+def test_unsupported_content_encoding(handler_client):
+    response = handler_client.post('/api/model/invoke', data=b'data', headers={'Content-Encoding': 'br'})
+
+    assert response.status_code == 500
+    assert 'Unsupported Content-Encoding' in response.json['message']
+
+
+@pytest.mark.parametrize('encoding', [GZIP_ENCODING, ZSTD_ENCODING])
+def test_model_client_compression(handler_client, encoding):
+    get_codec(encoding)
+    client = ModelClient(url='', http_client=handler_client, compression=encoding)
+    response = client.invoke(columns=['a', 'b'], data=[[index, 1] for index in range(1000)])
+
+    assert response['prediction'][999] == [1000]
+
+
+def test_model_client_compresses_by_default(handler_client):
+    sent_headers = []
+
+    class RecordingClient:
+        @staticmethod
+        def post(url, **kwargs):
+            sent_headers.append(kwargs.get('headers', {}))
+            return handler_client.post(url, **kwargs)
+
+    client = ModelClient(url='', http_client=RecordingClient)
+    response = client.invoke(columns=['a', 'b'], data=[[index, 1] for index in range(1000)])
+    client.invoke(columns=['a', 'b'], data=[[1, 1]])
+    ModelClient(url='', http_client=RecordingClient, compression=None).invoke(
+        columns=['a', 'b'], data=[[index, 1] for index in range(1000)]
+    )
+
+    assert response['prediction'][999] == [1000]
+    assert [headers.get('Content-Encoding') for headers in sent_headers] == [GZIP_ENCODING, None, None]
+
+
+def test_decompression_bomb_is_rejected(handler_client, legion_handler, monkeypatch):
+    monkeypatch.setattr(legion_handler, 'MAX_DECOMPRESSED_SIZE', 1000)
+    body = gzip.compress(json.dumps({'columns': ['a', 'b'], 'data': [[1, 1]] * 1000}).encode('utf-8'))
+
+    response = handler_client.post('/api/model/invoke', data=body, headers={'Content-Encoding': 'gzip'})
+    batch = handler_client.post('/api/model/batch', data=body, headers={'Content-Encoding': 'gzip'})
+    stream = handler_client.post('/api/model/stream', data=gzip.compress(b'[1, 1]\n' + b' ' * 2000 + b'[1, 1]\n'),
+                                 headers={'Content-Encoding': 'gzip'})
+
+    assert len(body) < 1000
+    assert response.status_code == 413
+    assert 'exceeds 1000 bytes' in response.json['message']
+    assert batch.status_code == 413
+    assert stream.status_code == 413
+
+
+def test_decompressed_body_within_limit(legion_handler, monkeypatch):
+    monkeypatch.setattr(legion_handler, 'MAX_DECOMPRESSED_SIZE', 1000)
+    monkeypatch.setattr(legion_handler, 'DECOMPRESSION_CHUNK_SIZE', 7)
+
+    # Members of multi-member gzip are concatenated
+    assert legion_handler.decode_request_body(gzip.compress(b'a' * 500) + gzip.compress(b'b' * 500), 'gzip') == \
+        b'a' * 500 + b'b' * 500
+    with pytest.raises(ValueError):
+        legion_handler.decode_request_body(b'not gzip', 'gzip')
+
+
+def test_objects_mode_rejects_binary_formats(handler_client, legion_handler, monkeypatch):
+    monkeypatch.setattr(legion_handler, 'SUPPORTED_PREDICTION_MODE', 'objects')
+    body, headers = encode_matrix([[1, 2]], ['a', 'b'], NPY_FORMAT)
+
+    response = handler_client.post('/api/model/invoke', data=body, headers=headers, content_type=NPY_FORMAT)
+
+    assert response.status_code == 415
+    assert 'objects mode' in response.json['message']
+    assert legion_handler.handle_prediction_on_objects({'data': numpy.array([[1, 2]])}).status_code == 500
+
+
+def test_records_to_columns(legion_handler):
+    columns = legion_handler.records_to_columns([{'a': 1, 'b': 2}, {'b': 4, 'a': 3}, {'a': 5}], ('a', 'b'))
+
+    assert columns['a'].tolist() == [1, 3, 5]
+    assert columns['b'].tolist() == [2, 4, None]
+    assert legion_handler.records_to_columns([{'a': 1}, {'a': 2}], ('a',))['a'].tolist() == [1, 2]
+    with pytest.raises(ValueError):
+        legion_handler.records_to_columns([{'a': 1}, [1]], ('a',))
+
+
+@pytest.mark.parametrize('input_type', [list, dict])
+def test_invoke_objects(handler_client, legion_handler, monkeypatch, input_type):
+    monkeypatch.setattr(legion_handler, 'SUPPORTED_PREDICTION_MODE', 'objects')
+    monkeypatch.setattr(legion_handler, 'get_object_input_type', lambda: input_type)
+
+    response = handler_client.post('/api/model/invoke', data=json.dumps([{'a': 1, 'b': 2}, {'b': 3, 'a': 4}]),
+                                   headers={'Accept': 'application/x-npy'})
+
+    assert response.status_code == 200
+    assert response.mimetype == 'application/json'
+    assert response.json == {'prediction': [{'sum': 3}, {'sum': 7}]}
+    assert handler_client.post('/api/model/invoke', data=json.dumps({'data': [1, 2]})).status_code == 500
+
+
+@pytest.mark.parametrize('input_type, column_type', [(list, list), (dict, numpy.ndarray)])
+def test_objects_are_always_columnar(legion_handler, monkeypatch, input_type, column_type):
+    received = []
+    monkeypatch.setattr(legion_handler, 'get_object_input_type', lambda: input_type)
+    monkeypatch.setattr(legion_handler.legion_model.entrypoint, 'predict_on_objects',
+                        lambda objects: received.append(objects) or [])
+
+    legion_handler.handle_prediction_on_objects([{'b': 2, 'a': 1}, {'a': 3}])
+
+    assert list(received[0]) == ['a', 'b']
+    assert isinstance(received[0]['a'], column_type)
+    assert list(received[0]['b']) == [2, None]
+
+
+def test_inference_pool(legion_handler):
+    legion_handler_pool = importlib.import_module('legion_handler_pool')
+    pool = legion_handler_pool.InferencePool('legion_model.entrypoint', 2)
+    try:
+        prediction, columns = pool.predict([[1, 2], [3, 4]], ['a', 'b'])
+        assert numpy.asarray(prediction).tolist() == [[3], [7]]
+        assert columns == ['sum']
+
+        with pytest.raises(Exception) as error:
+            pool.predict([[None, None]])
+        assert 'unsupported operand' in str(error.value)
+    finally:
+        pool.close()
+
+
+def test_inference_pool_pickles_non_numeric_matrices(legion_handler):
+    legion_handler_pool = importlib.import_module('legion_handler_pool')
+
+    for matrix in ([[1, 'a'], [2.5, None]], [['a', 'b']], [[1, 2], [3]]):
+        assert legion_handler_pool.encode_array(matrix) == ((legion_handler_pool.PICKLED, matrix), None)
+
+
+def test_inference_process_accepts_missing_columns(legion_handler, monkeypatch):
+    legion_handler_pool = importlib.import_module('legion_handler_pool')
+    entrypoint = types.ModuleType('columnless_entrypoint')
+    entrypoint.init = lambda: 'matrix'
+    # Non-numeric prediction is pickled, so the result does not reference a shared memory block
+    entrypoint.predict_on_matrix = lambda matrix, provided_columns_names=None: ([['x']], None)
+    monkeypatch.setitem(sys.modules, 'columnless_entrypoint', entrypoint)
+    tasks, results = queue.Queue(), queue.Queue()
+    tasks.put((7, (legion_handler_pool.PICKLED, [['a']]), None))
+    tasks.put(None)
+
+    legion_handler_pool.run_inference_process('columnless_entrypoint', tasks, results)
+
+    assert results.get_nowait() == (7, (legion_handler_pool.PICKLED, [['x']]), None)
+
+
+def test_inference_pool_timeout(legion_handler, monkeypatch):
+    legion_handler_pool = importlib.import_module('legion_handler_pool')
+    pool = legion_handler_pool.InferencePool('legion_model.entrypoint', 1, timeout=0.05)
+    # Inference process that never answers
+    monkeypatch.setattr(pool, 'start', lambda: None)
+    monkeypatch.setattr(pool, '_tasks', queue.Queue())
+
+    with pytest.raises(TimeoutError):
+        pool.predict([['a']])
+    with pytest.raises(TimeoutError):
+        pool.predict([['a']], deadline=time.monotonic())
+    assert pool._futures == {}
+
+
+def test_inference_pool_pickles_without_shared_memory_space(legion_handler, monkeypatch):
+    legion_handler_pool = importlib.import_module('legion_handler_pool')
+
+    def allocate(create, size):
+        raise OSError('No space left on device')
+
+    monkeypatch.setattr(legion_handler_pool, 'shared_memory', types.SimpleNamespace(SharedMemory=allocate))
+
+    assert not legion_handler_pool.has_shared_memory_space(2 ** 62)
+    assert legion_handler_pool.encode_array([[1, 2]]) == ((legion_handler_pool.PICKLED, [[1, 2]]), None)
+    monkeypatch.setattr(legion_handler_pool, 'has_shared_memory_space', lambda size: False)
+    assert legion_handler_pool.encode_array([[1, 2]]) == ((legion_handler_pool.PICKLED, [[1, 2]]), None)
+
+
+def test_grpc_predict(legion_handler):
+    pytest.importorskip('grpc')
+    from legion.sdk.clients.model_grpc import GrpcModelClient
+    legion_handler_grpc = importlib.import_module('legion_handler_grpc')
+
+    server = legion_handler_grpc.build_server(0, 2)
+    port = server.add_insecure_port('127.0.0.1:0')
+    server.start()
+    client = GrpcModelClient(f'127.0.0.1:{port}', timeout=10)
+    try:
+        response = client.invoke(data=[[1, 2], [3, 4]], columns=['a', 'b'])
+        assert response['prediction'].tolist() == [[3], [7]]
+        assert response['columns'] == ['sum']
+
+        responses = list(client.invoke_stream({'data': [[index, 1]], 'columns': ['a', 'b']} for index in range(3)))
+        assert [response['prediction'].tolist() for response in responses] == [[[1]], [[2]], [[3]]]
+    finally:
+        client.close()
+        server.stop(None)
+
+
+@pytest.mark.parametrize('matrix, columns', [
+    (numpy.array([[1.5, -2], [3, 4]]), ['a', 'b']),
+    (numpy.array([[-1, 2 ** 40]], dtype=numpy.int64), None),
+    (numpy.zeros((0, 3), dtype=numpy.float32), ['x', 'y', 'z']),
+])
+def test_grpc_codec_matches_protobuf(tmpdir, matrix, columns):
+    """
+    Hand-written codec of model_grpc has to stay wire compatible with legion_model_service.proto
+    """
+    protoc = pytest.importorskip('grpc_tools.protoc')
+    from legion.packager.rest.constants import RESOURCES_FOLDER, GRPC_SERVICE_DEFINITION
+    from legion.sdk.clients.model_grpc import encode_matrix_message, decode_matrix_message
+
+    assert protoc.main(['protoc', f'-I{RESOURCES_FOLDER}', f'--python_out={tmpdir}',
+                        os.path.join(RESOURCES_FOLDER, GRPC_SERVICE_DEFINITION)]) == 0
+    sys.path.insert(0, str(tmpdir))
+    try:
+        service = importlib.import_module(os.path.splitext(GRPC_SERVICE_DEFINITION)[0] + '_pb2')
+    finally:
+        sys.path.remove(str(tmpdir))
+        sys.modules.pop(os.path.splitext(GRPC_SERVICE_DEFINITION)[0] + '_pb2', None)
+
+    tensor = service.Tensor(shape=matrix.shape, dtype=matrix.dtype.str, data=matrix.tobytes())
+    for message in (service.PredictRequest(data=tensor, columns=columns),
+                    service.PredictResponse(prediction=tensor, columns=columns)):
+        assert encode_matrix_message(matrix, columns) == message.SerializeToString()
+
+        decoded, decoded_columns = decode_matrix_message(message.SerializeToString())
+        assert decoded.dtype == matrix.dtype and decoded.shape == matrix.shape
+        assert decoded.tolist() == matrix.tolist()
+        assert decoded_columns == columns
+
+    parsed = service.PredictRequest.FromString(encode_matrix_message(matrix, columns))
+    assert list(parsed.data.shape) == list(matrix.shape)
+    assert parsed.data.dtype == matrix.dtype.str
+    assert list(parsed.columns) == (columns or [])
+
+
+def test_grpc_client_does_not_log_token(caplog):
+    pytest.importorskip('grpc')
+    from legion.sdk.clients.model_grpc import GrpcModelClient
+
+    with caplog.at_level('DEBUG'):
+        GrpcModelClient('127.0.0.1:1', token='secret-token').close()
+    assert 'secret-token' not in caplog.text
+
+
+def test_input_schema_coerces_columns(legion_handler):
+    input_schema, _ = legion_handler.legion_model.entrypoint.info()
+    schema = legion_handler.InputSchema.from_info(input_schema)
+
+    matrix = schema.coerce([[1, '2'], [3, 4]], ['b', 'a'])
+    assert matrix.dtype == numpy.int64
+    assert matrix.tolist() == [[1, 2], [3, 4]]
+
+    # Missing values of optional integer column are NaN
+    assert numpy.isnan(schema.coerce([[1, None]])[0, 1])
+
+
+@pytest.mark.parametrize('matrix, columns, message', [
+    ([[1]], None, 'Every row has to contain 2 values'),
+    ([[1, 2], [3]], None, 'Every row has to contain 2 values'),
+    ([[None, 2]], None, 'Column a is required'),
+    ([[1.5, 2]], None, 'Column a has to contain integer values'),
+    ([['x', 2]], None, 'Column a has to contain numbers'),
+    ([[1, 2]], ['a', 'c'], 'Unknown columns: c'),
+    ([[2]], ['b'], 'Required columns are not provided: a'),
+])
+def test_input_schema_rejects_malformed_matrix(legion_handler, matrix, columns, message):
+    input_schema, _ = legion_handler.legion_model.entrypoint.info()
+
+    with pytest.raises(legion_handler.InputValidationError) as error:
+        legion_handler.InputSchema.from_info(input_schema).coerce(matrix, columns)
+    assert message in str(error.value)
+
+
+def test_invalid_input_does_not_reach_model(handler_client, legion_handler, monkeypatch):
+    input_schema, _ = legion_handler.legion_model.entrypoint.info()
+    monkeypatch.setattr(legion_handler, 'INPUT_SCHEMA', legion_handler.InputSchema.from_info(input_schema))
+    calls = legion_handler.legion_model.entrypoint.CALLS
+    calls_count = len(calls)
+
+    response = handler_client.post('/api/model/invoke', json={'data': [[1, 'x']]})
+    assert response.status_code == 500
+    assert response.json['message'].startswith('Invalid input: Column b')
+    assert len(calls) == calls_count
+
+    response = handler_client.post('/api/model/invoke', json={'data': [['3', 4]], 'columns': ['a', 'b']})
+    assert response.json == {'prediction': [[7]], 'columns': ['sum']}
+
+
+def test_reorder_columns(legion_handler):
+    legion_handler.get_column_permutation.cache_clear()
+
+    assert legion_handler.reorder_columns([[1, 2], [3, 4]], ['b', 'a']) == [[2, 1], [4, 3]]
+    assert legion_handler.reorder_columns(numpy.array([[1, 2]]), ['b', 'a']).tolist() == [[2, 1]]
+    assert legion_handler.reorder_columns([[5, 6]], ['b', 'a']) == [[6, 5]]
+    assert legion_handler.get_column_permutation.cache_info().misses == 1
+
+    with pytest.raises(legion_handler.InputValidationError) as error:
+        legion_handler.reorder_columns([[1, 2]], ['a', 'c'])
+    assert str(error.value) == 'Unknown columns: c; Columns are not provided: b'
+
+    with pytest.raises(legion_handler.InputValidationError):
+        legion_handler.reorder_columns([[1, 2, 3]], ['b', 'a'])
+
+
+def test_invoke_with_reordered_columns(handler_client, legion_handler, monkeypatch):
+    monkeypatch.setattr(legion_handler, 'REORDER_COLUMNS', True)
+    monkeypatch.setattr(legion_handler, 'PREDICT_FUNCTION',
+                        lambda matrix, provided_columns_names: ([list(row) for row in matrix], provided_columns_names))
+
+    response = handler_client.post('/api/model/invoke', json={'data': [[1, 2]], 'columns': ['b', 'a']})
+    assert response.json == {'prediction': [[2, 1]], 'columns': ['a', 'b']}
+
+    response = handler_client.post('/api/model/invoke', json={'data': [[1]], 'columns': ['b']})
+    assert response.json['message'] == 'Invalid input: Columns are not provided: a'
+
+
+def read_prediction_log(path):
+    with gzip.open(path) as stream:
+        return [json.loads(line) for line in stream]
+
+
+def test_prediction_log_batches(legion_handler, tmpdir):
+    legion_handler_log = importlib.import_module('legion_handler_log')
+    path = str(tmpdir.join('predictions.ndjson.gz'))
+    prediction_log = legion_handler_log.PredictionLog(legion_handler_log.build_sink(path),
+                                                      legion_handler.JSON_CODEC.dumps, 10 ** 6, batch_size=2)
+
+    for index in range(5):
+        prediction_log.record(str(index), {'data': numpy.array([[index, 1]])}, {'prediction': [[index + 1]]}, 0.01)
+    prediction_log.close()
+
+    records = read_prediction_log(path)
+    assert [record['request_id'] for record in records] == ['0', '1', '2', '3', '4']
+    assert records[2]['input'] == {'data': [[2, 1]]}
+    assert records[2]['output'] == {'prediction': [[3]]}
+    assert prediction_log.stats() == {'written': 5, 'dropped': {}, 'queued': 0, 'queued_bytes': 0}
+
+
+def test_prediction_log_drops_records_when_queue_is_full(legion_handler, tmpdir):
+    legion_handler_log = importlib.import_module('legion_handler_log')
+    sink_blocked = threading.Event()
+    release_sink = threading.Event()
+
+    class BlockingSink:
+        def write(self, data):
+            sink_blocked.set()
+            release_sink.wait(5)
+
+        def close(self):
+            pass
+
+    # Every record takes 10 bytes (with line separator), the queue fits 3 of them
+    prediction_log = legion_handler_log.PredictionLog(BlockingSink(), lambda record: b'x' * 9, 30, batch_size=1)
+    prediction_log.record('first', {}, {}, 0.0)
+    assert sink_blocked.wait(5)
+
+    start = time.perf_counter()
+    for index in range(5):
+        prediction_log.record(str(index), {}, {}, 0.0)
+    assert time.perf_counter() - start < 0.5
+    assert prediction_log.stats()['dropped'] == {'queue_full': 3}
+
+    release_sink.set()
+    prediction_log.close()
+    assert prediction_log.stats()['written'] == 3
+    assert prediction_log.stats()['queued_bytes'] == 0
+
+
+def test_prediction_log_counts_unserializable_records(legion_handler, tmpdir):
+    legion_handler_log = importlib.import_module('legion_handler_log')
+    path = str(tmpdir.join('predictions.ndjson.gz'))
+    prediction_log = legion_handler_log.PredictionLog(legion_handler_log.FileSink(path), json.dumps, 10 ** 6)
+
+    prediction_log.record('first', {'data': object()}, {}, 0.0)
+    prediction_log.close()
+
+    assert prediction_log.stats()['dropped'] == {'serialization': 1}
+
+
+def test_invoke_is_logged(handler_client, legion_handler, monkeypatch, tmpdir):
+    legion_handler_log = importlib.import_module('legion_handler_log')
+    path = str(tmpdir.join('predictions.ndjson.gz'))
+    prediction_log = legion_handler_log.PredictionLog(legion_handler_log.FileSink(path),
+                                                      legion_handler.JSON_CODEC.dumps, 10 ** 6)
+    monkeypatch.setattr(legion_handler, 'PREDICTION_LOG', prediction_log)
+
+    handler_client.post('/api/model/invoke', json={'columns': ['a', 'b'], 'data': [[1, 2]]},
+                        headers={'x-request-id': 'abc'})
+    prediction_log.close()
+
+    record, = read_prediction_log(path)
+    assert record['request_id'] == 'abc'
+    assert record['input'] == {'columns': ['a', 'b'], 'data': [[1, 2]]}
+    assert record['output'] == {'prediction': [[3]], 'columns': ['sum']}
+    assert record['latency'] > 0
+
+
+def test_profiler(handler_client, legion_handler, monkeypatch):
+    assert handler_client.get('/api/model/profile').status_code == 404
+
+    monkeypatch.setattr(legion_handler, 'PROFILER_TOKEN_SHA256', hashlib.sha256(b'secret').hexdigest())
+    assert handler_client.get('/api/model/profile').status_code == 401
+    assert handler_client.get('/api/model/profile', headers={'Profiler-Token': 'wrong'}).status_code == 401
+    assert handler_client.get('/api/model/profile?seconds=600', headers={'Profiler-Token': 'secret'}).status_code == 400
+
+    stop = threading.Event()
+
+    def busy_model():
+        while not stop.is_set():
+            legion_handler.legion_model.entrypoint.predict_on_matrix([[1, 2]] * 1000)
+
+    thread = threading.Thread(target=busy_model)
+    thread.start()
+    try:
+        response = handler_client.get('/api/model/profile?seconds=0.2&interval_ms=5',
+                                      headers={'Profiler-Token': 'secret'})
+    finally:
+        stop.set()
+        thread.join()
+
+    assert response.status_code == 200
+    assert int(response.headers['Profile-Samples']) > 0
+    lines = response.get_data(as_text=True).splitlines()
+    assert any('test_handler:busy_model;legion_model.entrypoint:predict_on_matrix' in line for line in lines)
+    assert all(line.rsplit(' ', 1)[1].isdigit() for line in lines)
+
+
+def test_native_thread_limits_in_info(handler_client, legion_handler, monkeypatch):
+    monkeypatch.setenv('OMP_NUM_THREADS', '2')
+    monkeypatch.delenv('MKL_NUM_THREADS', raising=False)
+    legion_handler.get_info_document.cache_clear()
+    try:
+        limits = handler_client.get('/api/model/info').json['x-native-thread-limits']
+    finally:
+        legion_handler.get_info_document.cache_clear()
+
+    assert limits['OMP_NUM_THREADS'] == 2
+    assert limits['MKL_NUM_THREADS'] is None
+
+
+def test_batch_invoke(handler_client, legion_handler):
+    calls = legion_handler.legion_model.entrypoint.CALLS
+    calls.clear()
+    client = ModelClient(url='', http_client=handler_client)
+
+    results = client.invoke_batch([
+        {'columns': ['a', 'b'], 'data': [[1, 2]]},
+        {'columns': ['b', 'a'], 'data': numpy.array([[3, 4]])},
+        {'columns': ['a', 'b'], 'data': [[5, 6], [7, 8]]},
+        {'columns': ['a', 'b']}
+    ])
+
+    assert results == [
+        {'prediction': [[3]], 'columns': ['sum']},
+        {'prediction': [[7]], 'columns': ['sum']},
+        {'prediction': [[11], [15]], 'columns': ['sum']},
+        {'error': 'Matrix is not provided'}
+    ]
+    # Matrices with the same columns are predicted at once
+    assert sorted(calls) == [1, 3]
+
+
+def test_batch_invoke_isolates_failed_items(handler_client, legion_handler):
+    calls = legion_handler.legion_model.entrypoint.CALLS
+    calls.clear()
+
+    response = handler_client.post('/api/model/batch', json=[{'data': [[1, 2]]}, {'data': [[1, 'x']]}])
+
+    assert response.status_code == 200
+    assert response.json[0] == {'prediction': [[3]], 'columns': ['sum']}
+    assert response.json[1]['error'].startswith('Exception during prediction: ')
+    assert calls == [2, 1, 1]
+
+
+def test_batch_invoke_requires_list(handler_client):
+    response = handler_client.post('/api/model/batch', json={'data': [[1, 2]]})
+
+    assert response.status_code == 500
+    assert response.json['message'] == 'List of invoke payloads is expected'
@@ -0,0 +1,175 @@
+#
+#    Copyright 2019 EPAM Systems
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+import importlib
+import itertools
+import json
+import os
+import shutil
+import sys
+import threading
+import weakref
+
+import pydantic
+import pytest
+
+from legion.packager.rest.constants import RESOURCES_FOLDER, HANDLER_MULTI_MODULE, ENTRYPOINT_DOCKER_TEMPLATE
+from legion.packager.rest.data_models import PackagingResourceArguments
+from legion.packager.rest.pipeline import work
+from legion.sdk.clients.model import encode_matrix, NPY_FORMAT
+
+TEST_MODEL_FOLDER = os.path.join(os.path.dirname(__file__), 'resources')
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def multi_handler(monkeypatch, tmpdir):
+    """
+    Import multi-model host with two copies of the test model, every load takes 5 MB and budget fits one model
+    """
+    monkeypatch.syspath_prepend(RESOURCES_FOLDER)
+    module = importlib.import_module(HANDLER_MULTI_MODULE)
+
+    for name in ('first', 'second'):
+        shutil.copytree(TEST_MODEL_FOLDER, str(tmpdir.join(name)))
+
+    memory = itertools.count(step=5 * MB)
+    monkeypatch.setattr(module, 'get_process_memory', lambda: next(memory))
+    monkeypatch.setattr(module, 'HOST', module.ModelHost(str(tmpdir), memory_budget=8 * MB))
+    return module
+
+
+def count_threads(name):
+    return [thread.name for thread in threading.enumerate()].count(name)
+
+
+def invoke(client, name):
+    return client.post(f'/api/models/{name}/invoke', data=json.dumps({'columns': ['a', 'b'], 'data': [[1, 2]]}))
+
+
+def test_models_are_loaded_lazily(multi_handler):
+    client = multi_handler.app.test_client()
+
+    assert client.get('/api/models').json['loaded'] == []
+
+    response = invoke(client, 'first')
+    assert response.status_code == 200
+    assert response.json == {'prediction': [[3]], 'columns': ['sum']}
+
+    stats = client.get('/api/models').json
+    assert stats['models'] == ['first', 'second']
+    assert [model['name'] for model in stats['loaded']] == ['first']
+    assert stats['memory'] == 5 * MB
+
+
+def test_models_are_isolated(multi_handler):
+    multi_handler.HOST.memory_budget = 0
+    first = multi_handler.HOST.get('first')
+    second = multi_handler.HOST.get('second')
+
+    assert first.entrypoint is not second.entrypoint
+    assert first.entrypoint.CALLS is not second.entrypoint.CALLS
+
+
+def test_least_recently_used_model_is_evicted(multi_handler):
+    client = multi_handler.app.test_client()
+
+    assert invoke(client, 'first').status_code == 200
+    assert invoke(client, 'second').status_code == 200
+    assert invoke(client, 'first').status_code == 200
+
+    stats = client.get('/api/models').json
+    assert [model['name'] for model in stats['loaded']] == ['first']
+    assert stats['evictions'] == 2
+    suffix = multi_handler.get_module_suffix('second')
+    assert f'legion_models_{suffix}.entrypoint' not in sys.modules
+    assert f'legion_handlers_{suffix}' not in sys.modules
+    assert os.environ.get('MODEL_LOCATION') is None
+
+
+def test_evicted_model_is_garbage_collected(multi_handler, monkeypatch, tmpdir):
+    monkeypatch.setattr(multi_handler, 'HOST', multi_handler.ModelHost(
+        multi_handler.HOST.location, multi_handler.HOST.memory_budget, str(tmpdir.mkdir('metrics'))
+    ))
+    monkeypatch.setenv('LEGION_BATCH_MAX_SIZE', '4')
+    monkeypatch.setenv('LEGION_PREDICTION_LOG', str(tmpdir.join('predictions.ndjson.gz')))
+    client = multi_handler.app.test_client()
+    threads = {name: count_threads(name)
+               for name in ('legion-micro-batcher', 'legion-prediction-log', 'legion-metrics-flusher')}
+
+    # Requests start micro batcher, prediction log and metrics flusher threads of the handler
+    assert invoke(client, 'first').status_code == 200
+    entrypoint = weakref.ref(multi_handler.HOST.get('first').entrypoint)
+    assert invoke(client, 'second').status_code == 200
+
+    assert entrypoint() is None
+    # Only threads of the second model are running
+    assert {name: count_threads(name) - count for name, count in threads.items()} == {
+        'legion-micro-batcher': 1, 'legion-prediction-log': 1, 'legion-metrics-flusher': 1
+    }
+
+
+def test_model_names_do_not_clash(multi_handler):
+    assert multi_handler.get_module_suffix('a-b') != multi_handler.get_module_suffix('a.b')
+
+
+def test_metrics_ready_and_stream(multi_handler):
+    multi_handler.HOST.memory_budget = 0
+    client = multi_handler.app.test_client()
+
+    assert client.get('/ready').status_code == 200
+    assert invoke(client, 'first').status_code == 200
+    assert invoke(client, 'second').status_code == 200
+    response = client.post('/api/models/second/stream', data='[1, 2]\n[3, 4]\n',
+                           headers={'Data-Columns': '["a", "b"]'})
+    assert response.data == b'[3]\n[7]\n'
+    response.close()
+    text = client.get('/metrics').data.decode('utf-8')
+
+    assert text.count('# TYPE legion_model_request_seconds histogram') == 1
+    assert 'legion_model_request_seconds_count{model_name="first",model_version=""} 1.0' in text
+    assert 'legion_model_request_seconds_count{model_name="second",model_version=""} 2.0' in text
+    assert client.get('/ready').json['models']['first']['ready'] is True
+    assert client.get('/api/models/first/ready').status_code == 200
+
+
+def test_unknown_model(multi_handler):
+    response = invoke(multi_handler.app.test_client(), 'third')
+
+    assert response.status_code == 404
+
+
+def test_models_use_handler_formats(multi_handler):
+    client = multi_handler.app.test_client()
+    body, headers = encode_matrix([[1, 2], [3, 4]], ['a', 'b'], NPY_FORMAT)
+    response = client.post('/api/models/first/invoke', data=body, headers=headers, content_type=NPY_FORMAT)
+
+    assert response.status_code == 200
+    assert response.json['prediction'] == [[3], [7]]
+    assert client.get('/api/models/first/info').json['swagger'] == '2.0'
+
+
+def test_models_location_option(tmpdir):
+    output = str(tmpdir.join('output'))
+    work(TEST_MODEL_FOLDER, output, conda_env='create', ignore_conda=True, conda_env_name='test-env',
+         dockerfile=True, arguments=PackagingResourceArguments(modelsLocation='/models', modelsMemoryBudgetMb=512))
+    with open(os.path.join(output, ENTRYPOINT_DOCKER_TEMPLATE)) as stream:
+        entrypoint = stream.read()
+
+    assert 'LEGION_MODELS_LOCATION=/models' in entrypoint
+    assert 'LEGION_MODELS_MEMORY_BUDGET_MB=512' in entrypoint
+    assert 'legion_handler_multi:app' in entrypoint
+    with pytest.raises(pydantic.ValidationError):
+        PackagingResourceArguments(modelsLocation='/models', serverMode='asgi')
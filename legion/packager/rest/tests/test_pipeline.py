@@ -0,0 +1,214 @@
+#
+#    Copyright 2019 EPAM Systems
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+import hashlib
+import os
+import subprocess
+import sys
+
+import pydantic
+import pytest
+
+from legion.packager.rest.autotune import choose_native_threads, read_cpu_limit
+from legion.packager.rest.constants import ENTRYPOINT_DOCKER_TEMPLATE, DOCKERFILE_TEMPLATE, DESCRIPTION_TEMPLATE
+from legion.packager.rest.data_models import PackagingResourceArguments
+from legion.packager.rest import pipeline
+from legion.packager.rest.pipeline import work
+
+TEST_MODEL_FOLDER = os.path.join(os.path.dirname(__file__), 'resources')
+
+
+def pack(output_folder, **arguments) -> str:
+    """
+    Pack the test model without conda and return folder with results
+    """
+    target = os.path.join(str(output_folder), 'output')
+    work(TEST_MODEL_FOLDER, target, conda_env='create', ignore_conda=True, conda_env_name='test-env',
+         dockerfile=True, arguments=PackagingResourceArguments(**arguments))
+    return target
+
+
+def read(folder, file_name) -> str:
+    with open(os.path.join(folder, file_name)) as stream:
+        return stream.read()
+
+
+def test_wsgi_server_mode(tmpdir):
+    output = pack(tmpdir, workers=2, threads=8)
+    entrypoint = read(output, ENTRYPOINT_DOCKER_TEMPLATE)
+
+    assert '-w 2 \\\n    --threads 8 \\\n    legion_handler:app' in entrypoint
+    assert '-k ' not in entrypoint
+    assert os.path.exists(os.path.join(output, 'legion_handler_asgi.py'))
+
+
+def test_asgi_server_mode(tmpdir):
+    output = pack(tmpdir, serverMode='asgi', threads=8)
+    entrypoint = read(output, ENTRYPOINT_DOCKER_TEMPLATE)
+    dockerfile = read(output, DOCKERFILE_TEMPLATE)
+
+    assert '-k uvicorn.workers.UvicornWorker \\\n    legion_handler_asgi:app' in entrypoint
+    assert 'LEGION_PREDICT_THREADS=8' in entrypoint
+    assert 'uvicorn starlette' in dockerfile
+    assert 'legion_handler_asgi.py' in dockerfile
+
+
+def test_unknown_server_mode():
+    with pytest.raises(pydantic.ValidationError):
+        PackagingResourceArguments(serverMode='cgi')
+
+
+def test_max_queue_depth_requires_asgi_mode():
+    with pytest.raises(pydantic.ValidationError):
+        PackagingResourceArguments(maxQueueDepth=10)
+
+    assert PackagingResourceArguments(serverMode='asgi', maxQueueDepth=10).maxQueueDepth == 10
+
+
+def test_json_codec_is_installed(tmpdir):
+    output = pack(tmpdir, jsonCodec='orjson')
+
+    assert 'LEGION_JSON_CODEC=orjson' in read(output, ENTRYPOINT_DOCKER_TEMPLATE)
+    assert 'pip install gunicorn[gevent] orjson' in read(output, DOCKERFILE_TEMPLATE)
+
+
+def test_zstd_compression_is_optional(tmpdir):
+    assert 'zstandard' not in read(pack(tmpdir.mkdir('gzip')), DOCKERFILE_TEMPLATE)
+    assert 'pip install gunicorn[gevent] zstandard' in read(pack(tmpdir.mkdir('zstd'), zstdCompression=True),
+                                                            DOCKERFILE_TEMPLATE)
+
+
+def test_preload(tmpdir):
+    entrypoint = read(pack(tmpdir, preload=True, workers=4), ENTRYPOINT_DOCKER_TEMPLATE)
+
+    assert 'LEGION_PRELOAD=true' in entrypoint
+    assert '-w 4 \\\n    --preload \\\n' in entrypoint
+
+
+def test_grpc_port(tmpdir):
+    output = pack(tmpdir, grpcPort=5001)
+    dockerfile = read(output, DOCKERFILE_TEMPLATE)
+
+    assert 'LEGION_GRPC_PORT=5001' in read(output, ENTRYPOINT_DOCKER_TEMPLATE)
+    assert 'pip install gunicorn[gevent] grpcio' in dockerfile
+    assert 'EXPOSE 5001' in dockerfile
+    assert os.path.exists(os.path.join(output, 'legion_model_service.proto'))
+    assert os.path.exists(os.path.join(output, 'legion_model_grpc.py'))
+    assert 'legion_model_grpc.py' in dockerfile
+
+
+def test_input_validation(tmpdir):
+    assert 'LEGION_INPUT_VALIDATION=true' in read(pack(tmpdir, inputValidation=True), ENTRYPOINT_DOCKER_TEMPLATE)
+
+
+def test_reorder_columns(tmpdir):
+    assert 'LEGION_REORDER_COLUMNS=true' in read(pack(tmpdir, reorderColumns=True), ENTRYPOINT_DOCKER_TEMPLATE)
+
+
+def test_prediction_log(tmpdir):
+    output = pack(tmpdir, predictionLog='tcp://collector:9000', predictionLogQueueMb=16)
+    entrypoint = read(output, ENTRYPOINT_DOCKER_TEMPLATE)
+
+    assert 'LEGION_PREDICTION_LOG=tcp://collector:9000' in entrypoint
+    assert 'LEGION_PREDICTION_LOG_QUEUE_MB=16' in entrypoint
+    assert os.path.exists(os.path.join(output, 'legion_handler_log.py'))
+
+
+def test_profiler_token_is_hashed(tmpdir):
+    entrypoint = read(pack(tmpdir, profilerToken='secret'), ENTRYPOINT_DOCKER_TEMPLATE)
+
+    assert f'LEGION_PROFILER_TOKEN_SHA256={hashlib.sha256(b"secret").hexdigest()}' in entrypoint
+    assert 'secret' not in entrypoint
+
+
+def test_warmup_iterations(tmpdir):
+    assert 'LEGION_WARMUP_ITERATIONS=5' in read(pack(tmpdir, warmupIterations=5), ENTRYPOINT_DOCKER_TEMPLATE)
+
+
+def model_environment(tmpdir) -> str:
+    """
+    Build conda envs location where Python of the tests plays the model environment
+    """
+    conda_env = tmpdir.mkdir('conda-env')
+    conda_env.mkdir('bin').join('python').mksymlinkto(sys.executable)
+    return str(conda_env)
+
+
+def test_autotune(tmpdir):
+    output = pack(tmpdir, autotune=True, autotuneCpus=3, threads=8,
+                  dockerfileCondaEnvsLocation=model_environment(tmpdir))
+    entrypoint = read(output, ENTRYPOINT_DOCKER_TEMPLATE)
+    description = read(output, DESCRIPTION_TEMPLATE)
+
+    # Sum of two integers is a GIL-bound prediction
+    assert '-w 3 \\\n    --threads 2 \\\n    legion_handler:app' in entrypoint
+    assert '# Workers, threads and server mode are autotuned: CPU limit 3, prediction latency' in entrypoint
+    assert 'Workers: 3\nThreads: 2\nServer mode: wsgi\nServer settings are autotuned: CPU limit 3' in description
+
+
+def test_autotune_without_model_environment(tmpdir, monkeypatch):
+    monkeypatch.setattr(pipeline, 'autotune', lambda *args: pytest.fail('Model is calibrated out of its environment'))
+    output = pack(tmpdir, autotune=True, autotuneCpus=3, workers=2, threads=8,
+                  dockerfileCondaEnvsLocation=str(tmpdir.join('missing-env')))
+    entrypoint = read(output, ENTRYPOINT_DOCKER_TEMPLATE)
+
+    assert '-w 2 \\\n    --threads 8' in entrypoint
+    assert 'autotuned' not in entrypoint
+
+
+def test_autotune_requires_cpus():
+    with pytest.raises(pydantic.ValidationError):
+        PackagingResourceArguments(autotune=True)
+
+    assert PackagingResourceArguments(autotune=True, autotuneCpus=2).autotuneCpus == 2
+
+
+def test_autotune_keeps_settings_of_broken_model(tmpdir, monkeypatch):
+    monkeypatch.setattr(pipeline, 'autotune', lambda *args: None)
+    output = pack(tmpdir, autotune=True, autotuneCpus=3, workers=2, threads=8,
+                  dockerfileCondaEnvsLocation=model_environment(tmpdir))
+    entrypoint = read(output, ENTRYPOINT_DOCKER_TEMPLATE)
+
+    assert '-w 2 \\\n    --threads 8' in entrypoint
+    assert 'autotuned' not in entrypoint
+
+
+def test_native_thread_limits(tmpdir):
+    output = pack(tmpdir, workers=2, inferenceProcesses=2, autotuneCpus=8)
+    entrypoint = read(output, ENTRYPOINT_DOCKER_TEMPLATE)
+
+    assert 'LEGION_NATIVE_THREADS=$(( CPUS / 4 ))' in entrypoint
+    assert 'OMP_NUM_THREADS=$LEGION_NATIVE_THREADS \\\n' in entrypoint
+    # Default is computed at start of the container, not by CPUs of the packager
+    assert 'OMP_NUM_THREADS' not in read(output, DOCKERFILE_TEMPLATE)
+
+
+def test_native_thread_limits_are_computed_by_cpu_quota(tmpdir):
+    output = pack(tmpdir, workers=2)
+    script = read(output, ENTRYPOINT_DOCKER_TEMPLATE).split('\nPATH=')[0]
+
+    result = subprocess.run(['bash', '-c', script + '\necho $LEGION_NATIVE_THREADS'], stdout=subprocess.PIPE,
+                            check=True, universal_newlines=True, env={'PATH': os.environ['PATH']})
+
+    assert int(result.stdout) == choose_native_threads(read_cpu_limit(), 2)
+
+
+def test_explicit_native_thread_limit(tmpdir):
+    output = pack(tmpdir, nativeThreads=3)
+    entrypoint = read(output, ENTRYPOINT_DOCKER_TEMPLATE)
+
+    assert 'LEGION_NATIVE_THREADS=${LEGION_NATIVE_THREADS:-3}' in entrypoint
+    assert 'nproc' not in entrypoint
+    assert 'ENV OMP_NUM_THREADS=3 \\\n' in read(output, DOCKERFILE_TEMPLATE)
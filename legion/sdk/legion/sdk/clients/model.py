@@ -16,6 +16,8 @@
 """
 Model HTTP API client and utils
 """
+import gzip
+import io
 import json
 import logging
 
@@ -28,8 +30,39 @@ from legion.sdk import config
 from legion.sdk.clients.route import ModelRouteClient
 from legion.sdk.utils import ensure_function_succeed
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 LOGGER = logging.getLogger(__name__)
 
+JSON_FORMAT = 'application/json'
+NPY_FORMAT = 'application/x-npy'
+ARROW_FORMAT = 'application/vnd.apache.arrow.stream'
+DATA_COLUMNS_HEADER = 'Data-Columns'
+REQUEST_TIMEOUT_MS_HEADER = 'Request-Timeout-Ms'
+
+GZIP_ENCODING = 'gzip'
+ZSTD_ENCODING = 'zstd'
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+# Accepted encodings of model responses
+ACCEPT_ENCODING = 'zstd, gzip' if zstandard else 'gzip'
+# Request bodies smaller than this size (bytes) are not compressed
+COMPRESSION_MIN_SIZE = 1024
+
 
 def encode_http_params(data):
     """
@@ -84,6 +117,112 @@ def calculate_url(host: str, url: str = None, model_route: str = None, model_dep
     raise NotImplementedError("Cannot create a model url")
 
 
+def encode_matrix(data, columns, data_format):
+    """
+    Encode matrix and column names to binary columnar format
+
+    :param data: matrix (list of rows or numpy array)
+    :param columns: (Optional) column names
+    :param data_format: NPY_FORMAT or ARROW_FORMAT
+    :return: tuple[bytes, dict] -- encoded body and additional headers
+    """
+    if numpy is None:
+        raise ValueError('numpy is required for {} format'.format(data_format))
+
+    matrix = numpy.asarray(data)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    buffer = io.BytesIO()
+
+    if data_format == NPY_FORMAT:
+        numpy.save(buffer, matrix, allow_pickle=False)
+        headers = {DATA_COLUMNS_HEADER: json.dumps(list(columns))} if columns else {}
+        return buffer.getvalue(), headers
+
+    if data_format == ARROW_FORMAT:
+        if pyarrow is None:
+            raise ValueError('pyarrow is required for {} format'.format(data_format))
+
+        names = list(columns) if columns else [str(index) for index in range(matrix.shape[1])]
+        batch = pyarrow.RecordBatch.from_arrays([pyarrow.array(matrix[:, index])
+                                                 for index in range(matrix.shape[1])], names=names)
+        with pyarrow.ipc.new_stream(buffer, batch.schema) as writer:
+            writer.write_batch(batch)
+        return buffer.getvalue(), {}
+
+    raise ValueError('Unknown data format: {}'.format(data_format))
+
+
+def decode_matrix(content, content_type, headers):
+    """
+    Decode binary columnar model response
+
+    :param content: response body
+    :type content: bytes
+    :param content_type: mimetype of response body
+    :type content_type: str
+    :param headers: response headers
+    :return: dict -- parsed response with `prediction` (numpy array) and `columns`
+    """
+    if content_type == NPY_FORMAT:
+        columns = headers.get(DATA_COLUMNS_HEADER)
+        return {
+            'prediction': numpy.load(io.BytesIO(content), allow_pickle=False),
+            'columns': json.loads(columns) if columns else None
+        }
+
+    if content_type == ARROW_FORMAT:
+        table = pyarrow.ipc.open_stream(content).read_all()
+        return {
+            'prediction': numpy.column_stack([column.to_numpy() for column in table.columns]),
+            'columns': table.column_names
+        }
+
+    raise ValueError('Unknown data format: {}'.format(content_type))
+
+
+def compress_body(body, encoding):
+    """
+    Compress request body
+
+    :param body: request body
+    :type body: bytes
+    :param encoding: GZIP_ENCODING or ZSTD_ENCODING
+    :type encoding: str
+    :return: bytes -- compressed body
+    """
+    if encoding == GZIP_ENCODING:
+        return gzip.compress(body, compresslevel=6)
+
+    if encoding == ZSTD_ENCODING:
+        if zstandard is None:
+            raise ValueError('zstandard is required for {} encoding'.format(encoding))
+        return zstandard.ZstdCompressor().compress(body)
+
+    raise ValueError('Unknown content encoding: {}'.format(encoding))
+
+
+def decompress_body(content, encoding):
+    """
+    Decompress response body if it has not been decompressed by HTTP client yet
+
+    :param content: response body
+    :type content: bytes
+    :param encoding: value of Content-Encoding header
+    :type encoding: str
+    :return: bytes -- decompressed body
+    """
+    if encoding == GZIP_ENCODING and content[:2] == GZIP_MAGIC:
+        return gzip.decompress(content)
+
+    if encoding == ZSTD_ENCODING and content[:4] == ZSTD_MAGIC:
+        if zstandard is None:
+            raise ValueError('zstandard is required for {} encoding'.format(encoding))
+        return zstandard.ZstdDecompressor().decompressobj().decompress(content)
+
+    return content
+
+
 def calculate_url_from_config():
     """
     Calculate url for model with config values
@@ -101,7 +240,7 @@ class ModelClient:
 
     def __init__(self, url=None, token=None, http_client=requests,
                  http_exception=requests.exceptions.RequestException,
-                 timeout=None):
+                 timeout=None, data_format=JSON_FORMAT, compression=GZIP_ENCODING):
         """
         Build client
 
@@ -113,12 +252,20 @@ class ModelClient:
         :type http_exception: python class that implements Exception class interface
         :param timeout: timeout for connections
         :type timeout: int
+        :param data_format: format of invoke request and response (JSON_FORMAT, NPY_FORMAT or ARROW_FORMAT)
+        :type data_format: str
+        :param compression: encoding of invoke request bodies (default: GZIP_ENCODING, which every model server
+                            supports; ZSTD_ENCODING requires zstdCompression packaging option; None disables
+                            compression). Responses are decompressed regardless of this parameter
+        :type compression: str
         """
         self._url = url
         self._token = token
         self._http_client = http_client
         self._http_exception = http_exception
         self._timeout = timeout
+        self._data_format = data_format
+        self._compression = compression
 
         LOGGER.debug('Model client params: %s, %s, %s, %s, %s', url, token, http_client, http_exception, timeout)
 
@@ -161,10 +308,14 @@ class ModelClient:
         :type response: object with .text or .data and .status_code attributes
         :return: dict -- parsed response
         """
-        data = response.text if hasattr(response, 'text') else response.data
+        content = response.content if hasattr(response, 'content') else response.data
+        content = decompress_body(content, response.headers.get('Content-Encoding'))
 
-        if isinstance(data, bytes):
-            data = data.decode('utf-8')
+        content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+        if content_type in (NPY_FORMAT, ARROW_FORMAT) and 200 <= response.status_code < 400:
+            return decode_matrix(content, content_type, response.headers)
+
+        data = content.decode('utf-8', errors='replace')
 
         try:
             data = json.loads(data)
@@ -192,6 +343,20 @@ class ModelClient:
             kwargs['timeout'] = self._timeout
         return kwargs
 
+    @property
+    def _invoke_kwargs(self):
+        """
+        Get additional HTTP client key-value arguments of invoke request.
+        Client timeout (read timeout if tuple) is sent as a deadline of prediction
+
+        :return: dict -- additional kwargs
+        """
+        kwargs = self._additional_kwargs
+        if self._timeout is not None:
+            timeout = self._timeout[-1] if isinstance(self._timeout, (tuple, list)) else self._timeout
+            kwargs.setdefault('headers', {})[REQUEST_TIMEOUT_MS_HEADER] = str(int(timeout * 1000))
+        return kwargs
+
     def _request(self, http_method, url, data=None, files=None, retries=10, sleep=3, **kwargs):
         """
         Send request with provided method and other parameters
@@ -237,7 +402,56 @@ class ModelClient:
         :type parameters: dict[str, object] -- dictionary with parameters
         :return: dict -- parsed model response
         """
-        return self._request('post', f'{self.api_url}/invoke', **self._additional_kwargs, json=parameters)
+        kwargs = self._invoke_kwargs
+        headers = kwargs.setdefault('headers', {})
+
+        if self._data_format == JSON_FORMAT:
+            body = json.dumps(parameters).encode('utf-8')
+        else:
+            body, format_headers = encode_matrix(parameters.get('data'), parameters.get('columns'), self._data_format)
+            headers.update(format_headers)
+            headers['Accept'] = self._data_format
+        headers['Content-Type'] = self._data_format
+
+        return self._request('post', f'{self.api_url}/invoke', data=self._compress(body, headers), **kwargs)
+
+    def invoke_batch(self, payloads):
+        """
+        Invoke model with many independent payloads in one request (JSON format is used regardless of data format).
+        Matrices with the same columns are predicted by the model at once
+
+        :param payloads: parameters of invocations (`data` and optional `columns`), numpy arrays are converted to lists
+        :type payloads: list[dict[str, object]]
+        :return: list[dict] -- result (`prediction` and `columns`) or error (`error`) of every payload, in order
+        """
+        kwargs = self._invoke_kwargs
+        headers = kwargs.setdefault('headers', {})
+
+        body = json.dumps([
+            {key: value.tolist() if hasattr(value, 'tolist') else value for key, value in parameters.items()}
+            for parameters in payloads
+        ]).encode('utf-8')
+        headers['Content-Type'] = JSON_FORMAT
+
+        return self._request('post', self.build_batch_url(), data=self._compress(body, headers), **kwargs)
+
+    def _compress(self, body, headers):
+        """
+        Compress request body if compression is enabled and body is large enough
+
+        :param body: request body
+        :type body: bytes
+        :param headers: request headers, encoding headers are added to them
+        :type headers: dict
+        :return: bytes -- request body
+        """
+        headers['Accept-Encoding'] = ACCEPT_ENCODING
+
+        if self._compression and len(body) >= COMPRESSION_MIN_SIZE:
+            body = compress_body(body, self._compression)
+            headers['Content-Encoding'] = self._compression
+
+        return body
 
     def info(self):
         """
@@ -0,0 +1,248 @@
+#
+#    Copyright 2019 EPAM Systems
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+"""
+Model gRPC API client (legion.model.ModelService of REST packager, see legion_model_service.proto)
+
+Messages are encoded in protobuf wire format without generated code. The module depends only on grpcio and numpy,
+REST packager copies it to model images with gRPC endpoint, where the model server uses the same message codec.
+"""
+import logging
+
+try:
+    import grpc
+except ImportError:
+    grpc = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+LOGGER = logging.getLogger(__name__)
+
+SERVICE_NAME = 'legion.model.ModelService'
+PREDICT_METHOD = '/{}/Predict'.format(SERVICE_NAME)
+PREDICT_STREAM_METHOD = '/{}/PredictStream'.format(SERVICE_NAME)
+
+# Wire types of protobuf encoding
+VARINT = 0
+LENGTH_DELIMITED = 2
+
+
+def _encode_varint(value):
+    value &= (1 << 64) - 1
+    result = bytearray()
+    while True:
+        bits = value & 0x7f
+        value >>= 7
+        if value:
+            result.append(bits | 0x80)
+        else:
+            result.append(bits)
+            return bytes(result)
+
+
+def _decode_varint(data, position):
+    result = shift = 0
+    while True:
+        if position >= len(data):
+            raise ValueError('Truncated varint')
+        byte = data[position]
+        result |= (byte & 0x7f) << shift
+        position += 1
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+
+
+def _encode_field(number, value):
+    return _encode_varint(number << 3 | LENGTH_DELIMITED) + _encode_varint(len(value)) + value
+
+
+def _encode_scalar_field(number, value):
+    # proto3 does not serialize scalar (and packed repeated) fields with default (empty) values
+    return _encode_field(number, value) if value else b''
+
+
+def _decode_fields(data):
+    position = 0
+    while position < len(data):
+        key, position = _decode_varint(data, position)
+        number, wire_type = key >> 3, key & 0x7
+        if wire_type == VARINT:
+            value, position = _decode_varint(data, position)
+        elif wire_type == LENGTH_DELIMITED:
+            length, position = _decode_varint(data, position)
+            value = data[position:position + length]
+            position += length
+        else:
+            raise ValueError('Unsupported wire type {}'.format(wire_type))
+        yield number, wire_type, value
+
+
+def encode_matrix_message(matrix, columns=None):
+    """
+    Encode PredictRequest / PredictResponse (both have tensor as field 1 and columns as field 2)
+
+    :param matrix: numeric matrix (list of rows or numpy array)
+    :param columns: (Optional) column names
+    :type columns: list[str]
+    :return: bytes -- encoded message
+    """
+    array = numpy.ascontiguousarray(matrix)
+    if array.dtype.hasobject:
+        raise ValueError('Only numeric matrices can be sent as tensors')
+
+    tensor = _encode_scalar_field(1, b''.join(_encode_varint(dimension) for dimension in array.shape)) + \
+        _encode_scalar_field(2, array.dtype.str.encode('utf-8')) + \
+        _encode_scalar_field(3, array.tobytes())
+
+    return _encode_field(1, tensor) + b''.join(_encode_field(2, str(column).encode('utf-8'))
+                                               for column in (columns or ()))
+
+
+def decode_matrix_message(data):
+    """
+    Decode PredictRequest / PredictResponse
+
+    :param data: encoded message
+    :type data: bytes
+    :return: tuple -- matrix (numpy array) and column names (None if not provided)
+    """
+    tensor = b''
+    columns = []
+    for number, wire_type, value in _decode_fields(data):
+        if number == 1 and wire_type == LENGTH_DELIMITED:
+            tensor = value
+        elif number == 2 and wire_type == LENGTH_DELIMITED:
+            columns.append(value.decode('utf-8'))
+
+    shape = []
+    dtype = '<f8'
+    values = b''
+    for number, wire_type, value in _decode_fields(tensor):
+        if number == 1 and wire_type == LENGTH_DELIMITED:
+            position = 0
+            while position < len(value):
+                dimension, position = _decode_varint(value, position)
+                shape.append(dimension)
+        elif number == 1 and wire_type == VARINT:
+            shape.append(value)
+        elif number == 2:
+            dtype = value.decode('utf-8')
+        elif number == 3:
+            values = value
+
+    matrix = numpy.frombuffer(values, dtype=numpy.dtype(dtype))
+    return matrix.reshape(shape) if shape else matrix, columns or None
+
+
+def encode_predict_request(data, columns=None):
+    """
+    Encode PredictRequest message
+
+    :param data: numeric matrix (list of rows or numpy array), a single row is sent as a matrix of one row
+    :param columns: (Optional) column names
+    :type columns: list[str]
+    :return: bytes -- encoded message
+    """
+    matrix = numpy.asarray(data)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+
+    return encode_matrix_message(matrix, columns)
+
+
+def decode_predict_response(data):
+    """
+    Decode PredictResponse message
+
+    :param data: encoded message
+    :type data: bytes
+    :return: dict -- `prediction` (numpy array) and `columns`
+    """
+    prediction, columns = decode_matrix_message(data)
+    return {
+        'prediction': prediction,
+        'columns': columns
+    }
+
+
+class GrpcModelClient:
+    """
+    Model gRPC client with the same invoke interface as ModelClient (binary formats)
+    """
+
+    def __init__(self, target, token=None, timeout=None, channel=None):
+        """
+        Build client
+
+        :param target: gRPC server address (host:port)
+        :type target: str
+        :param token: API token value to use (default: None)
+        :type token: str
+        :param timeout: timeout of RPCs in seconds, it is propagated to model server as a deadline of prediction
+        :type timeout: float
+        :param channel: (Optional) gRPC channel to use instead of insecure channel to target
+        """
+        if grpc is None or numpy is None:
+            raise ValueError('grpcio and numpy are required for gRPC model client')
+
+        self._channel = channel or grpc.insecure_channel(target)
+        self._token = token
+        self._timeout = timeout
+        self._predict = self._channel.unary_unary(PREDICT_METHOD,
+                                                  request_serializer=None,
+                                                  response_deserializer=decode_predict_response)
+        self._predict_stream = self._channel.stream_stream(PREDICT_STREAM_METHOD,
+                                                           request_serializer=None,
+                                                           response_deserializer=decode_predict_response)
+
+        LOGGER.debug('Model gRPC client params: %s, %s', target, timeout)
+
+    @property
+    def _metadata(self):
+        if self._token:
+            return (('authorization', 'Bearer {token}'.format(token=self._token)),)
+        return None
+
+    def invoke(self, **parameters):
+        """
+        Invoke model with matrix
+
+        :param parameters: `data` (numeric matrix) and (optional) `columns`
+        :type parameters: dict[str, object]
+        :return: dict -- `prediction` (numpy array) and `columns`
+        """
+        request = encode_predict_request(parameters.get('data'), parameters.get('columns'))
+        return self._predict(request, timeout=self._timeout, metadata=self._metadata)
+
+    def invoke_stream(self, requests):
+        """
+        Invoke model with a stream of matrices over one RPC
+
+        :param requests: iterable of dicts with `data` and (optional) `columns`
+        :return: iterator of dicts with `prediction` and `columns` (in order of requests)
+        """
+        encoded = (encode_predict_request(parameters.get('data'), parameters.get('columns'))
+                   for parameters in requests)
+        return self._predict_stream(encoded, timeout=self._timeout, metadata=self._metadata)
+
+    def close(self):
+        """
+        Close gRPC channel
+        """
+        self._channel.close()